@@ -43,6 +43,7 @@ test_cmd="$mydir/../pys test-ypp.py"
 	z00pp1:		--json=2 -Idata/snippets data/pp.yaml
 	z00pp2:		-Dmayday=1st.may -Dj.s=error -Idata/snippets --json=2 data/pp.yaml
 	z00data:	data/xx.yaml
+	z00scalar1:	-n data/scalar.yaml
 
 	# myotc test files
 	z00demo20:	-Idata/snippets --json=2 data/demo2.yaml
@@ -50,6 +51,7 @@ test_cmd="$mydir/../pys test-ypp.py"
 	z00letest1:	-Idata/snippets --json=2 data/letest.yaml
 	z00letest2:	-DSID=sys1 -Idata/snippets --json=2 data/letest.yaml
 	z00letest3: 	-DUSE_ACME -DSID=sys1 -Idata/snippets --json=2 data/letest.yaml
+	z00jobs1:	-j2 -DSID=sys1 -Idata/snippets --json=2 data/letest.yaml data/demo2.yaml data/pp.yaml
 
 	z00tsv21:	-Idata/snippets -DUSE_ACME --json=2 data/ts-v2.yaml
 	z00tsv22: 	-Idata/snippets -DSID=tsv2 --json=2 data/ts-v2.yaml
@@ -0,0 +1,47 @@
+#!python3
+'''Start-up import checks
+
+Imports `ypp` in fresh interpreters and fails if libraries that
+are only needed by some directives are imported eagerly, or if
+the import takes much longer than the recorded baseline.
+
+```
+test-imports.py [runs]
+```
+'''
+import os
+import sys
+
+ypplib_dir = os.path.abspath(os.path.join(os.path.dirname(__file__),'..'))
+
+sys.path.insert(0, os.path.join(ypplib_dir, 'ypp'))
+import bench
+
+LAZY_MODULES = ('cryptography', 'passlib', 'concurrent.futures', 'asyncio')
+'''Modules that must only be imported when first used'''
+BASELINE_US = 90000
+'''Cumulative import time of `ypp` in microseconds, as measured with `ypp.bench imports`'''
+SLACK = 3
+'''Factor by which the import time may exceed `BASELINE_US`, to allow for slower machines'''
+
+def check(runs:int) -> int:
+  '''Check the start-up imports
+
+  :param runs: number of fresh interpreters to run, the best time is used
+  :returns: number of failed checks
+  '''
+  times = bench.import_times('ypp', runs)
+  errors = 0
+  eager = [ name for name in LAZY_MODULES if name in times ]
+  if eager:
+    sys.stderr.write(f'Imported eagerly: {", ".join(eager)}\n')
+    errors += 1
+  cumulative = times['ypp'][1]
+  sys.stderr.write(f'ypp import time: {cumulative/1000:.1f} ms (baseline {BASELINE_US/1000:.1f} ms)\n')
+  if cumulative > BASELINE_US * SLACK:
+    sys.stderr.write(f'Import time exceeds {SLACK}x the baseline\n')
+    errors += 1
+  return errors
+
+if __name__ == '__main__':
+  sys.exit(0 if check(int(sys.argv[1]) if len(sys.argv) > 1 else 5) == 0 else 1)
@@ -1,45 +1,86 @@
 #!python3
+'''Command line test runner
+
+Test cases are JSON files with the command line arguments and the
+expected exit code, standard output, standard error and MD5 of the
+`output.txt` file.
+
+Cases are run in-process by calling the command line interface
+`main` function, with captured output.  Independent cases are run
+in parallel by a pool of worker processes.
+
+```
+test-ypp.py run [ypp arguments] > case.json
+test-ypp.py test [-jN] case.json ...
+```
+'''
 import difflib
 import hashlib
+import io
 import json
 import os
-import platform
 import re
 import shlex
-import subprocess
 import sys
+import tempfile
 import typing
 
-ypplib_dir = os.path.join(os.path.dirname(__file__),'..')
+from concurrent.futures import ProcessPoolExecutor
+
+ypplib_dir = os.path.abspath(os.path.join(os.path.dirname(__file__),'..'))
 output_txt = 'output.txt'
 
+sys.path.insert(0, ypplib_dir)
+import ypp
+import ypp.__main__
+from ypp import server
+import extcmd   # Same module instances as used by ypp
+import pwhash
+import sshkeys
+
 def remove_passwds(src:str) -> str:
   return re.sub(r'(\$[0-9]\$)[a-zA-Z0-9+/.]+\$[a-zA-Z0-9+/.]+',r'\1___$_________',src)
 
-def run_ypp(args:str) -> tuple[int,str,str]:
-  cmd = 'pys -m ypp ' if platform.system() == 'Windows' else './pys -m ypp '
-  cmd += args
-
-  sys.stderr.write(cmd+' : ')
-  outpath = os.path.join(ypplib_dir, output_txt)
-
-  if os.path.isfile(outpath): os.unlink(outpath)
-  rc = subprocess.run(cmd,
-                      capture_output=True,
-                      text=True,
-                      shell=True,
-                      cwd = ypplib_dir)
-  sys.stderr.write(' {returncode}\n'.format(returncode=rc.returncode))
-  if os.path.isfile(outpath):
-    with open(outpath,'rb') as fp:
-      hasher = hashlib.md5()
-      hasher.update(fp.read())
-      md5 = hasher.hexdigest()
-    os.unlink(outpath)
-  else:
-    md5 = None
-
-  return  rc.returncode, remove_passwds(rc.stdout).split('\n'), rc.stderr.split('\n'), md5
+def init_worker() -> None:
+  '''Set up a worker process to run test cases'''
+  os.chdir(ypplib_dir)
+  # Help text is formatted for a pipe, as when running ypp in a sub-process
+  os.environ.setdefault('COLUMNS', '80')
+
+def isolate() -> None:
+  '''Reset global state so that test cases do not see each other'''
+  ypp.reset()
+  pwhash.stores.clear()
+  ypp.pwhash.stores.clear()
+  sshkeys.key_cache.clear()
+  ypp.sshkeys.key_cache.clear()
+  extcmd.cache.clear()
+
+def run_ypp(args:str) -> tuple[int,list[str],list[str],str|None]:
+  '''Run the command line interface in-process
+
+  :param args: command line arguments
+  :returns: exit code, standard output and error lines and MD5 of `output.txt`
+
+  `output.txt` is redirected to a private file, so that cases
+  can run concurrently.
+  '''
+  with tempfile.TemporaryDirectory() as tmpdir:
+    outpath = os.path.join(tmpdir, output_txt)
+    argv = [outpath if arg == output_txt else arg for arg in shlex.split(args)]
+
+    isolate()
+    rc, out, err = server.run_handler(ypp.__main__.main, argv, '')
+
+    if os.path.isfile(outpath):
+      with open(outpath,'rb') as fp:
+        hasher = hashlib.md5()
+        hasher.update(fp.read())
+        md5 = hasher.hexdigest()
+    else:
+      md5 = None
+
+  return  rc, remove_passwds(out).split('\n'), err.split('\n'), md5
 
 def differ(seg:str, a:list[str], b:list[str], fp:typing.TextIO) -> int:
   sa = '\n'.join(a)
@@ -53,32 +94,59 @@ def differ(seg:str, a:list[str], b:list[str], fp:typing.TextIO) -> int:
   fp.writelines(diff)
   return 1
 
+def check_case(testcase:str) -> tuple[str,int,str]:
+  '''Run a test case and compare the results
+
+  :param testcase: JSON test case file
+  :returns: command line, exit code and report of differences
+  '''
+  with open(testcase) as fp:
+    jsdat = json.load(fp)
+  if not 'md5' in jsdat: jsdat['md5'] = None
+
+  rc, out, err, md5 = run_ypp(jsdat['args'])
+
+  diff = 0
+  report = io.StringIO()
+  if rc != jsdat['rc']:
+    diff += 1
+    report.write('Return code was {rc}.  Expected {jsrc}\n'.format(
+                  rc = rc, jsrc=jsdat['rc']))
+  diff += differ('out', out, jsdat['out'], report)
+  diff += differ('err', err, jsdat['err'], report)
+  if (str(md5) != str(jsdat['md5'])):
+    diff += 1
+    report.write('MD5 was {md5}.  Expected {jsmd5}\n'.format(
+                  md5 = md5, jsmd5 = jsdat['md5']))
+  return jsdat['args'], rc, diff, report.getvalue()
+
 def run_cmd(args:list[str]) -> None:
   match args[0]:
     case 'run':
       # Run test case
+      init_worker()
       yppcmd = shlex.join(args[1:])
       rc, out, err, md5 = run_ypp(yppcmd)
+      sys.stderr.write(f'{yppcmd} :  {rc}\n')
       print(json.dumps({'args': yppcmd, 'rc': rc, 'out': out, 'err': err, 'md5': md5}, indent=4))
     case 'test':
+      jobs = os.cpu_count() or 1
+      testcases = []
+      for arg in args[1:]:
+        if arg.startswith('-j'):
+          jobs = int(arg[2:])
+        else:
+          # Workers run in the top directory
+          testcases.append(os.path.abspath(arg))
+
       diff = 0
-      for testcase in args[1:]:
-        with open(testcase) as fp:
-          jsdat = json.load(fp)
-        if not 'md5' in jsdat: jsdat['md5'] = None
-
-        rc, out, err, md5 = run_ypp(jsdat['args'])
-
-        if rc != jsdat['rc']:
-          diff += 1
-          sys.stderr.write('Return code was {rc}.  Expected {jsrc}\n'.format(
-                            rc = rc, jsrc=jsdat['rc']))
-        diff += differ('out', out, jsdat['out'], sys.stderr)
-        diff += differ('err', err, jsdat['err'], sys.stderr)
-        if (str(md5) != str(jsdat['md5'])):
-          diff += 1
-          sys.stderr.write('MD5 was {md5}.  Expected {jsmd5}\n'.format(
-                            md5 = md5, jsmd5 = jsdat['md5']))
+      with ProcessPoolExecutor(max_workers = max(1, min(jobs, len(testcases))),
+                               initializer = init_worker) as pool:
+        # Reports are printed in test case order
+        for yppcmd, rc, count, report in pool.map(check_case, testcases):
+          sys.stderr.write(f'{yppcmd} :  {rc}\n')
+          sys.stderr.write(report)
+          diff += count
       sys.exit(0 if diff == 0 else 1)
     case _:
       print(args)
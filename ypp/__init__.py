@@ -5,8 +5,10 @@ This library can be used to enhance YAML based configuration
 files to also include pre-processor directives and macro
 expansions.
 
-This module makes available the {py:obj}`pproc.YamlPreProcessor`
-and {py:obj}`ipp.STR` directly.
+This module makes available the {py:obj}`pproc.YamlPreProcessor`,
+{py:obj}`ipp.STR`, {py:obj}`compiler.set_cache`,
+{py:obj}`pwhash.set_hash_cache` and {py:obj}`extcmd.set_exec_cache`
+directly.
 
 So you can just:
 
@@ -33,6 +35,7 @@ inc_path = ypp.lookup(ypp.STR.INCLUDE_PATH)
 
 '''
 
+import contextlib
 import os
 import sys
 import typing
@@ -54,11 +57,19 @@ sys.path.append(os.path.dirname(__file__))
 from version import VERSION
 from pproc import YamlPreProcessor
 from ipp import STR
+from compiler import set_cache
+from pwhash import set_hash_cache
+from pwhash import revalidate as revalidate_stores
+from pwhash import set_locking as set_store_locking
+from extcmd import set_exec_cache
 import __meta__
 
 sys.path = saved_path
 del saved_path
 
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+'''YAML loader, uses libyaml when available'''
+
 
 default_vars = dict()
 ''' _private_
@@ -89,6 +100,19 @@ def init(config:list[str] = [], include:list[str] = [], define:list[str] = [], a
     default_vars[VERSION] = YamlPreProcessor(config, include, define, app_defaults, env_prefix)
   return default_vars[VERSION]
 
+def reset() -> None:
+  '''Reset the procedural API
+
+  Drops the pre-processor instance created by `init`, so that the
+  next call to `init` starts with fresh variables.  Compiled templates,
+  keys and secrets stay cached, but secrets changed on disk by other
+  programs are re-read.
+
+  Used to serve independent requests from a single process.
+  '''
+  default_vars.clear()
+  revalidate_stores()
+
 def process(fileptr:str|typing.TextIO) -> str:
   '''Process a file or file-pointer
 
@@ -108,17 +132,65 @@ def process(fileptr:str|typing.TextIO) -> str:
   if len(default_vars) == 0: raise RuntimeError
   return default_vars[VERSION].process(fileptr)
 
+def iter_process(fileptr:str|typing.TextIO) -> typing.Iterator[str]:
+  '''Process a file or file-pointer yielding output as it is produced
+
+  :param fileptr: a str containing a file name or a TextIO object as returned by `open`
+  :returns: iterator yielding pre-processed text chunks
+  :raises RuntimeError: If `init` has not been called
+
+  Streaming version of `process`.  Use this to write large documents
+  without holding the whole output in memory.
+  '''
+  if len(default_vars) == 0: raise RuntimeError
+  return default_vars[VERSION].iter_process(fileptr)
+
+@contextlib.contextmanager
+def yaml_source(yppi:YamlPreProcessor, fileptr:str|typing.TextIO, stream:bool = False) -> typing.Iterator[str|typing.TextIO]:
+  '''Pre-process a file for the YAML loader
+  :param yppi: pre-processor instance
+  :param fileptr: a str containing a file name or a TextIO object as returned by `open`
+  :param stream: always read the pre-processed text while it is being produced
+  :returns: context manager giving the text to pass to `yaml.load`
+
+  With libyaml, the loader reads the pre-processed text while it
+  is being produced.  The pure Python loader is faster parsing a
+  string, so the whole text is pre-processed first, unless `stream`
+  is set.  Use `stream` when loading documents one at a time, so
+  that only one document is kept in memory with either loader.
+  '''
+  if SafeLoader is yaml.SafeLoader and not stream:
+    yield yppi.process(fileptr)
+  else:
+    with yppi.reader(fileptr) as fp:
+      yield fp
+
 def load(fileptr:str|typing.TextIO) -> any:
   '''Load a YAML file or a file-pointer and returns its structure
   :param fileptr: a str containing a file name or a TextIO object as returned by `open`
   :returns: object as specified in the YAML input file
   :raises RuntimeError: If `init` has not been called
 
-  Utility function that calls `process` and subsequently loads its
-  output using `yaml.safe_load`.
+  Utility function that pre-processes the file and loads its output
+  using `SafeLoader`.  See `yaml_source`.
   '''
-  ytxt = process(fileptr)
-  return yaml.safe_load(ytxt)
+  if len(default_vars) == 0: raise RuntimeError
+  with yaml_source(default_vars[VERSION], fileptr) as src:
+    return yaml.load(src, Loader = SafeLoader)
+
+def load_all(fileptr:str|typing.TextIO) -> typing.Iterator[any]:
+  '''Load a multi-document YAML file or file-pointer
+  :param fileptr: a str containing a file name or a TextIO object as returned by `open`
+  :returns: iterator yielding the structure of each document
+  :raises RuntimeError: If `init` has not been called
+
+  Same as `load`, but for streams with documents separated by
+  `---`.  Each document is yielded as soon as it is parsed, so
+  only one document is kept in memory at a time.
+  '''
+  if len(default_vars) == 0: raise RuntimeError
+  with yaml_source(default_vars[VERSION], fileptr, stream = True) as src:
+    yield from yaml.load_all(src, Loader = SafeLoader)
 
 def lookup(name:str) -> str|None:
   '''Returns the value of the given `name`
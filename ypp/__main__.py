@@ -8,13 +8,16 @@ the processed file.
 Optionally it can parse the generated YAML and dump it as a JSON
 object (which is also valid YAML document)
 '''
+import io
+import itertools
 import json
 import os
+import string
 import sys
 import typing
 import yaml
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
 
 try:
   from icecream import ic
@@ -25,6 +28,7 @@ if '__file__' in globals():
   sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
 import ypp
 import ypp.pwhash
+import ypp.sshkeys
 
 COMPACT = -1
 R_PWHASH = 'cash'
@@ -42,21 +46,34 @@ def cmd_cli():
                     const=COMPACT,    # indent=None, most compact representation
                     type=int,
                     nargs='?')
+  cli.add_argument('--json-lines', help='Parse YAML and write each document as one line of JSON as soon as it is parsed', action='store_true')
   cli.add_argument('-V','--version', action='version', version='%(prog)s '+ ypp.VERSION)
 
   cli.add_argument('-n','--no-pp', help='Disable pre-processor',action='store_true')
-  cli.add_argument('-o','--output', help='Save output to the given file', default=None)
+  cli.add_argument('-o','--output', help='Save output to the given file.  Use {stem} or {name} to save each input file separately', default=None)
+  cli.add_argument('-j','--jobs', help='Process input files in parallel using the given number of processes (default: 1, all CPUs for --cash -Dbulk)', type=int, default=None)
   cli.add_argument('--unix', help='Force UNIX mode output', action='store_true')
   cli.add_argument('--windows', help='Force Windows mode output', action='store_true')
+  cli.add_argument('--cache-dir', help='Cache compiled templates in the given directory', default=None)
+  cli.add_argument('--no-cache', help='Disable compiled template caching', action='store_true')
+  cli.add_argument('--hash-cache', help='Re-use password hashes cached in the secrets file name with .hashes appended, so unchanged passwords keep their hashes', action='store_true')
+  cli.add_argument('--rehash', help='Compute new password hashes instead of using cached hashes (requires --hash-cache)', action='store_true')
+  cli.add_argument('--exec-ttl', help='Re-use #exec results for the given number of seconds (default: within a document)', type=float, default=None)
+  cli.add_argument('--exec-cache-dir', help='Save #exec results in the given directory (requires --exec-ttl)', default=None)
+  cli.add_argument('--no-exec-cache', help='Always run #exec commands', action='store_true')
+  cli.add_argument('--profile', help='Print time spent in directives, macros, files and variable look-ups to stderr (not available with --jobs)',
+                   choices=('text','json'), const='text', default=None, nargs='?')
+  cli.add_argument('--serve', help='Run as a daemon serving requests on the given UNIX socket', metavar='SOCKET', default=None)
+  cli.add_argument('--client', help='Send the request to the daemon listening on the given UNIX socket', metavar='SOCKET', default=None)
 
   cli.set_defaults(rutil = None)
   
   grp1 = cli.add_argument_group('Sub command options')
-  grp1.add_argument('--cash', help='Run cash utility (Use -Dalgo=xxx, -Dpwd=xxx)',
+  grp1.add_argument('--cash', help='Run cash utility (Use -Dalgo=xxx, -Dpwd=xxx, -Dbulk=file)',
                                 dest = 'rutil',
                                 const = R_PWHASH,
                                 action='store_const')
-  grp1.add_argument('--rnd', help='Generate random values (Use -Dlen=num, -Dchrset=xxx)',
+  grp1.add_argument('--rnd', help='Generate random values (Use -Dlen=num, -Dchrset=xxx, -Dcount=num)',
                                 dest = 'rutil',
                                 const = R_GENRAND,
                                 action='store_const')
@@ -71,85 +88,351 @@ def load_yaml(text:str|typing.TextIO) -> any:
   :returns: structure defined by YAML document
 
   This is a simple utility function that catches `ParserError`
-  exceptions and displays them on-screen.
+  exceptions and displays them on-screen.  It uses libyaml when
+  available.
   '''
 
   try:
-    res = yaml.safe_load(text)
+    res = yaml.load(text, Loader = ypp.SafeLoader)
   except yaml.parser.ParserError as err:
     sys.stderr.write(f'Yaml Parser error: {err}\n')
     sys.exit(1)
   return res
 
+def iter_load_yaml(text:str|typing.TextIO) -> typing.Iterator[any]:
+  '''Utility function for multi-document streams
+
+  :param text: YAML stream to load
+  :returns: iterator yielding the structure of each document
+
+  Same as `load_yaml`, but documents separated by `---` are
+  yielded one at a time, as soon as they are parsed.
+  '''
+  try:
+    yield from yaml.load_all(text, Loader = ypp.SafeLoader)
+  except yaml.parser.ParserError as err:
+    sys.stderr.write(f'Yaml Parser error: {err}\n')
+    sys.exit(1)
+
 def generate_output(outfp:typing.TextIO, res:any, js:int|None) -> None:
   if js is None:
-    outfp.write(yaml.dump(res))
+    outfp.write(yaml.dump(res, Dumper = yaml.SafeDumper))
   else:
     outfp.write(json.dumps(res, indent = None if js == COMPACT else js))
 
-def main(xargs:list[str]) -> None:
+def generate_docs(outfp:typing.TextIO, docs:typing.Iterable[any], js:int|None, json_lines:bool = False) -> None:
+  '''Write parsed documents
+
+  :param outfp: output file
+  :param docs: parsed documents
+  :param js: JSON indentation, `None` to output YAML
+  :param json_lines: write each document as one line of JSON
+
+  Documents are written as soon as they are available.  YAML
+  documents are separated by `---`, JSON documents by new lines.
+  An empty stream is written as a single `null` document, except
+  when writing JSON lines.
+
+  ```python
+  >>> generate_docs(sys.stdout, [{'a': 1}, [2]], None)
+  a: 1
+  ---
+  - 2
+  >>> generate_docs(sys.stdout, iter([{'a': 1}, [2]]), COMPACT, True)
+  {"a": 1}
+  [2]
+
+  ```
+  '''
+  count = 0
+  for res in docs:
+    if json_lines:
+      outfp.write(json.dumps(res) + '\n')
+    else:
+      if count > 0: outfp.write('---\n' if js is None else '\n')
+      generate_output(outfp, res, js)
+    outfp.flush()
+    count += 1
+  if count == 0 and not json_lines: generate_output(outfp, None, js)
+
+OUTPUT_FIELDS = ('name', 'stem')
+'''Fields allowed in output file name templates'''
+
+def output_name(template:str, input_file:str) -> str:
+  '''Generate output file name for an input file
+
+  :param template: output file name template
+  :param input_file: input file name
+  :returns: output file name
+
+  The template may contain `{name}` (the input file name without
+  directories) and `{stem}` (same as `{name}` without extension).
+
+  ```python
+  >>> output_name('out/{stem}.json', 'data/host1.yaml')
+  'out/host1.json'
+
+  ```
+  '''
+  name = os.path.basename(input_file)
+  return template.format(name = name, stem = os.path.splitext(name)[0])
+
+def output_names(template:str, input_files:list[str]) -> list[str]:
+  '''Generate and check the output file names of all input files
+
+  :param template: output file name template
+  :param input_files: input file names
+  :returns: output file names, in input order
+  :raises ValueError: if the template is invalid or two input files use the same output file
+
+  ```python
+  >>> output_names('out/{stem}.json', ['a/x.yaml', 'b/y.yaml'])
+  ['out/x.json', 'out/y.json']
+  >>> output_names('out/{path}.json', ['a/x.yaml'])
+  Traceback (most recent call last):
+  ...
+  ValueError: unknown field "path", use one of: name, stem
+  >>> output_names('out/{stem}.json', ['a/x.yaml', 'b/x.yaml'])
+  Traceback (most recent call last):
+  ...
+  ValueError: b/x.yaml and a/x.yaml both write out/x.json
+
+  ```
+  '''
+  for _, field, _, _ in string.Formatter().parse(template):
+    if not field is None and not field in OUTPUT_FIELDS:
+      raise ValueError(f'unknown field "{field}", use one of: {", ".join(OUTPUT_FIELDS)}')
+  names = []
+  seen = {}
+  for input_file in input_files:
+    fname = output_name(template, input_file)
+    key = os.path.normpath(os.path.abspath(fname))
+    if key in seen:
+      raise ValueError(f'{input_file} and {seen[key]} both write {fname}')
+    seen[key] = input_file
+    names.append(fname)
+  return names
+
+def open_output(fname:str, args:Namespace) -> typing.TextIO:
+  '''Open an output file honoring the `--unix` and `--windows` options
+
+  :param fname: file to open
+  :param args: parsed command line arguments
+  :returns: opened file
+  '''
+  dirname = os.path.dirname(fname)
+  if dirname: os.makedirs(dirname, exist_ok = True)
+  if args.unix:
+    return open(fname,'w',newline='\n')
+  elif args.windows:
+    return open(fname,'w',newline='\r\n')
+  else:
+    return open(fname,'w')
+
+def render(yppi:ypp.YamlPreProcessor, input_file:str|typing.TextIO, outfp:typing.TextIO, js:int|None, json_lines:bool = False) -> None:
+  '''Pre-process an input file and write the results
+
+  :param yppi: pre-processor instance
+  :param input_file: file to process
+  :param outfp: output file
+  :param js: JSON indentation, `None` to output the pre-processed text
+  :param json_lines: write each document as one line of JSON
+  '''
+  if js is None and not json_lines:
+    outfp.writelines(yppi.iter_process(input_file))
+  else:
+    # JSON lines are written as soon as each document is parsed
+    with ypp.yaml_source(yppi, input_file, stream = json_lines) as src:
+      generate_docs(outfp, iter_load_yaml(src), js, json_lines)
+
+def init_job(args:Namespace) -> None:
+  '''Initialize worker processes
+
+  :param args: parsed command line arguments
+  '''
+  ypp.set_cache(not args.no_cache, args.cache_dir)
+  ypp.set_hash_cache(args.hash_cache, args.rehash)
+  ypp.set_exec_cache(not args.no_exec_cache, args.exec_ttl, args.exec_cache_dir)
+  # Workers save the same secrets files concurrently
+  ypp.set_store_locking(True)
+
+def render_job(input_file:str, args:Namespace) -> str|None:
+  '''Pre-process an input file in a worker process
+
+  :param input_file: file to process
+  :param args: parsed command line arguments
+  :returns: output text, or `None` if the output was saved to its own file
+
+  Each file is processed by a new pre-processor instance initialized
+  from the command line options.  So, unlike when processing files
+  serially, definitions in one file are not seen by other files.
+  '''
+  yppi = ypp.YamlPreProcessor(args.config, args.include, args.define, {}, '')
+  if not args.output is None and '{' in args.output:
+    with open_output(output_name(args.output, input_file), args) as fp:
+      render(yppi, input_file, fp, args.json, args.json_lines)
+    return None
+  fp = io.StringIO()
+  render(yppi, input_file, fp, args.json, args.json_lines)
+  return fp.getvalue()
+
+def reads_stdin(args:Namespace) -> bool:
+  '''Check if a command reads standard input
+
+  :param args: parsed command line arguments
+  :returns: `True` if standard input is used
+  '''
+  if len(args.file) > 0: return False
+  if args.rutil is None: return True
+  if args.rutil == R_PWHASH:
+    return 'bulk=-' in args.define or not any(d.startswith('pwd=') for d in args.define)
+  return False
+
+def client(args:Namespace, xargs:list[str]) -> None:
+  '''Run a command in the daemon
+
+  :param args: parsed command line arguments
+  :param xargs: command line arguments
+
+  Output and exit code are the same as running the command locally.
+  '''
+  from ypp import server
+  stdin = sys.stdin.read() if reads_stdin(args) else None
+  try:
+    rc, out, err = server.call(args.client, server.strip_option(xargs, '--client'), stdin)
+  except (OSError, ValueError, KeyError) as e:
+    sys.stderr.write(f'{args.client}: {e}\n')
+    sys.exit(53)
+  sys.stdout.write(out)
+  sys.stderr.write(err)
+  sys.exit(rc)
+
+def serve_request(xargs:list[str]) -> None:
+  '''Handle a daemon request
+
+  :param xargs: command line arguments
+
+  Every request gets a fresh pre-processor instance.  Compiled
+  templates, keys and secrets stores are kept between requests.
+  '''
+  ypp.reset()
+  main(xargs, served = True)
+
+def main(xargs:list[str], served:bool = False) -> None:
   cli = cmd_cli()
   if '--json' in xargs:
     # I don't know a better way to handle this!
     i = xargs.index('--json')
     xargs[i] = f'--json={COMPACT}'
+  if '--profile' in xargs:
+    # Same for --profile, unless it is followed by a format
+    i = xargs.index('--profile')
+    if not xargs[i+1:i+2] in (['text'], ['json']): xargs[i] = '--profile=text'
   args = cli.parse_args(xargs)
+  # Bulk hashing defaults to all CPUs, everything else to one process
+  if args.jobs is None and args.rutil != R_PWHASH: args.jobs = 1
+
+  if not args.serve is None or not args.client is None:
+    if served:
+      sys.stderr.write('Options --serve and --client are not allowed in daemon requests\n')
+      sys.exit(52)
+    if not args.client is None:
+      client(args, xargs)
+    from ypp import server
+    server.serve(args.serve, serve_request)
+    return
 
   if args.unix and args.windows:
     sys.stderr.write('Options --unix and --windows are mutually exclusive\n')
     sys.exit(52)
+  if args.json_lines and not args.json is None:
+    sys.stderr.write('Options --json and --json-lines are mutually exclusive\n')
+    sys.exit(52)
+  per_file = not args.output is None and '{' in args.output and args.rutil is None
   if args.output is None:
     if args.unix or args.windows:
       sys.stderr.write('Options --unix and --windows only allowed when using --output option\n')
       sys.exit(52)
     outfp = sys.stdout
+  elif per_file:
+    outfp = None
   else:
-    if args.unix:
-      outfp = open(args.output,'w',newline='\n')
-    elif args.windows:
-      outfp = open(args.output,'w',newline='\r\n')
-    else:
-      outfp = open(args.output,'w')
-
-  if not args.rutil is None:
-    # Run utilities
-    if args.rutil == R_PWHASH:
-      ypp.pwhash.util(outfp, args.define)
-    elif args.rutil == R_GENRAND:
-      ypp.pwhash.randutil(outfp, args.define)
-    else:
-      raise NotImplementedError
-    exit()
-
-  if args.no_pp:
-    if len(args.file) == 0:
-      sys.stderr.write('Reading from stdin...\n')
-      res = load_yaml(sys.stdin)
-      generate_output(outfp, res, args.json)
-    else:
-      for input_file in args.file:
-        with open(input_file, 'r') as fp:
-          res = load_yaml(fp)
-          generate_output(outfp, res, args.json)
-  else:
-    ypp.init(args.config, args.include, args.define, {}, '')
-    if len(args.file) == 0:
-      sys.stderr.write('Reading from stdin...\n')
-      txt = ypp.process(sys.stdin)
-      if not args.json is None:
-        res = load_yaml(txt)
-        generate_output(outfp, res, args.json)
+    outfp = open_output(args.output, args)
+
+  profiler = None
+  if not args.profile is None:
+    from ypp import profiler as ypp_profiler
+    profiler = ypp_profiler.Profiler()
+
+  try:
+    if not args.rutil is None:
+      # Run utilities
+      if args.rutil == R_PWHASH:
+        ypp.pwhash.util(outfp, args.define, args.jobs)
+      elif args.rutil == R_GENRAND:
+        ypp.pwhash.randutil(outfp, args.define)
       else:
-        outfp.write(txt)
-    else:
-      for input_file in args.file:
-        txt = ypp.process(input_file)
-        if not args.json is None:
-          res = load_yaml(txt)
-          generate_output(outfp, res, args.json)
-        else:
-          outfp.write(txt)
+        raise NotImplementedError
+      return
 
+    if per_file:
+      if len(args.file) == 0:
+        sys.stderr.write('Output file templates require input files\n')
+        sys.exit(52)
+      try:
+        output_names(args.output, args.file)
+      except ValueError as err:
+        sys.stderr.write(f'Invalid output file template {args.output}: {err}\n')
+        sys.exit(52)
+
+    if args.no_pp:
+      if len(args.file) == 0:
+        sys.stderr.write('Reading from stdin...\n')
+        generate_docs(outfp, iter_load_yaml(sys.stdin), args.json, args.json_lines)
+      else:
+        for input_file in args.file:
+          with open(input_file, 'r') as fp:
+            if per_file:
+              with open_output(output_name(args.output, input_file), args) as ofp:
+                generate_docs(ofp, iter_load_yaml(fp), args.json, args.json_lines)
+            else:
+              generate_docs(outfp, iter_load_yaml(fp), args.json, args.json_lines)
+    else:
+      ypp.set_cache(not args.no_cache, args.cache_dir)
+      ypp.set_hash_cache(args.hash_cache, args.rehash)
+      ypp.set_exec_cache(not args.no_exec_cache, args.exec_ttl, args.exec_cache_dir)
+      if args.jobs > 1 and len(args.file) > 0:
+        # Generate missing SSH keys in parallel before pre-processing
+        pre = ypp.YamlPreProcessor(args.config, args.include, args.define, {}, '')
+        ypp.sshkeys.pregen_files(pre, args.file, args.jobs)
+        # Workers must agree on new passwords, so create them first
+        ypp.pwhash.pregen_files(pre, args.file)
+      if len(args.file) == 0:
+        yppi = ypp.init(args.config, args.include, args.define, {}, '')
+        if profiler: profiler.attach(yppi)
+        sys.stderr.write('Reading from stdin...\n')
+        render(yppi, sys.stdin, outfp, args.json, args.json_lines)
+      elif args.jobs > 1 and len(args.file) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers = args.jobs,
+                                 initializer = init_job,
+                                 initargs = (args,)) as pool:
+          # Results are returned in input order
+          for txt in pool.map(render_job, args.file, itertools.repeat(args)):
+            if not txt is None: outfp.write(txt)
+      else:
+        yppi = ypp.init(args.config, args.include, args.define, {}, '')
+        if profiler: profiler.attach(yppi)
+        for input_file in args.file:
+          if per_file:
+            with open_output(output_name(args.output, input_file), args) as fp:
+              render(yppi, input_file, fp, args.json, args.json_lines)
+          else:
+            render(yppi, input_file, outfp, args.json, args.json_lines)
+  finally:
+    # Daemon requests must not leave output files open
+    if not outfp is None and outfp is not sys.stdout: outfp.close()
+    if profiler: profiler.report(sys.stderr, args.profile)
 
 ###################################################################
 #
@@ -0,0 +1,947 @@
+#!/usr/bin/env python3
+'''Pre-processor benchmarks
+
+Collection of benchmarks used to check the performance
+characteristics of the pre-processor.  Run them from the
+command line:
+
+```bash
+python3 -m ypp.bench linear
+python3 -m ypp.bench stream
+python3 -m ypp.bench includes
+python3 -m ypp.bench scanner
+python3 -m ypp.bench variables
+python3 -m ypp.bench sshkeys
+python3 -m ypp.bench secrets
+python3 -m ypp.bench cash
+python3 -m ypp.bench rand
+python3 -m ypp.bench vnc
+python3 -m ypp.bench imports
+python3 -m ypp.bench exec
+python3 -m ypp.bench yaml
+python3 -m ypp.bench suite --save run.json
+python3 -m ypp.bench compare base.json run.json
+```
+
+Test documents are generated on-the-fly in a temporary directory.
+
+The `suite` benchmark renders a synthetic document for each of the
+`WORKLOADS` and reports lines/sec, MB/s of output and peak memory.
+Results can be saved as JSON and compared against an earlier run
+to catch performance regressions.
+'''
+import asyncio
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+import yaml
+
+from argparse import ArgumentParser
+
+if '__file__' in globals():
+  sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+import ypp
+import compiler # Same module instance as used by ypp
+import d3des
+import extcmd
+import pwhash
+import sshkeys
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+'''Directory with sample documents'''
+
+def gen_nested(dirname:str, lines:int, depth:int = 4) -> str:
+  '''Generate a YAML document split over nested `#include` files
+
+  :param dirname: directory where to create the files
+  :param lines: total number of lines to generate
+  :param depth: include nesting depth
+  :returns: file name of the top-level document
+
+  Lines are distributed evenly among the top-level document and
+  each nesting level.  Every line contains a variable reference.
+  '''
+  chunk = lines // (depth + 1)
+  for level in range(depth, -1, -1):
+    fname = os.path.join(dirname, f'level{level}.yaml')
+    with open(fname, 'w') as fp:
+      if level == 0: fp.write('#define VALUE value\n')
+      fp.write(f'level{level}:\n')
+      for i in range(chunk):
+        fp.write(f'  key{i}: $<VALUE> {i}\n')
+      if level < depth:
+        fp.write(f'  #include level{level+1}.yaml\n')
+  return os.path.join(dirname, 'level0.yaml')
+
+def timeit(func:typing.Callable, *args) -> tuple[float,any]:
+  '''Time a function call
+
+  :param func: function to call
+  :param args: arguments to pass to `func`
+  :returns: tuple(elapsed seconds, result)
+  '''
+  start = time.perf_counter()
+  res = func(*args)
+  return time.perf_counter() - start, res
+
+def bench_linear(args:list[str]) -> None:
+  '''Check that output assembly scales linearly
+
+  :param args: command line arguments
+
+  Processes documents with 1k to 1M lines (use `--max` to
+  change the upper limit) split over nested `#include` files
+  and reports the processing time per line.  With linear
+  output assembly, the time per line should remain constant.
+  '''
+  cli = ArgumentParser(prog='ypp.bench linear')
+  cli.add_argument('--max', help='Maximum number of lines', type=int, default=1000000)
+  cli.add_argument('--depth', help='Include nesting depth', type=int, default=4)
+  opts = cli.parse_args(args)
+
+  print(f'{"lines":>10} {"seconds":>10} {"lines/sec":>12} {"usec/line":>10}')
+  lines = 1000
+  while lines <= opts.max:
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fname = gen_nested(tmpdir, lines, opts.depth)
+      yppi = ypp.YamlPreProcessor()
+      secs, txt = timeit(yppi.process, fname)
+    count = txt.count('\n')
+    print(f'{count:>10} {secs:>10.3f} {count/secs:>12.0f} {secs*1000000/count:>10.2f}')
+    lines *= 10
+
+def peak_memory(func:typing.Callable, *args) -> int:
+  '''Measure peak memory allocated by a function call
+
+  :param func: function to call
+  :param args: arguments to pass to `func`
+  :returns: peak allocated bytes
+  '''
+  tracemalloc.start()
+  try:
+    func(*args)
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+def bench_stream(args:list[str]) -> None:
+  '''Compare peak memory of `process` and `iter_process`
+
+  :param args: command line arguments
+
+  Writes the processed output to `os.devnull` using either the
+  `process` method (whole document in memory) or the streaming
+  `iter_process` method.
+  '''
+  cli = ArgumentParser(prog='ypp.bench stream')
+  cli.add_argument('--lines', help='Number of lines', type=int, default=200000)
+  cli.add_argument('--depth', help='Include nesting depth', type=int, default=4)
+  opts = cli.parse_args(args)
+
+  def whole(fname:str) -> None:
+    with open(os.devnull, 'w') as fp:
+      fp.write(ypp.YamlPreProcessor().process(fname))
+  def streamed(fname:str) -> None:
+    with open(os.devnull, 'w') as fp:
+      fp.writelines(ypp.YamlPreProcessor().iter_process(fname))
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    fname = gen_nested(tmpdir, opts.lines, opts.depth)
+    for name, func in (('process', whole), ('iter_process', streamed)):
+      print(f'{name:>12}: peak {peak_memory(func, fname)/1024:.0f} KiB')
+
+def gen_snippets(dirname:str, count:int, lines:int = 50) -> str:
+  '''Generate a YAML document including the same snippet many times
+
+  :param dirname: directory where to create the files
+  :param count: number of times the snippet is included
+  :param lines: number of lines in the snippet
+  :returns: file name of the top-level document
+  '''
+  with open(os.path.join(dirname, 'snippet.yaml'), 'w') as fp:
+    fp.write('#ifndef snippet_value\n#define snippet_value $<VALUE>\n#endif\n')
+    for i in range(lines):
+      fp.write(f'key{i}: $<snippet_value> {i}\n' if i % 2 else f'key{i}: plain {i}\n')
+  fname = os.path.join(dirname, 'main.yaml')
+  with open(fname, 'w') as fp:
+    fp.write('#define VALUE value\n')
+    for i in range(count):
+      fp.write(f'item{i}:\n  #include snippet.yaml\n')
+  return fname
+
+def bench_includes(args:list[str]) -> None:
+  '''Measure the effect of the compiled template cache
+
+  :param args: command line arguments
+
+  Processes a document that includes the same snippet many times,
+  with and without the compiled template cache.
+  '''
+  cli = ArgumentParser(prog='ypp.bench includes')
+  cli.add_argument('--count', help='Number of includes', type=int, default=2000)
+  cli.add_argument('--lines', help='Lines per snippet', type=int, default=50)
+  opts = cli.parse_args(args)
+
+  max_cache_size = compiler.MAX_CACHE_SIZE
+  with tempfile.TemporaryDirectory() as tmpdir:
+    fname = gen_snippets(tmpdir, opts.count, opts.lines)
+    for name, limit in (('no cache', -1), ('cached', max_cache_size)):
+      compiler.cache.clear()
+      compiler.MAX_CACHE_SIZE = limit
+      secs, txt = timeit(ypp.YamlPreProcessor().process, fname)
+      print(f'{name:>10}: {secs:.3f} seconds, {txt.count(chr(10))/secs:.0f} lines/sec')
+  compiler.MAX_CACHE_SIZE = max_cache_size
+
+def legacy_find_closing_bracket(line:str, off:int) -> int:
+  '''Character by character implementation of `compiler.find_closing_bracket`
+
+  Used as reference by the scanner benchmark.
+  '''
+  i = off
+  ln = len(line)
+  nesting = 0
+
+  while i < ln:
+    if line[i] == '$' and i+1 < ln and line[i+1] == '$':
+      i += 2
+      continue
+    if line[i] == '$' and i+1 < ln and line[i+1] == '<':
+      i += 2
+      nesting += 1
+      continue
+    if line[i] == '>':
+      if nesting == 0: return i
+      nesting -= 1
+    i += 1
+  return -1
+
+def legacy_split_macros(line:str) -> list[str]:
+  '''`str.find` based implementation of `compiler.split_macros`
+
+  Used as reference by the scanner benchmark.
+  '''
+  if not '$' in line: return [line]
+
+  segs = []
+  offset = 0
+  txt = ''
+  lenline= len(line)
+
+  while (pos := line.find('$', offset)) != -1:
+    txt += line[offset:pos]
+    offset = pos
+    if pos+1 == lenline: break
+    if line[pos+1] == '$':
+      txt += '$'
+      offset += 2
+      continue
+    if line[pos+1] != '<':
+      txt += line[offset:offset+2]
+      offset += 2
+      continue
+
+    closing = legacy_find_closing_bracket(line, offset+2)
+    if closing == -1: break
+
+    segs.append(txt)
+    segs.append(line[offset+2:closing])
+    txt = ''
+    offset = closing +1
+  segs.append(txt + line[offset:])
+
+  return segs
+
+def gen_macro_lines(count:int, seed:int = 1) -> list[str]:
+  '''Generate macro-dense lines
+
+  :param count: number of lines to generate
+  :param seed: random seed
+  :returns: list of lines
+  '''
+  rnd = random.Random(seed)
+  names = ['SID', 'PUBLIC_DNS_ZONE', 'vhost_fqdn', 'int_domain', 'key_store']
+  lines = []
+  for i in range(count):
+    parts = [f'  key{i}: ']
+    for j in range(rnd.randint(1,6)):
+      k = rnd.random()
+      if k < 0.6:
+        parts.append(f'$<{rnd.choice(names)}>')
+      elif k < 0.8:
+        parts.append(f'$<pwgen:$<{rnd.choice(names)}>_db:SHA512>')
+      elif k < 0.9:
+        parts.append('echo $$HOME')
+      else:
+        parts.append('text')
+      parts.append(rnd.choice(['.', ' ', '-', '/']))
+    lines.append(''.join(parts))
+  return lines
+
+def bench_scanner(args:list[str]) -> None:
+  '''Compare the regex scanner against the legacy scanner
+
+  :param args: command line arguments
+
+  Checks that both implementations produce identical results on the
+  `data` folder and on random fragments, then times both on
+  macro-dense lines.
+  '''
+  cli = ArgumentParser(prog='ypp.bench scanner')
+  cli.add_argument('--lines', help='Number of lines', type=int, default=20000)
+  cli.add_argument('--repeat', help='Timing repetitions', type=int, default=5)
+  opts = cli.parse_args(args)
+
+  datadir = os.path.join(os.path.dirname(__file__), '..', 'data')
+  corpus = []
+  for fname in glob.glob(os.path.join(datadir, '**', '*.yaml'), recursive = True):
+    with open(fname, 'r') as fp:
+      corpus += fp.read().split('\n')
+
+  rnd = random.Random(1)
+  pieces = ['$', '$$', '$<', '<', '>', 'abc', ':', ' ', 'value', '$<VAR>', '$<pwgen:$<x>:SHA512>']
+  fuzz = [''.join(rnd.choice(pieces) for j in range(rnd.randint(1,40))) for i in range(opts.lines)]
+  lines = gen_macro_lines(opts.lines)
+
+  errors = 0
+  for line in corpus + fuzz + lines:
+    if compiler.split_macros(line) != legacy_split_macros(line):
+      errors += 1
+      print(f'Mismatch: {line!r}')
+  print(f'{len(corpus)+len(fuzz)+len(lines)} lines compared, {errors} mismatches')
+
+  for name, func in (('legacy', legacy_split_macros), ('regex', compiler.split_macros)):
+    best = None
+    for i in range(opts.repeat):
+      secs, res = timeit(lambda: [func(line) for line in lines])
+      if best is None or secs < best: best = secs
+    print(f'{name:>10}: {best*1000000/len(lines):.2f} usec/line')
+
+def gen_var_chain(dirname:str, depth:int, refs:int, redefine:int = 0) -> str:
+  '''Generate a YAML document referencing a deep chain of variables
+
+  :param dirname: directory where to create the file
+  :param depth: number of variables in the chain
+  :param refs: number of lines referencing the end of the chain
+  :param redefine: if not zero, re-define the start of the chain every `redefine` lines
+  :returns: file name of the document
+  '''
+  fname = os.path.join(dirname, 'chain.yaml')
+  with open(fname, 'w') as fp:
+    fp.write('#define v0 start\n')
+    for i in range(1, depth):
+      fp.write(f'#define v{i} --defer $<v{i-1}>.{i}\n')
+    for i in range(refs):
+      if redefine and i % redefine == 0: fp.write(f'#define v0 start{i}\n')
+      fp.write(f'key{i}: $<v{depth-1}>\n')
+  return fname
+
+def bench_variables(args:list[str]) -> None:
+  '''Measure variable resolution
+
+  :param args: command line arguments
+
+  Processes a document referencing the end of a deep chain of
+  variables many times.  Optionally the start of the chain is
+  re-defined periodically, invalidating all the resolved values.
+  '''
+  cli = ArgumentParser(prog='ypp.bench variables')
+  cli.add_argument('--depth', help='Length of the variable chain', type=int, default=1000)
+  cli.add_argument('--refs', help='Number of references', type=int, default=100000)
+  cli.add_argument('--redefine', help='Re-define the chain every n lines', type=int, default=10000)
+  opts = cli.parse_args(args)
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    for redefine in (0, opts.redefine):
+      fname = gen_var_chain(tmpdir, opts.depth, opts.refs, redefine)
+      secs, txt = timeit(ypp.YamlPreProcessor().process, fname)
+      label = f'redefine every {redefine}' if redefine else 'no redefines'
+      print(f'{label:>24}: {secs:.3f} seconds, {opts.refs/secs:.0f} refs/sec')
+
+def bench_sshkeys(args:list[str]) -> None:
+  '''Compare on-demand and pre-generated SSH keys
+
+  :param args: command line arguments
+
+  Generates a number of keys one at a time, as the pre-processor
+  does when it first sees a key, and then in parallel using
+  {py:obj}`sshkeys.pregen`.
+  '''
+  cli = ArgumentParser(prog='ypp.bench sshkeys')
+  cli.add_argument('--keys', help='Number of keys', type=int, default=16)
+  cli.add_argument('--bits', help='Key length', type=int, default=2048)
+  cli.add_argument('--jobs', help='Number of processes', type=int, default=None)
+  cli.add_argument('--type', help='Key type', choices=sshkeys.KEY_TYPES, default=sshkeys.RSA)
+  opts = cli.parse_args(args)
+
+  keys = [ (f'host{i}', opts.bits, opts.type) for i in range(opts.keys) ]
+  with tempfile.TemporaryDirectory() as tmpdir:
+    def serial():
+      for key_id, key_sz, key_type in keys:
+        sshkeys.gen(os.path.join(tmpdir, 'serial'), key_id, sshkeys.PUB, key_sz, key_type = key_type)
+    secs, _ = timeit(serial)
+    print(f'{"serial":>10}: {secs:.3f} seconds, {opts.keys/secs:.1f} keys/sec')
+    secs, _ = timeit(sshkeys.pregen, os.path.join(tmpdir, 'pool'), keys, opts.jobs)
+    print(f'{"pool":>10}: {secs:.3f} seconds, {opts.keys/secs:.1f} keys/sec')
+
+def bench_secrets(args:list[str]) -> None:
+  '''Measure generating and looking up many secrets
+
+  :param args: command line arguments
+
+  Compares saving the secrets file after every new secret, as
+  was done before secrets were buffered, against a single flush
+  at the end.  Then compares looking up one secret in a large
+  YAML and indexed secrets file.
+  '''
+  cli = ArgumentParser(prog='ypp.bench secrets')
+  cli.add_argument('--count', help='Number of secrets', type=int, default=10000)
+  cli.add_argument('--legacy', help='Number of secrets when saving every secret', type=int, default=500)
+  cli.add_argument('--lookup', help='Number of secrets in the look-up test', type=int, default=100000)
+  opts = cli.parse_args(args)
+
+  def run(fname, count, every):
+    for i in range(count):
+      pwhash.gen(fname, f'secret{i}')
+      if every: pwhash.flush()
+    pwhash.flush()
+
+  def lookup(fname, name):
+    return pwhash.open_store(fname)[name]
+
+  saved = dict(pwhash.stores)
+  pwhash.stores.clear()
+  try:
+    with tempfile.TemporaryDirectory() as tmpdir, open(os.devnull,'w') as devnull, contextlib.redirect_stdout(devnull):
+      for count, every, ext, label in ((opts.legacy, True, '.yaml', 'flush every'),
+                                       (opts.count, False, '.yaml', 'flush once'),
+                                       (opts.count, False, pwhash.INDEX_EXT, 'indexed')):
+        secs, _ = timeit(run, os.path.join(tmpdir, f'gen-{label}{ext}'), count, every)
+        sys.stderr.write(f'{label:>12}: {count} secrets, {secs:.3f} seconds, {count/secs:.0f} secrets/sec\n')
+
+      store = pwhash.open_store(os.path.join(tmpdir, 'lookup' + pwhash.INDEX_EXT))
+      for i in range(opts.lookup):
+        store[f'secret{i}'] = pwhash.gen_rand()
+      store.flush()
+      pwhash.convert(store.filename, os.path.join(tmpdir, 'lookup.yaml'))
+      for ext in ('.yaml', pwhash.INDEX_EXT):
+        secs, _ = timeit(lookup, os.path.join(tmpdir, 'lookup' + ext), f'secret{opts.lookup//2}')
+        sys.stderr.write(f'{"lookup " + ext:>12}: {opts.lookup} secrets, {secs*1000:.3f} ms\n')
+  finally:
+    pwhash.stores.clear()
+    pwhash.stores.update(saved)
+
+def bench_cash(args:list[str]) -> None:
+  '''Measure bulk password hashing
+
+  :param args: command line arguments
+
+  Hashes `name<TAB>password` records serially and in a process
+  pool using {py:obj}`pwhash.bulk_hash`.
+  '''
+  cli = ArgumentParser(prog='ypp.bench cash')
+  cli.add_argument('--count', help='Number of passwords', type=int, default=2000)
+  cli.add_argument('--algo', help='Hash algorithm', choices=[k.lower() for k in pwhash.HASH_STR], default='sha512')
+  cli.add_argument('--jobs', help='Number of processes', type=int, default=None)
+  opts = cli.parse_args(args)
+
+  records = ''.join(f'user{i}\t{pwhash.gen_rand()}\n' for i in range(opts.count))
+  encode = pwhash.HASH_STR[opts.algo.upper()]
+  for jobs, label in ((1, 'serial'), (opts.jobs, 'pool')):
+    out = io.StringIO()
+    secs, _ = timeit(pwhash.bulk_hash, io.StringIO(records), out, encode, jobs)
+    print(f'{label:>10}: {opts.count} {opts.algo} hashes, {secs:.3f} seconds, {opts.count/secs:.0f} hashes/sec')
+
+def bench_rand(args:list[str]) -> None:
+  '''Measure random string generation
+
+  :param args: command line arguments
+
+  Compares the `random.sample` based generator used previously
+  against {py:obj}`pwhash.iter_rand`.
+  '''
+  cli = ArgumentParser(prog='ypp.bench rand')
+  cli.add_argument('--count', help='Number of strings', type=int, default=1000000)
+  cli.add_argument('--legacy', help='Number of strings for the legacy generator', type=int, default=100000)
+  cli.add_argument('--len', help='String length', type=int, default=pwhash.DEF_PWLEN)
+  opts = cli.parse_args(args)
+
+  def legacy(count, length, charset):
+    return [ ''.join(random.sample(charset*length, length)) for _ in range(count) ]
+  def bulk(count, length, charset):
+    return list(pwhash.iter_rand(count, length, charset))
+
+  for func, count in ((legacy, opts.legacy), (bulk, opts.count)):
+    secs, _ = timeit(func, count, opts.len, pwhash.DEF_CHARSET)
+    print(f'{func.__name__:>10}: {count} strings, {secs:.3f} seconds, {count/secs:.0f} strings/sec')
+
+def legacy_vnc(clear:str) -> str:
+  '''`d3des.encrypt` computing the key schedule on every call
+
+  :param clear: clear text password
+  :returns: encrypted password
+  '''
+  clear = (bytes(clear,encoding='raw_unicode_escape') + b'\x00' * 8)[:8]
+  strkey = b''.join([bytes(chr(x),encoding='raw_unicode_escape') for x in d3des.vnckey])
+  key = d3des.deskey(strkey,False)
+  return d3des.base64.b64encode(d3des.desfunc(clear, key)).decode('ascii')
+
+def bench_vnc(args:list[str]) -> None:
+  '''Measure VNC password encryption
+
+  :param args: command line arguments
+
+  Compares computing the VNC key schedule for every password
+  against the cached schedule, one password at a time and with
+  {py:obj}`d3des.encrypt_many`.
+  '''
+  cli = ArgumentParser(prog='ypp.bench vnc')
+  cli.add_argument('--count', help='Number of passwords', type=int, default=20000)
+  opts = cli.parse_args(args)
+
+  clears = list(pwhash.iter_rand(opts.count, 8))
+  tests = (
+    ('legacy', lambda: [ legacy_vnc(c) for c in clears ]),
+    ('enc_passwd', lambda: [ pwhash.enc_passwd(c, pwhash.VNC) for c in clears ]),
+    ('encrypt_many', lambda: d3des.encrypt_many(clears)),
+  )
+  for label, func in tests:
+    secs, _ = timeit(func)
+    print(f'{label:>12}: {opts.count} passwords, {secs*1e6/opts.count:.2f} us/password')
+
+def bench_exec(args:list[str]) -> None:
+  '''Compare serial and concurrent `#exec` commands
+
+  :param args: command line arguments
+
+  Renders a document with many slow `#exec` commands with
+  `process` and with `aprocess`.
+  '''
+  cli = ArgumentParser(prog='ypp.bench exec')
+  cli.add_argument('--count', help='Number of commands', type=int, default=20)
+  cli.add_argument('--delay', help='Command duration in seconds', type=float, default=0.1)
+  cli.add_argument('--limit', help='Concurrency limit', type=int, default=8)
+  opts = cli.parse_args(args)
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    fname = os.path.join(tmpdir, 'exec.yaml')
+    with open(fname, 'w') as fp:
+      fp.write('cmds:\n')
+      for i in range(opts.count):
+        fp.write(f'#exec sleep {opts.delay}; echo "  - {i}"\n')
+    yppi = ypp.YamlPreProcessor()
+    secs, res1 = timeit(yppi.process, fname)
+    print(f'{"process":>10}: {opts.count} commands, {secs:.3f} seconds')
+    secs, res2 = timeit(lambda: asyncio.run(yppi.aprocess(fname, limit = opts.limit)))
+    print(f'{"aprocess":>10}: {opts.count} commands, {secs:.3f} seconds (limit {opts.limit})')
+    if res1 != res2: print('ERROR: outputs differ')
+
+def import_times(module:str = 'ypp', runs:int = 1) -> dict[str,tuple[int,int]]:
+  '''Measure import times with `python3 -X importtime`
+
+  :param module: module to import
+  :param runs: number of fresh interpreters to run
+  :returns: dictionary mapping module names to the best (self, cumulative)
+            import times in microseconds
+
+  Every run starts a new interpreter, so that nothing is
+  served from `sys.modules`.
+  '''
+  topdir = os.path.abspath(os.path.join(os.path.dirname(__file__),'..'))
+  times = dict()
+  for _ in range(runs):
+    rc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                        cwd = topdir, capture_output = True, text = True, check = True)
+    for line in rc.stderr.splitlines():
+      if not line.startswith('import time:'): continue
+      fields = line[len('import time:'):].split('|')
+      if len(fields) != 3 or not fields[0].strip().isdigit(): continue
+      name = fields[2].strip()
+      usecs = (int(fields[0]), int(fields[1]))
+      if name in times: usecs = min(times[name], usecs, key = lambda t: t[1])
+      times[name] = usecs
+  return times
+
+def bench_imports(args:list[str]) -> None:
+  '''Measure start-up import times
+
+  :param args: command line arguments
+
+  Reports the cumulative import time of `ypp` and its slowest
+  dependencies, and whether any crypto library was imported
+  eagerly.
+  '''
+  cli = ArgumentParser(prog='ypp.bench imports')
+  cli.add_argument('--module', help='Module to import', default='ypp')
+  cli.add_argument('--runs', help='Number of runs (best is reported)', type=int, default=5)
+  cli.add_argument('--top', help='Number of modules to list', type=int, default=10)
+  opts = cli.parse_args(args)
+
+  times = import_times(opts.module, opts.runs)
+  print(f'{opts.module:>24}: {times[opts.module][1]/1000:.1f} ms')
+  for name, (_, cumulative) in sorted(times.items(), key = lambda kv: -kv[1][1])[1:opts.top+1]:
+    print(f'{name:>24}: {cumulative/1000:.1f} ms')
+  eager = [ name for name in ('cryptography', 'passlib', 'concurrent.futures') if name in times ]
+  print(f'{"eager imports":>24}: {", ".join(eager) if eager else "none"}')
+
+def gen_flat(dirname:str, lines:int) -> str:
+  '''Generate a large document without directives
+
+  :param dirname: directory where to create the file
+  :param lines: number of lines to generate
+  :returns: file name of the document
+
+  Half of the lines reference a variable.
+  '''
+  fname = os.path.join(dirname, 'flat.yaml')
+  with open(fname, 'w') as fp:
+    fp.write('#define VALUE value\n')
+    fp.write('flat:\n')
+    for i in range(lines):
+      fp.write(f'  key{i}: $<VALUE> {i}\n' if i % 2 else f'  key{i}: plain text {i}\n')
+  return fname
+
+def gen_deep(dirname:str, lines:int) -> str:
+  '''Generate a document split over a deep chain of `#include` files
+
+  :param dirname: directory where to create the files
+  :param lines: total number of lines to generate
+  :returns: file name of the top-level document
+  '''
+  return gen_nested(dirname, lines, 32)
+
+def gen_macros(dirname:str, lines:int) -> str:
+  '''Generate a document with macro-dense lines
+
+  :param dirname: directory where to create the file
+  :param lines: number of lines to generate
+  :returns: file name of the document
+
+  Uses {py:obj}`gen_macro_lines`, so lines also contain
+  `pwgen` macros with hashed passwords.
+  '''
+  fname = os.path.join(dirname, 'macros.yaml')
+  with open(fname, 'w') as fp:
+    for name in ('SID', 'PUBLIC_DNS_ZONE', 'vhost_fqdn', 'int_domain'):
+      fp.write(f'#define {name} {name.lower()}.example\n')
+    fp.write('macros:\n')
+    for line in gen_macro_lines(lines):
+      fp.write(line + '\n')
+  return fname
+
+def gen_ifdef(dirname:str, lines:int, depth:int = 16) -> str:
+  '''Generate a document with long `#ifdef` chains
+
+  :param dirname: directory where to create the file
+  :param lines: approximate number of lines to generate
+  :param depth: nesting depth of each chain
+  :returns: file name of the document
+
+  Each chain nests `#ifdef`, `#ifndef` and `#else` blocks, so
+  that about half of the lines are suppressed.
+  '''
+  fname = os.path.join(dirname, 'ifdef.yaml')
+  with open(fname, 'w') as fp:
+    fp.write('#define DEF1 yes\nifdef:\n')
+    chain = 0
+    written = 0
+    while written < lines:
+      for level in range(depth):
+        fp.write(f'#ifdef DEF{level % 2}\n' if level % 3 else f'#ifndef UNDEF{level}\n')
+        fp.write(f'  c{chain}_l{level}: $<DEF1>\n')
+      for level in range(depth):
+        fp.write(f'#else\n  c{chain}_e{level}: no\n#endif\n')
+      chain += 1
+      written += depth * 5
+  return fname
+
+def gen_secrets(dirname:str, lines:int) -> str:
+  '''Generate a document referencing many secrets
+
+  :param dirname: directory where to create the file
+  :param lines: number of lines to generate
+  :returns: file name of the document
+
+  Every secret is referenced twice, so half of the references
+  generate a new password and half look up an existing one.
+  '''
+  fname = os.path.join(dirname, 'secrets.yaml')
+  with open(fname, 'w') as fp:
+    fp.write('secrets:\n')
+    for i in range(lines):
+      fp.write(f'  key{i}: $<pwgen:secret{i // 2}>\n')
+  return fname
+
+def gen_exec(dirname:str, lines:int) -> str:
+  '''Generate a document with many `#exec` commands
+
+  :param dirname: directory where to create the file
+  :param lines: number of commands
+  :returns: file name of the document
+
+  Every other command is repeated, so that half of them can be
+  served from the `#exec` result cache.
+  '''
+  fname = os.path.join(dirname, 'exec.yaml')
+  with open(fname, 'w') as fp:
+    fp.write('exec:\n')
+    for i in range(lines):
+      fp.write(f'  cmd{i}:\n')
+      # Commands i and i + 1 (i even) are identical
+      fp.write(f'#exec echo "    - {i // 2}"\n')
+  return fname
+
+WORKLOADS = {
+  'flat': (gen_flat, 200000),
+  'deep': (gen_deep, 100000),
+  'macros': (gen_macros, 20000),
+  'ifdef': (gen_ifdef, 100000),
+  'secrets': (gen_secrets, 20000),
+  'exec': (gen_exec, 200),
+}
+'''Workloads used by the `suite` benchmark: generator and default size'''
+
+def run_workload(name:str, size:int, repeat:int = 3) -> dict[str,float]:
+  '''Render a synthetic document and measure it
+
+  :param name: workload name, one of `WORKLOADS`
+  :param size: size passed to the generator
+  :param repeat: number of timed renders, the best is reported
+  :returns: dict with the measurements
+
+  Every render uses a new pre-processor with its own secrets file
+  and key store, and starts with empty template and `#exec` caches,
+  so runs do not affect each other.
+  '''
+  gen, _ = WORKLOADS[name]
+  saved = dict(pwhash.stores)
+  try:
+    with tempfile.TemporaryDirectory() as tmpdir, open(os.devnull,'w') as devnull, contextlib.redirect_stdout(devnull):
+      fname = gen(tmpdir, size)
+      def render(run):
+        pwhash.stores.clear()
+        defs = [ f'secrets_file={os.path.join(tmpdir, f"secrets{run}.yaml")}',
+                 f'key_store={os.path.join(tmpdir, "keys")}' ]
+        return ypp.YamlPreProcessor(define = defs, env_prefix = None).process(fname)
+      best = None
+      for run in range(repeat):
+        compiler.cache.clear()
+        extcmd.cache.clear()
+        secs, txt = timeit(render, run)
+        if best is None or secs < best: best = secs
+      compiler.cache.clear()
+      extcmd.cache.clear()
+      peak = peak_memory(render, repeat)
+  finally:
+    pwhash.stores.clear()
+    pwhash.stores.update(saved)
+  lines = txt.count('\n')
+  size = len(txt.encode())
+  return {
+    'size': size,
+    'lines': lines,
+    'seconds': best,
+    'lines_per_sec': lines / best,
+    'mb_per_sec': size / best / 1e6,
+    'peak_kib': peak / 1024,
+  }
+
+def compare_runs(base:dict, run:dict, threshold:float = 0.1) -> list[str]:
+  '''Compare two `suite` runs
+
+  :param base: reference results as saved by `suite`
+  :param run: new results
+  :param threshold: relative change considered a regression
+  :returns: list of workloads that regressed
+
+  Prints the relative change of throughput and peak memory for
+  every workload present in both runs.
+  '''
+  regressions = []
+  print(f'{"workload":>10} {"lines/sec":>12} {"change":>8} {"peak KiB":>10} {"change":>8}')
+  for name, new in run['results'].items():
+    old = base['results'].get(name)
+    if old is None: continue
+    speed = new['lines_per_sec'] / old['lines_per_sec'] - 1
+    memory = new['peak_kib'] / old['peak_kib'] - 1
+    flag = ''
+    if speed < -threshold or memory > threshold:
+      flag = '  REGRESSION'
+      regressions.append(name)
+    print(f'{name:>10} {new["lines_per_sec"]:>12.0f} {speed:>+8.1%} {new["peak_kib"]:>10.0f} {memory:>+8.1%}{flag}')
+  return regressions
+
+def bench_suite(args:list[str]) -> None:
+  '''Run all workloads
+
+  :param args: command line arguments
+
+  Reports lines/sec, MB/s of output and peak memory of
+  `YamlPreProcessor.process` for each of the `WORKLOADS`.
+  Exits with status 1 if `--compare` finds regressions.
+  '''
+  cli = ArgumentParser(prog='ypp.bench suite')
+  cli.add_argument('--scale', help='Multiply workload sizes', type=float, default=1.0)
+  cli.add_argument('--repeat', help='Timing repetitions', type=int, default=3)
+  cli.add_argument('--only', help='Run only the given workload', action='append', choices=list(WORKLOADS), default=None)
+  cli.add_argument('--save', help='Save results as JSON', default=None)
+  cli.add_argument('--compare', help='Compare against results saved with --save', default=None)
+  cli.add_argument('--threshold', help='Relative change considered a regression', type=float, default=0.1)
+  opts = cli.parse_args(args)
+
+  run = {
+    'version': ypp.VERSION,
+    'python': platform.python_version(),
+    'scale': opts.scale,
+    'results': {},
+  }
+  print(f'{"workload":>10} {"lines":>9} {"seconds":>9} {"lines/sec":>12} {"MB/s":>8} {"peak KiB":>10}')
+  for name in opts.only or WORKLOADS:
+    res = run_workload(name, max(1, int(WORKLOADS[name][1] * opts.scale)), opts.repeat)
+    run['results'][name] = res
+    print(f'{name:>10} {res["lines"]:>9} {res["seconds"]:>9.3f} {res["lines_per_sec"]:>12.0f} {res["mb_per_sec"]:>8.2f} {res["peak_kib"]:>10.0f}')
+
+  if opts.save:
+    with open(opts.save, 'w') as fp:
+      json.dump(run, fp, indent = 2)
+  if opts.compare:
+    with open(opts.compare, 'r') as fp:
+      base = json.load(fp)
+    print()
+    if compare_runs(base, run, opts.threshold): sys.exit(1)
+
+def bench_compare(args:list[str]) -> None:
+  '''Compare two saved `suite` runs
+
+  :param args: command line arguments
+
+  Exits with status 1 if there are regressions.
+  '''
+  cli = ArgumentParser(prog='ypp.bench compare')
+  cli.add_argument('base', help='Reference results')
+  cli.add_argument('run', help='New results')
+  cli.add_argument('--threshold', help='Relative change considered a regression', type=float, default=0.1)
+  opts = cli.parse_args(args)
+
+  with open(opts.base, 'r') as fp:
+    base = json.load(fp)
+  with open(opts.run, 'r') as fp:
+    run = json.load(fp)
+  if compare_runs(base, run, opts.threshold): sys.exit(1)
+
+def gen_hosts(dirname:str, hosts:int) -> str:
+  '''Generate a document with many copies of `data/ts-v2.yaml`
+
+  :param dirname: directory where to create the file
+  :param hosts: number of copies
+  :returns: file name of the document
+
+  Each copy is nested under its own key, including its
+  pre-processor directives.  The `data/snippets` directory must
+  be in the include path.
+  '''
+  with open(os.path.join(DATA_DIR, 'ts-v2.yaml'), 'r') as fp:
+    body = ''.join('    ' + line if line.strip() else line for line in fp)
+  fname = os.path.join(dirname, 'hosts.yaml')
+  with open(fname, 'w') as fp:
+    fp.write('hosts:\n')
+    for i in range(hosts):
+      fp.write(f'  host{i}:\n')
+      fp.write(body)
+  return fname
+
+def bench_yaml(args:list[str]) -> None:
+  '''Compare ways of loading pre-processed YAML
+
+  :param args: command line arguments
+
+  Loads a document made of `--hosts` copies of `data/ts-v2.yaml`:
+
+  - `text`: pre-process to a string, then `yaml.safe_load`
+  - `stream`: parse the output while it is produced, pure Python loader
+  - `libyaml`: parse the output while it is produced with `ypp.SafeLoader`
+
+`ypp.yaml_source` picks `libyaml` when available and `text` otherwise.
+
+  Pre-processing is included in the timings.
+  '''
+  cli = ArgumentParser(prog='ypp.bench yaml')
+  cli.add_argument('--hosts', help='Number of copies of data/ts-v2.yaml', type=int, default=1000)
+  cli.add_argument('--memory', help='Also measure peak memory (slow)', action='store_true')
+  opts = cli.parse_args(args)
+
+  def load_text(yppi, fname):
+    return yaml.safe_load(yppi.process(fname))
+  def load_stream(yppi, fname, loader = yaml.SafeLoader):
+    with yppi.reader(fname) as fp:
+      return yaml.load(fp, Loader = loader)
+  def load_libyaml(yppi, fname):
+    return load_stream(yppi, fname, ypp.SafeLoader)
+  methods = { 'text': load_text, 'stream': load_stream }
+  if ypp.SafeLoader is not yaml.SafeLoader: methods['libyaml'] = load_libyaml
+
+  saved = dict(pwhash.stores)
+  try:
+    with tempfile.TemporaryDirectory() as tmpdir, open(os.devnull,'w') as devnull, contextlib.redirect_stdout(devnull):
+      fname = gen_hosts(tmpdir, opts.hosts)
+      defs = [ 'SID=bench',
+               f'secrets_file={os.path.join(tmpdir, "secrets.yaml")}',
+               f'key_store={os.path.join(tmpdir, "keys")}' ]
+      new_yppi = lambda: ypp.YamlPreProcessor(include = [os.path.join(DATA_DIR, 'snippets')], define = defs, env_prefix = None)
+      # Warm up: compile templates and generate secrets
+      new_yppi().process(fname)
+      results = {}
+      for name, method in methods.items():
+        secs, res = timeit(method, new_yppi(), fname)
+        peak = peak_memory(method, new_yppi(), fname) if opts.memory else 0
+        results[name] = (secs, peak, res)
+  finally:
+    pwhash.stores.clear()
+    pwhash.stores.update(saved)
+
+  base = results['text'][0]
+  print(f'{"method":>8} {"seconds":>9} {"speedup":>8} {"peak KiB":>10}')
+  for name, (secs, peak, res) in results.items():
+    assert res == results['text'][2]
+    print(f'{name:>8} {secs:>9.3f} {base/secs:>7.2f}x {f"{peak/1024:.0f}" if opts.memory else "-":>10}')
+
+BENCHMARKS = {
+  'linear': bench_linear,
+  'stream': bench_stream,
+  'includes': bench_includes,
+  'scanner': bench_scanner,
+  'variables': bench_variables,
+  'sshkeys': bench_sshkeys,
+  'secrets': bench_secrets,
+  'cash': bench_cash,
+  'rand': bench_rand,
+  'vnc': bench_vnc,
+  'imports': bench_imports,
+  'exec': bench_exec,
+  'yaml': bench_yaml,
+  'suite': bench_suite,
+  'compare': bench_compare,
+}
+'''Available benchmarks'''
+
+def main(argv:list[str]) -> None:
+  '''Run benchmarks
+
+  :param argv: command line arguments
+  '''
+  if len(argv) == 0 or not argv[0] in BENCHMARKS:
+    sys.stderr.write('Usage: python3 -m ypp.bench {' + ','.join(BENCHMARKS) + '} [options]\n')
+    sys.exit(1)
+  BENCHMARKS[argv[0]](argv[1:])
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+'''Template compiler
+
+Turns pre-processor source text into a list of pre-tokenized
+operations.  Compiled files are cached in memory so that files
+included multiple times (or processed by repeated `process` calls)
+only need to run variable expansion.
+
+Each operation is a tuple whose first element is the operation code:
+
+- `(LITERAL, line)` : line without directives or macro references
+- `(MACRO, segments)` : line with macro references
+- `(DIRECTIVE, token, args, args_segments, in_prefix, line_segments)` :
+  pre-processor directive.  `line_segments` are used if `token`
+  turns out not to be a registered directive.
+- `(IFDEF, args)`, `(IFNDEF, args)`, `(ELSE, args)`, `(ENDIF, args)` :
+  conditionals
+
+Segments are lists as returned by {py:obj}`compiler.split_macros`.
+
+Optionally, compiled files can also be stored in an on-disk cache
+directory (similar to `__pycache__`) so that they can be re-used
+by separate program runs.  See {py:obj}`compiler.set_cache`.
+'''
+import hashlib
+import io
+import marshal
+import os
+import re
+import sys
+import tempfile
+import typing
+
+from ipp import MK
+from version import VERSION
+
+LITERAL = 0
+'''Plain text line'''
+MACRO = 1
+'''Line containing macro references'''
+DIRECTIVE = 2
+'''Pre-processor directive'''
+IFDEF = 3
+'''`#ifdef` conditional'''
+IFNDEF = 4
+'''`#ifndef` conditional'''
+ELSE = 5
+'''`#else` conditional'''
+ENDIF = 6
+'''`#endif` conditional'''
+
+CONDITIONALS = {
+  'ifdef': IFDEF,
+  'ifndef': IFNDEF,
+  'else': ELSE,
+  'endif': ENDIF,
+}
+'''Conditional directives'''
+
+RE_PP_DIRECTIVE = re.compile(r'^(\s*)#\s*([a-z]+)\s*')
+''' Regular expression to get pre-processor directives '''
+RE_PP_DIRECTIVE_ALT = re.compile(r'^(\s*-\s*)#\s*([a-z]+)\s*')
+''' Regular expression to get alternative pre-processor directives '''
+
+MAX_CACHE_SIZE = 4 * 1024 * 1024
+'''Files larger than this are compiled on-the-fly and not cached'''
+
+DISK_CACHE_SIZE = 64 * 1024 * 1024
+'''Default size limit of the on-disk cache'''
+DISK_CACHE_EXT = '.ops'
+'''File extension used for on-disk cache entries'''
+
+cache = {}
+'''dict storing compiled files.  Keyed by absolute path, contains tuple(mtime, size, ops)'''
+cache_enabled = True
+'''If `False`, compiled files are never cached'''
+cache_dir = None
+'''Directory used for the on-disk cache.  `None` disables the on-disk cache'''
+cache_dir_size = DISK_CACHE_SIZE
+'''Size limit of the on-disk cache'''
+
+def set_cache(enabled:bool = True, directory:str|None = None, max_size:int = DISK_CACHE_SIZE) -> None:
+  '''Configure compiled template caching
+
+  :param enabled: If `False` compiled files are neither cached in memory nor on-disk.
+  :param directory: Directory for the on-disk cache.  `None` disables the on-disk cache.
+  :param max_size: Size limit of the on-disk cache in bytes.  When exceeded,
+    least recently used entries are removed.
+
+  The in-memory cache is only cleared when the settings change, so
+  long running processes can re-apply the same settings for every
+  request.
+  '''
+  global cache_enabled, cache_dir, cache_dir_size
+  directory = directory if enabled else None
+  if (enabled, directory, max_size) == (cache_enabled, cache_dir, cache_dir_size): return
+  cache_enabled = enabled
+  cache_dir = directory
+  cache_dir_size = max_size
+  cache.clear()
+
+def parse_line(line:str) -> tuple[str,str,str]:
+  '''Parse pre-processor directives
+
+  :param line: text to parse
+  :returns: tuple(token, args, prefix)
+
+  ```python
+  >>> parse_line(' - #include  sslh.yaml ')
+  ('include', 'sslh.yaml', ' - ')
+  >>> parse_line('key: value')
+  ('', '', '')
+
+  ```
+  '''
+  if not '#' in line: return '','',''
+  mv = RE_PP_DIRECTIVE.match(line)
+  if mv:
+    return mv.group(2), line[mv.end():].strip(), mv.group(1)
+  mv = RE_PP_DIRECTIVE_ALT.match(line)
+  if mv:
+    return mv.group(2), line[mv.end():].strip(), mv.group(1)
+  return '','',''
+
+RE_MACRO_REFS = re.compile('{opening}([^{signal}{close}]*(?:{opening}[^{signal}{close}]*{close}[^{signal}{close}]*)*){close}'.format(
+                    opening = re.escape(MK.SIGNAL + MK.OPEN),
+                    signal = re.escape(MK.SIGNAL),
+                    close = re.escape(MK.CLOSE)))
+'''Regular expression matching simple macro references
+
+Matches references with at most one level of nesting and no `$`
+characters other than in nested references.  Used to split lines
+without `$$` escapes using `re.split`.
+'''
+RE_MACRO_TOKENS = re.compile('{signal}(?:({signal})|{open}([^{signal}{close}]*(?:(?:{escape}|{opening}[^{signal}{close}]*{close})[^{signal}{close}]*)*){close}|({open}))|({close})'.format(
+                    escape = re.escape(MK.SIGNAL + MK.SIGNAL),
+                    opening = re.escape(MK.SIGNAL + MK.OPEN),
+                    signal = re.escape(MK.SIGNAL),
+                    open = re.escape(MK.OPEN),
+                    close = re.escape(MK.CLOSE)))
+'''Regular expression matching macro tokens
+
+Groups:
+
+1. `$$` escapes
+2. contents of simple macro references (with at most one level of
+   nesting and no `$` characters other than `$$` escapes or in
+   nested references)
+3. macro reference openings
+4. macro reference closings
+'''
+ESCAPE = MK.SIGNAL + MK.SIGNAL
+'''Escaped macro character'''
+OPENING = MK.SIGNAL + MK.OPEN
+'''Macro reference opening'''
+T_ESCAPE = 1
+'''Token group for `$$` escapes'''
+T_SIMPLE = 2
+'''Token group for simple macro references'''
+T_OPEN = 3
+'''Token group for macro reference openings'''
+T_CLOSE = 4
+'''Token group for macro reference closings'''
+
+def find_closing_bracket(line:str, off:int) -> int:
+  '''Find closing bracket
+
+  :param str line: string to scan
+  :param int off: offset in string
+  :returns int: returns the index to the closing bracket or -1 if not found
+
+  Used to find the closing bracket for a `$(macro reference)`.  It
+  will handle `$$` escapes and nested macro references.
+
+  ```python
+  >>> find_closing_bracket('$<a:$<b>$$>>', 2)
+  10
+  >>> find_closing_bracket('$<a', 2)
+  -1
+
+  ```
+  '''
+  nesting = 0
+  for mv in RE_MACRO_TOKENS.finditer(line, off):
+    tok = mv.lastindex
+    if tok == T_OPEN:
+      nesting += 1
+    elif tok == T_CLOSE:
+      if nesting == 0: return mv.start()
+      nesting -= 1
+  return -1
+
+def split_macros(line:str) -> list[str]:
+  '''Split a line into literal text and macro references
+
+  :param line: text to split
+  :returns: list of segments
+
+  Segments at even positions are literal text (with `$$` escapes
+  already resolved) and segments at odd positions are the contents
+  of top-level `$<...>` references.  The list always has an odd
+  length.
+
+  Lines without `$$` escapes are split with `RE_MACRO_REFS`.  Otherwise
+  (or if the line contains deeply nested or unclosed references) the line
+  is scanned once with `RE_MACRO_TOKENS`, where simple references are
+  matched as a single token.  Nested references are kept as part of the
+  reference text, as they are expanded together with the arguments
+  of the referencing macro.
+
+  ```python
+  >>> split_macros('plain text')
+  ['plain text']
+  >>> split_macros('x$<ABC>: $$5 $<a:$<b>>')
+  ['x', 'ABC', ': $5 ', 'a:$<b>', '']
+  >>> split_macros('unclosed $$ $<ref $$')
+  ['unclosed $ $<ref $$']
+  >>> split_macros('$x>$')
+  ['$x>$']
+  >>> split_macros('a $<b $<c>')
+  ['a $<b $<c>']
+
+  ```
+  '''
+  if not MK.SIGNAL in line: return [line]
+
+  if not ESCAPE in line:
+    # Fast path: split in one go and check that no unmatched
+    # references were left in the literal text.
+    segs = RE_MACRO_REFS.split(line)
+    for txt in segs[0::2]:
+      if OPENING in txt: break
+    else:
+      return segs
+
+  segs = []
+  txt = []
+  offset = 0
+  nesting = 0
+
+  for mv in RE_MACRO_TOKENS.finditer(line):
+    tok = mv.lastindex
+    if nesting == 0:
+      if tok == T_SIMPLE:
+        txt.append(line[offset:mv.start()])
+        segs.append(''.join(txt))
+        segs.append(mv.group(T_SIMPLE))
+        txt = []
+        offset = mv.end()
+      elif tok == T_ESCAPE:
+        txt.append(line[offset:mv.start()])
+        txt.append(MK.SIGNAL)
+        offset = mv.end()
+      elif tok == T_OPEN:
+        txt.append(line[offset:mv.start()])
+        offset = mv.start()
+        nesting = 1
+      # Top-level closing characters are just text
+    elif tok == T_OPEN:
+      nesting += 1
+    elif tok == T_CLOSE:
+      nesting -= 1
+      if nesting == 0:
+        segs.append(''.join(txt))
+        segs.append(line[offset+2:mv.start()])
+        txt = []
+        offset = mv.end()
+  # Unclosed references are left verbatim
+  txt.append(line[offset:])
+  segs.append(''.join(txt))
+
+  return segs
+
+def compile_line(line:str) -> tuple:
+  '''Compile a single line
+
+  :param line: line to compile (without line terminators)
+  :returns: operation tuple
+
+  ```python
+  >>> compile_line('a: b')
+  (0, 'a: b')
+  >>> compile_line('a: $<b>')
+  (1, ['a: ', 'b', ''])
+  >>> compile_line('#ifdef ABC')
+  (3, 'ABC')
+  >>> compile_line('  #include $<x>.yaml')
+  (2, 'include', '$<x>.yaml', ['', 'x', '.yaml'], '  ', ['  #include ', 'x', '.yaml'])
+
+  ```
+  '''
+  token, args, in_prefix = parse_line(line)
+  if token in CONDITIONALS: return (CONDITIONALS[token], args)
+  if token: return (DIRECTIVE, token, args, split_macros(args), in_prefix, split_macros(line))
+  if MK.SIGNAL in line: return (MACRO, split_macros(line))
+  return (LITERAL, line)
+
+def compile_stream(fp:typing.TextIO) -> typing.Iterator[tuple]:
+  '''Compile lines from a file pointer
+
+  :param fp: file pointer as returned by `open`
+  :returns: iterator yielding operation tuples
+  '''
+  for line in fp:
+    if line.endswith("\n"): line = line[:-1]
+    if line.endswith("\r"): line = line[:-1]
+    yield compile_line(line)
+
+def compile_large_file(filename:str) -> typing.Iterator[tuple]:
+  '''Compile a file on-the-fly
+
+  :param filename: file to compile
+  :returns: iterator yielding operation tuples
+  '''
+  with open(filename, 'r') as fp:
+    yield from compile_stream(fp)
+
+def disk_cache_key(data:bytes) -> str:
+  '''Compute the on-disk cache key for the given file contents
+
+  :param data: file contents
+  :returns: cache key
+
+  Keys depend on the file contents, the library version and the
+  Python implementation (as the `marshal` format is not portable).
+  '''
+  hasher = hashlib.sha256()
+  hasher.update(f'{VERSION}:{sys.implementation.cache_tag}:'.encode())
+  hasher.update(data)
+  return hasher.hexdigest()
+
+def disk_cache_load(key:str) -> list[tuple]|None:
+  '''Load compiled operations from the on-disk cache
+
+  :param key: cache key
+  :returns: operations or `None` if not found
+  '''
+  fname = os.path.join(cache_dir, key + DISK_CACHE_EXT)
+  try:
+    with open(fname, 'rb') as fp:
+      ops = marshal.load(fp)
+    os.utime(fname) # Keep track of recently used entries
+  except (OSError, EOFError, ValueError, TypeError):
+    return None
+  return ops
+
+def disk_cache_save(key:str, ops:list[tuple]) -> None:
+  '''Save compiled operations to the on-disk cache
+
+  :param key: cache key
+  :param ops: operations to save
+
+  Entries are written to a temporary file which is then renamed,
+  so concurrent runs never see partially written entries.
+  '''
+  try:
+    os.makedirs(cache_dir, exist_ok = True)
+    fd, tmpname = tempfile.mkstemp(dir = cache_dir, suffix = '.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as fp:
+        marshal.dump(ops, fp)
+      os.replace(tmpname, os.path.join(cache_dir, key + DISK_CACHE_EXT))
+    except Exception:
+      os.unlink(tmpname)
+      raise
+  except OSError as e:
+    sys.stderr.write(f'Unable to write cache: {e}\n')
+    return
+  disk_cache_evict()
+
+def disk_cache_evict() -> None:
+  '''Remove least recently used on-disk cache entries
+
+  Entries are removed (oldest first) until the total size is
+  below the configured limit.
+  '''
+  entries = []
+  total = 0
+  with os.scandir(cache_dir) as it:
+    for entry in it:
+      if not entry.name.endswith(DISK_CACHE_EXT): continue
+      try:
+        st = entry.stat()
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, entry.path))
+      total += st.st_size
+  if total <= cache_dir_size: return
+
+  entries.sort()
+  for mtime, size, path in entries:
+    try:
+      os.unlink(path)
+    except OSError:
+      continue
+    total -= size
+    if total <= cache_dir_size: break
+
+def compile_data(filename:str) -> list[tuple]:
+  '''Compile a file using the on-disk cache
+
+  :param filename: file to compile
+  :returns: operations
+  '''
+  with open(filename, 'rb') as fp:
+    data = fp.read()
+  key = disk_cache_key(data)
+  ops = disk_cache_load(key)
+  if ops is None:
+    # Decode the same way `open(filename, 'r')` would
+    ops = list(compile_stream(io.TextIOWrapper(io.BytesIO(data))))
+    disk_cache_save(key, ops)
+  return ops
+
+def compile_file(filename:str) -> typing.Iterable[tuple]:
+  '''Compile a file
+
+  :param filename: file to compile
+  :returns: operations
+  :raises FileNotFoundError: if `filename` does not exist
+
+  Compiled operations are cached and re-used as long as the
+  file's modification time and size have not changed.  Files
+  larger than `MAX_CACHE_SIZE` are compiled on-the-fly while
+  being read.
+
+  If an on-disk cache directory is configured, compiled files
+  are also looked up and saved there, keyed by file contents.
+
+  The in-memory cache is keyed by absolute path, as relative paths
+  name different files when the working directory changes (as in
+  daemon requests).
+  '''
+  st = os.stat(filename)
+  if not cache_enabled or st.st_size > MAX_CACHE_SIZE: return compile_large_file(filename)
+
+  key = os.path.abspath(filename)
+  if key in cache:
+    mtime, size, ops = cache[key]
+    if mtime == st.st_mtime_ns and size == st.st_size: return ops
+
+  if cache_dir is None:
+    with open(filename, 'r') as fp:
+      ops = list(compile_stream(fp))
+  else:
+    ops = compile_data(filename)
+  cache[key] = (st.st_mtime_ns, st.st_size, ops)
+  return ops
+
+def defines(ops:typing.Iterable[tuple], name:str) -> bool:
+  '''Check if compiled operations define a variable
+
+  :param ops: operations from `compile_file`
+  :param name: variable to look for
+  :returns: `True` if a `#define` or `#default` directive sets `name`
+
+  Conditionals are ignored, so the variable may not actually be
+  set when the file is pre-processed.
+
+  ```python
+  >>> defines(compile_stream(['#ifdef X\\n', '#define key_store /tmp\\n', '#endif\\n']), 'key_store')
+  True
+  >>> defines(compile_stream(['#define key_stores /tmp\\n']), 'key_store')
+  False
+
+  ```
+  '''
+  for op in ops:
+    if op[0] == DIRECTIVE and op[1] in ('define', 'default') and op[2].split(maxsplit = 1)[:1] == [name]:
+      return True
+  return False
+
+if __name__ == '__main__':
+  import doctest
+  import sys
+
+  failures, tests = doctest.testmod()
+  if failures > 0: sys.exit(1)
@@ -7,7 +7,8 @@ from [d3des.py](https://github.com/matthayes/vnc2flv/blob/master/vnc2flv/d3des.p
 
 ## Public Interface
 
-The only public interface function is {py:obj}`ypp.d3des.encrypt`.
+The public interface functions are {py:obj}`ypp.d3des.encrypt`
+and {py:obj}`ypp.d3des.encrypt_many`.
 
 
 ## d3des.py - DES implementation
@@ -44,6 +45,8 @@ Copyright (c) 1988,1989,1990,1991,1992 by Richard Outerbridge.
 '''
 
 
+import functools
+
 from struct import pack, unpack
 
 
@@ -61,8 +64,18 @@ bytebit = [ 0o1, 0o2, 0o4, 0o10, 0o20, 0o40, 0o100, 0o200 ] # VNC version
 
 # two password functions for VNC protocol.
 def decrypt_passwd(data):
-    dk = deskey(pack('8B', *vnckey), True)
-    return desfunc(data, dk)
+    return desfunc(data, vnc_keys(True))
+
+@functools.lru_cache(maxsize=2)
+def vnc_keys(decrypt = False):
+    '''Key schedule for the constant VNC key
+
+    :param bool decrypt: return the decryption schedule
+    :returns list: key schedule as returned by `deskey`
+
+    The schedule is computed on first use and cached.
+    '''
+    return deskey(pack('8B', *vnckey), decrypt)
 
 def generate_response(passwd, challange):
     ek = deskey((passwd.encode()+b'\x00'*8)[:8], False)
@@ -332,30 +345,32 @@ def desfunc(block, keys):
     right ^= work
     leftt = ((leftt << 1) | ((leftt >> 31) & 1)) & 0xffffffff
 
+    # Local names are faster than globals in the inner loop
+    sp1, sp2, sp3, sp4, sp5, sp6, sp7, sp8 = SP1, SP2, SP3, SP4, SP5, SP6, SP7, SP8
     for i in range(0, 32, 4):
         work  = (right << 28) | (right >> 4)
         work ^= keys[i]
-        fval  = SP7[ work            & 0x3f]
-        fval |= SP5[(work >>  8) & 0x3f]
-        fval |= SP3[(work >> 16) & 0x3f]
-        fval |= SP1[(work >> 24) & 0x3f]
+        fval  = sp7[ work            & 0x3f]
+        fval |= sp5[(work >>  8) & 0x3f]
+        fval |= sp3[(work >> 16) & 0x3f]
+        fval |= sp1[(work >> 24) & 0x3f]
         work  = right ^ keys[i+1]
-        fval |= SP8[ work            & 0x3f]
-        fval |= SP6[(work >>  8) & 0x3f]
-        fval |= SP4[(work >> 16) & 0x3f]
-        fval |= SP2[(work >> 24) & 0x3f]
+        fval |= sp8[ work            & 0x3f]
+        fval |= sp6[(work >>  8) & 0x3f]
+        fval |= sp4[(work >> 16) & 0x3f]
+        fval |= sp2[(work >> 24) & 0x3f]
         leftt ^= fval
         work  = (leftt << 28) | (leftt >> 4)
         work ^= keys[i+2]
-        fval  = SP7[ work            & 0x3f]
-        fval |= SP5[(work >>  8) & 0x3f]
-        fval |= SP3[(work >> 16) & 0x3f]
-        fval |= SP1[(work >> 24) & 0x3f]
+        fval  = sp7[ work            & 0x3f]
+        fval |= sp5[(work >>  8) & 0x3f]
+        fval |= sp3[(work >> 16) & 0x3f]
+        fval |= sp1[(work >> 24) & 0x3f]
         work  = leftt ^ keys[i+3]
-        fval |= SP8[ work            & 0x3f]
-        fval |= SP6[(work >>  8) & 0x3f]
-        fval |= SP4[(work >> 16) & 0x3f]
-        fval |= SP2[(work >> 24) & 0x3f]
+        fval |= sp8[ work            & 0x3f]
+        fval |= sp6[(work >>  8) & 0x3f]
+        fval |= sp4[(work >> 16) & 0x3f]
+        fval |= sp2[(work >> 24) & 0x3f]
         right ^= fval
 
     right = (right << 31) | (right >> 1)
@@ -405,12 +420,32 @@ def encrypt(clear):
   ```
   '''
   clear = (bytes(clear,encoding='raw_unicode_escape') + b'\x00' * 8)[:8]
-  strkey = b''.join([bytes(chr(x),encoding='raw_unicode_escape') for x in vnckey])
-  key = deskey(strkey,False)
-  crypted = desfunc(clear, key)
+  crypted = desfunc(clear, vnc_keys())
   b64 = base64.b64encode(crypted).decode('ascii')
   return b64
 
+def encrypt_many(clears):
+  '''
+  VNC compatible encryption of many passwords
+
+  :params iterable clears: clear text passwords
+  :returns list: encrypted passwords
+
+  Same as `encrypt` for every password in `clears`.
+
+  :Examples:
+  ```python
+  >>> encrypt_many(['zahT9aib', 'Quiali1i'])
+  ['7MjSEypOX1U=', '3hxs4eyguyQ=']
+
+  ```
+  '''
+  keys = vnc_keys()
+  pad = b'\x00' * 8
+  b64encode = base64.b64encode
+  return [ b64encode(desfunc((bytes(clear,encoding='raw_unicode_escape') + pad)[:8], keys)).decode('ascii')
+           for clear in clears ]
+
 # test
 if __name__ == '__main__':
   import doctest
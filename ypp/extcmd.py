@@ -1,42 +1,602 @@
 #!/usr/bin/env python3
 '''External command executor
+
+Commands run by `#exec` either synchronously with `cb_exec`, or, when
+rendering with {py:obj}`pproc.YamlPreProcessor.aprocess`, concurrently
+with `cb_aexec`.  `asyncio` is only imported when it is used.
+
+Results of successful commands are cached, keyed by the command,
+the directory it runs in and the environment variables listed in
+`cache_env`.  By default results are only re-used while rendering
+the same document.  With a TTL, results are kept for that many
+seconds and, if a cache directory is configured, saved there to be
+re-used by later runs.  See `set_exec_cache`.
+
+Options may be given before the command:
+
+- `#exec --nocache cmd` : always run `cmd`, do not cache its result
+- `#exec --timeout=5 cmd` : kill `cmd` if it runs for more than 5 seconds
+- `#exec --max-bytes=1M cmd` : stop reading output after 1MiB and
+  kill `cmd`.  Sizes may use the `K`, `M` and `G` suffixes.
+
+Output is streamed line by line into the document.  Every command
+run is recorded in the pre-processor's `exec_stats` list as an
+`ExecStat`.
 '''
+import codecs
+import hashlib
+import io
+import json
+import locale
 import os
+import re
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
 
 import ipp
 
-def cb_exec(yppi:ipp.iYamlPreProcessor, args:str, prefix:str = '') -> str:
-  '''Handler for external commands
-  
-  :param yppi: Yaml Pre-Processor instance
+DEF_CONCURRENCY = 8
+'''Default number of commands run at the same time by `aprocess`'''
+DEF_CACHE_ENV = ('PATH', 'HOME')
+'''Default environment variables that are part of the cache key'''
+DISK_CACHE_EXT = '.exec'
+'''File extension used for on-disk cache entries'''
+OPTIONS = ('nocache', 'timeout', 'max-bytes')
+'''Options accepted before the command'''
+RE_OPTION = re.compile(r'^\s*--([a-z][-a-z]*)(?:=(\S*))?\s+')
+'''Regular expression matching an option before the command'''
+SIZE_SUFFIXES = { 'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024 }
+'''Multipliers for size suffixes'''
+CACHE_MAX_BYTES = 1024 * 1024
+'''Commands with more output are streamed but their result is not cached'''
+READ_SIZE = 65536
+'''Bytes of command output read at a time'''
+
+cache = {}
+'''dict storing command results.  Keyed by `cache_key`, contains
+tuple(expires, stdout, stderr).  `expires` is `None` for results
+only kept while rendering the current document'''
+cache_enabled = True
+'''If `False`, commands are always run'''
+cache_ttl = None
+'''Seconds results are re-used.  `None` re-uses results only within a document'''
+cache_dir = None
+'''Directory used for the on-disk cache.  `None` disables the on-disk cache'''
+cache_env = DEF_CACHE_ENV
+'''Environment variables that are part of the cache key'''
+
+def set_exec_cache(enabled:bool = True, ttl:float|None = None, directory:str|None = None,
+                   env:typing.Iterable[str] = DEF_CACHE_ENV) -> None:
+  '''Configure the `#exec` result cache
+
+  :param enabled: If `False` commands are always run.
+  :param ttl: Seconds results are re-used.  `None` only re-uses results
+    while rendering the same document.
+  :param directory: Directory for the on-disk cache.  Only used if a `ttl`
+    is given.  `None` disables the on-disk cache.
+  :param env: Environment variables that are part of the cache key
+
+  The in-memory cache is only cleared when the settings change.
+  Cached output may contain sensitive data: on-disk entries are only
+  readable by their owner.
+  '''
+  global cache_enabled, cache_ttl, cache_dir, cache_env
+  directory = directory if enabled and not ttl is None else None
+  env = tuple(env)
+  if (enabled, ttl, directory, env) == (cache_enabled, cache_ttl, cache_dir, cache_env): return
+  cache_enabled = enabled
+  cache_ttl = ttl
+  cache_dir = directory
+  cache_env = env
+  cache.clear()
+
+def parse_opts(args:str) -> tuple[dict[str,str],str]:
+  '''Split options from an `#exec` command
+
   :param args: argument string passed in the pre-processor directive
-  :param prefix: used to maintain YAML structure
+  :returns: dict with options and the command
+
+  Only options listed in `OPTIONS` are recognized, anything else
+  is part of the command.
+
+  ```python
+  >>> parse_opts('--nocache date +%s')
+  ({'nocache': ''}, 'date +%s')
+  >>> parse_opts('--version')
+  ({}, '--version')
+
+  ```
+  '''
+  opts = {}
+  while True:
+    mv = RE_OPTION.match(args)
+    if not mv or not mv.group(1) in OPTIONS: break
+    opts[mv.group(1)] = mv.group(2) or ''
+    args = args[mv.end():]
+  return opts, args
+
+def cache_key(args:str, cwd:str|None) -> str:
+  '''Compute the cache key for a command
+
+  :param args: command
+  :param cwd: directory the command runs in
+  :returns: cache key
+  '''
+  return json.dumps([args, os.path.abspath(cwd or '.'), [ os.environ.get(k) for k in cache_env ]])
+
+def disk_cache_file(key:str) -> str:
+  '''Return the on-disk cache file for a cache key
+
+  :param key: cache key
+  :returns: file path
+  '''
+  return os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + DISK_CACHE_EXT)
+
+def cache_get(key:str) -> tuple[str,str]|None:
+  '''Look up a cached command result
+
+  :param key: cache key
+  :returns: tuple(stdout, stderr) or `None` if not cached or expired
+  '''
+  entry = cache.get(key)
+  if entry is None and not cache_dir is None:
+    try:
+      with open(disk_cache_file(key), 'r') as fp:
+        entry = tuple(json.load(fp))
+    except (OSError, ValueError):
+      entry = None
+  if entry is None: return None
+  expires, stdout, stderr = entry
+  if not expires is None and expires < time.time():
+    cache.pop(key, None)
+    return None
+  cache[key] = entry
+  return stdout, stderr
+
+def cache_put(key:str, stdout:str, stderr:str) -> None:
+  '''Save a command result
+
+  :param key: cache key
+  :param stdout: command output
+  :param stderr: command error output
+  '''
+  expires = None if cache_ttl is None else time.time() + cache_ttl
+  cache[key] = (expires, stdout, stderr)
+  if expires is None or cache_dir is None: return
+  try:
+    os.makedirs(cache_dir, exist_ok = True)
+    fd, tmpname = tempfile.mkstemp(dir = cache_dir, suffix = '.tmp')
+    try:
+      with os.fdopen(fd, 'w') as fp:
+        json.dump(cache[key], fp)
+      os.replace(tmpname, disk_cache_file(key))
+    except Exception:
+      os.unlink(tmpname)
+      raise
+  except OSError as e:
+    sys.stderr.write(f'Unable to write exec cache: {e}\n')
+
+def flush() -> None:
+  '''Forget results only cached for the current document
+
+  Called when the pre-processor finishes a document.
+  '''
+  for key in [ key for key, entry in cache.items() if entry[0] is None ]:
+    del cache[key]
+
+class ExecStat:
+  '''Statistics of an `#exec` command'''
+  def __init__(self, command:str, filename:str|None, line:int):
+    '''Create a statistics record
+
+    :param command: command run
+    :param filename: file containing the `#exec` directive
+    :param line: line of the `#exec` directive
+    '''
+    self.command = command
+    '''Command run'''
+    self.filename = filename
+    '''File containing the `#exec` directive'''
+    self.line = line
+    '''Line of the `#exec` directive'''
+    self.returncode = None
+    '''Exit status'''
+    self.duration = 0.0
+    '''Seconds the command ran'''
+    self.stdout_bytes = 0
+    '''Bytes of output read'''
+    self.stderr_bytes = 0
+    '''Bytes of error output'''
+    self.cached = False
+    '''`True` if the output was taken from the cache'''
+    self.timed_out = False
+    '''`True` if the command was killed after its timeout'''
+    self.truncated = False
+    '''`True` if the command was killed after producing too much output'''
+
+  def __repr__(self) -> str:
+    return f'<ExecStat {self.command!r} rc={self.returncode} {self.duration:.3f}s {self.stdout_bytes}+{self.stderr_bytes} bytes>'
+
+def parse_size(text:str) -> int:
+  '''Parse a size
+
+  :param text: number of bytes, optionally followed by `K`, `M` or `G`
+  :returns: size in bytes
+  :raises ValueError: if `text` is not a valid size
+
+  ```python
+  >>> parse_size('1M'), parse_size('16k'), parse_size('100')
+  (1048576, 16384, 100)
+
+  ```
+  '''
+  text = text.strip().upper()
+  if text[-1:] in SIZE_SUFFIXES: return int(text[:-1]) * SIZE_SUFFIXES[text[-1]]
+  return int(text)
+
+def exec_limits(yppi:ipp.iYamlPreProcessor, opts:dict[str,str]) -> tuple[float|None,int|None]:
+  '''Get timeout and output size limit from `#exec` options
+
+  :param yppi: Yaml Pre-Processor instance
+  :param opts: options as returned by `parse_opts`
+  :returns: tuple(timeout, max_bytes), `None` for no limit
+  '''
+  timeout = max_bytes = None
+  try:
+    if 'timeout' in opts: timeout = float(opts['timeout'])
+  except ValueError:
+    yppi.msg(f'Invalid timeout "{opts["timeout"]}"')
+  try:
+    if 'max-bytes' in opts: max_bytes = parse_size(opts['max-bytes'])
+  except ValueError:
+    yppi.msg(f'Invalid size "{opts["max-bytes"]}"')
+  return timeout, max_bytes
+
+def report(yppi:ipp.iYamlPreProcessor, stat:ExecStat, timeout:float|None, max_bytes:int|None) -> None:
+  '''Report failed commands
+
+  :param yppi: Yaml Pre-Processor instance
+  :param stat: command statistics
+  :param timeout: timeout used
+  :param max_bytes: output size limit used
+  '''
+  if stat.timed_out:
+    text = f'Command: {stat.command} timed out after {timeout} seconds'
+  elif stat.truncated:
+    text = f'Command: {stat.command} output truncated at {max_bytes} bytes'
+  elif stat.returncode != 0:
+    text = f'Command: {stat.command} exited status {stat.returncode}'
+  else:
+    return
+  state = yppi.save_state(stat.filename, stat.line)
+  yppi.msg(text)
+  yppi.restore_state(state)
+
+def kill_process(proc:subprocess.Popen) -> None:
+  '''Kill a command and the processes it started
+
+  :param proc: process to kill
+
+  Commands with limits are started in their own session, so that
+  their whole process group can be killed.
+  '''
+  try:
+    if hasattr(os, 'killpg'):
+      os.killpg(proc.pid, signal.SIGKILL)
+    else:
+      proc.kill()
+  except OSError:
+    pass
+
+def exec_cwd(yppi:ipp.iYamlPreProcessor) -> str|None:
+  '''Return the directory commands are run in
+
+  :param yppi: Yaml Pre-Processor instance
+  :returns: directory of the file being processed or `None`
   '''
   cwd = None
   filename = yppi.get_filename()
   if filename:
     cwd = os.path.dirname(filename)
     if cwd == ' ': cwd = None
+  return cwd
 
-  rc = subprocess.run(args,
-                      capture_output=True,
-                      shell=True,
-                      text=True,
-                      cwd=cwd)
-  if rc.returncode != 0:
-    yppi.msg(f'Command: {args} exited status {rc.returncode}')
-  if rc.stderr != '': sys.stderr.write(rc.stderr)
+def prefix_lines(text:str, prefix:str = '') -> typing.Iterator[str]:
+  '''Split command output into prefixed lines
+
+  :param text: command output
+  :param prefix: used to maintain YAML structure
+  :returns: iterator yielding output lines
 
+  ```python
+  >>> list(prefix_lines('one\\ntwo', '- '))
+  ['- one\\n', '  two\\n']
+
+  ```
+  '''
   prefix2 = prefix.replace('-',' ')
   # Used to handle `- #include` syntax
-  txt = ''
-  for i in rc.stdout.split('\n'):
-    txt += prefix + i +'\n'
+  for i in text.split('\n'):
+    yield prefix + i +'\n'
     prefix = prefix2
 
-  return txt
+def decode(data:bytes) -> str:
+  '''Decode command output the same way as `subprocess.run(text=True)`
+
+  :param data: output bytes
+  :returns: text with universal newlines
+
+  ```python
+  >>> decode(b'one\\r\\ntwo\\r')
+  'one\\ntwo\\n'
+
+  ```
+
+  Undecodable bytes (for example, in truncated output) are replaced.
+  '''
+  text = data.decode(locale.getpreferredencoding(False), errors='replace')
+  return text.replace('\r\n','\n').replace('\r','\n')
+
+def decoder() -> io.IncrementalNewlineDecoder:
+  '''Create an incremental version of `decode`
+
+  :returns: decoder for output read in blocks
+
+  Characters and `\\r\\n` sequences split across blocks are
+  decoded correctly.
+
+  ```python
+  >>> dec = decoder()
+  >>> dec.decode(b'one\\r'), dec.decode(b'\\ntwo\\r'), dec.decode(b'', final = True)
+  ('one', '\\ntwo', '\\n')
+
+  ```
+  '''
+  enc = codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors = 'replace')
+  return io.IncrementalNewlineDecoder(enc, translate = True)
+
+def stream(args:str, cwd:str|None, prefix:str, timeout:float|None, max_bytes:int|None,
+           stat:ExecStat, keep:list[str]|None) -> typing.Iterator[str]:
+  '''Run a command streaming its output
+
+  :param args: command to run
+  :param cwd: directory to run the command in
+  :param prefix: used to maintain YAML structure
+  :param timeout: seconds after which the command is killed, `None` for no limit
+  :param max_bytes: bytes of output after which the command is killed, `None` for no limit
+  :param stat: statistics to update
+  :param keep: if not `None`, decoded output is appended to this list
+    (up to `CACHE_MAX_BYTES`)
+  :returns: iterator yielding prefixed output lines
+
+  The last line (which is empty if the output ends with a new line)
+  is not yielded but returned, together with the error output, as
+  the generator's value.  Error output is collected in a temporary
+  file and written to `stderr` when the command finishes.
+
+  Output is read in blocks of at most `READ_SIZE` bytes, never
+  reading past `max_bytes`, so the limit also applies to output
+  without new lines.
+
+  ```python
+  >>> stat = ExecStat('x', None, 0)
+  >>> out = stream("yes | tr -d '\\\\n'", None, '', None, 1000, stat, None)
+  >>> try:
+  ...   while True: next(out)
+  ... except StopIteration as e:
+  ...   last, err = e.value
+  >>> len(last), stat.stdout_bytes, stat.truncated
+  (1001, 1000, True)
+
+  ```
+  '''
+  start = time.monotonic()
+  prefix2 = prefix.replace('-',' ')
+  pending = ''
+  timer = None
+  with tempfile.TemporaryFile() as errfp:
+    proc = subprocess.Popen(args,
+                            shell=True,
+                            stdout=subprocess.PIPE,
+                            stderr=errfp,
+                            cwd=cwd,
+                            start_new_session=not (timeout is None and max_bytes is None))
+    try:
+      if not timeout is None:
+        def expire():
+          stat.timed_out = True
+          kill_process(proc)
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+      dec = decoder()
+      while not stat.truncated:
+        # Read one byte past the limit to detect longer output
+        size = READ_SIZE if max_bytes is None else min(READ_SIZE, max_bytes - stat.stdout_bytes + 1)
+        raw = proc.stdout.read1(size)
+        if not max_bytes is None and stat.stdout_bytes + len(raw) > max_bytes:
+          raw = raw[:max_bytes - stat.stdout_bytes]
+          stat.truncated = True
+        stat.stdout_bytes += len(raw)
+        text = dec.decode(raw, final = stat.truncated or not raw)
+        if not keep is None and stat.stdout_bytes <= CACHE_MAX_BYTES: keep.append(text)
+        lines = (pending + text).split('\n')
+        pending = lines.pop()
+        for line in lines:
+          yield prefix + line + '\n'
+          prefix = prefix2
+        if not raw: break
+      if stat.truncated: kill_process(proc)
+    finally:
+      if not timer is None: timer.cancel()
+      if proc.poll() is None and (stat.truncated or stat.timed_out or sys.exc_info()[0]):
+        kill_process(proc)
+      proc.stdout.close()
+      stat.returncode = proc.wait()
+      stat.duration = time.monotonic() - start
+    errfp.seek(0)
+    err = errfp.read()
+  stat.stderr_bytes = len(err)
+  err = decode(err)
+  if err: sys.stderr.write(err)
+  return prefix + pending + '\n', err
+
+def cb_exec(yppi:ipp.iYamlPreProcessor, args:str, prefix:str = '') -> typing.Iterator[str]:
+  '''Handler for external commands
+
+  :param yppi: Yaml Pre-Processor instance
+  :param args: argument string passed in the pre-processor directive
+  :param prefix: used to maintain YAML structure
+  :returns: iterator yielding command output lines
+  '''
+  opts, args = parse_opts(args)
+  cwd = exec_cwd(yppi)
+  timeout, max_bytes = exec_limits(yppi, opts)
+  stat = ExecStat(args, yppi.get_filename(), yppi.line)
+  yppi.exec_stats.append(stat)
+  key = cache_key(args, cwd) if cache_enabled and not 'nocache' in opts else None
+  hit = None if key is None else cache_get(key)
+  if not hit is None:
+    stdout, stderr = hit
+    stat.returncode, stat.cached = 0, True
+    stat.stdout_bytes, stat.stderr_bytes = len(stdout.encode()), len(stderr.encode())
+    if stderr != '': sys.stderr.write(stderr)
+    yield from prefix_lines(stdout, prefix)
+    return
+
+  keep = None if key is None else []
+  last, stderr = yield from stream(args, cwd, prefix, timeout, max_bytes, stat, keep)
+  report(yppi, stat, timeout, max_bytes)
+  if stat.returncode == 0 and not stat.truncated and not key is None and stat.stdout_bytes <= CACHE_MAX_BYTES:
+    cache_put(key, ''.join(keep), stderr)
+  yield last
+
+async def arun(args:str, cwd:str|None, key:str|None, limit:'asyncio.Semaphore', inflight:dict,
+               timeout:float|None, max_bytes:int|None, stat:ExecStat) -> tuple[ExecStat,str,str]:
+  '''Run an external command asynchronously
+
+  :param args: command to run
+  :param cwd: directory to run the command in
+  :param key: cache key, `None` if the result must not be cached
+  :param limit: semaphore limiting the number of commands running at the same time
+  :param inflight: tasks running commands, see `cb_aexec`
+  :param timeout: seconds after which the command is killed, `None` for no limit
+  :param max_bytes: bytes of output after which the command is killed, `None` for no limit
+  :param stat: statistics to update
+  :returns: tuple(stat, stdout, stderr)
+  '''
+  import asyncio
+  out = []
+
+  async def read_stdout(proc):
+    while True:
+      data = await proc.stdout.read(READ_SIZE)
+      if not data: return
+      if stat.truncated: continue # Discard output until the killed command exits
+      if not max_bytes is None and stat.stdout_bytes + len(data) > max_bytes:
+        data = data[:max_bytes - stat.stdout_bytes]
+        stat.truncated = True
+        kill_process(proc)
+      stat.stdout_bytes += len(data)
+      out.append(data)
+
+  try:
+    async with limit:
+      start = time.monotonic()
+      proc = await asyncio.create_subprocess_shell(args,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE,
+                                                   cwd=cwd,
+                                                   start_new_session=not (timeout is None and max_bytes is None))
+      readers = asyncio.gather(read_stdout(proc), proc.stderr.read())
+      done, _ = await asyncio.wait([readers], timeout = timeout)
+      if not done:
+        stat.timed_out = True
+        kill_process(proc)
+      _, err = await readers
+      stat.returncode = await proc.wait()
+      stat.duration = time.monotonic() - start
+  finally:
+    if not key is None: inflight.pop(key, None)
+  stdout, stderr = decode(b''.join(out)), decode(err)
+  stat.stderr_bytes = len(err)
+  if stat.returncode == 0 and not stat.truncated and not key is None and stat.stdout_bytes <= CACHE_MAX_BYTES:
+    cache_put(key, stdout, stderr)
+  return stat, stdout, stderr
+
+async def aexec(yppi:ipp.iYamlPreProcessor, prefix:str, task:'asyncio.Task', stat:ExecStat,
+                timeout:float|None, max_bytes:int|None) -> str:
+  '''Wait for an external command and format its output
+
+  :param yppi: Yaml Pre-Processor instance
+  :param prefix: used to maintain YAML structure
+  :param task: task running the command, see `arun`
+  :param stat: statistics of this `#exec` directive
+  :param timeout: timeout used
+  :param max_bytes: output size limit used
+  :returns: prefixed command output
+
+  When identical commands share a task, only the first one runs
+  the command.  The others are recorded as cached.
+  '''
+  run, stdout, stderr = await task
+  if not run is stat:
+    stat.returncode, stat.cached = run.returncode, True
+    stat.stdout_bytes, stat.stderr_bytes = run.stdout_bytes, run.stderr_bytes
+    stat.timed_out, stat.truncated = run.timed_out, run.truncated
+  report(yppi, stat, timeout, max_bytes)
+  if stderr: sys.stderr.write(stderr)
+
+  return ''.join(prefix_lines(stdout, prefix))
+
+def cb_aexec(yppi:ipp.iYamlPreProcessor, args:str, prefix:str = '',
+             limit:'asyncio.Semaphore|None' = None, inflight:dict|None = None) -> list:
+  '''Handler for external commands run concurrently
+
+  :param yppi: Yaml Pre-Processor instance
+  :param args: argument string passed in the pre-processor directive
+  :param prefix: used to maintain YAML structure
+  :param limit: semaphore limiting the number of commands running at the same time
+  :param inflight: tasks running commands, shared by all the `#exec` directives of a document
+  :returns: list with the task running the command, or with the cached output
+
+  Must be called from a running event loop.  The task is returned
+  in place of the command output, and replaced by its result once
+  all commands finish.  Identical cacheable commands share a single
+  task while it runs.  `inflight` is keyed by cache key, or by the
+  command's `ExecStat` if its result is not cached, so that the
+  caller can cancel every task it started.
+  '''
+  import asyncio
+  if limit is None: limit = asyncio.Semaphore(DEF_CONCURRENCY)
+  if inflight is None: inflight = {}
+  opts, args = parse_opts(args)
+  cwd = exec_cwd(yppi)
+  timeout, max_bytes = exec_limits(yppi, opts)
+  stat = ExecStat(args, yppi.get_filename(), yppi.line)
+  yppi.exec_stats.append(stat)
+  key = cache_key(args, cwd) if cache_enabled and not 'nocache' in opts else None
+  hit = None if key is None else cache_get(key)
+  if not hit is None:
+    stdout, stderr = hit
+    stat.returncode, stat.cached = 0, True
+    stat.stdout_bytes, stat.stderr_bytes = len(stdout.encode()), len(stderr.encode())
+    if stderr != '': sys.stderr.write(stderr)
+    return [ ''.join(prefix_lines(stdout, prefix)) ]
+
+  task = None if key is None else inflight.get(key)
+  if task is None:
+    task = asyncio.ensure_future(arun(args, cwd, key, limit, inflight, timeout, max_bytes, stat))
+    inflight[stat if key is None else key] = task
+  return [ asyncio.ensure_future(aexec(yppi, prefix, task, stat, timeout, max_bytes)) ]
 
 if __name__ == '__main__':
-  pass
-  
+  import doctest
+
+  failures, tests = doctest.testmod()
+  if failures > 0: sys.exit(1)
@@ -3,6 +3,7 @@
 '''
 import base64
 import re
+import typing
 
 try:
   from icecream import ic
@@ -15,7 +16,7 @@ import ipp
 RE_TYPE = re.compile(r'\s*--(raw|bin)\s+')
 ''' Regular expression to determine the include type '''
 
-def include_raw(yppi:ipp.iYamlPreProcessor, fname:str, prefix:str) -> str:
+def include_raw(yppi:ipp.iYamlPreProcessor, fname:str, prefix:str) -> typing.Iterator[str]:
   ''' Include file verbatim
 
   :param yppi: YamlPreProcessor instance
@@ -26,8 +27,9 @@ def include_raw(yppi:ipp.iYamlPreProcessor, fname:str, prefix:str) -> str:
   expansion nor include statements.
 
   Prefix is still used.  This is to maintiain the YAML file structure.
+
+  Lines are yielded as they are read.
   '''
-  txt = ''
   fname = yppi.find_include(fname)
   prefix2 = prefix.replace('-',' ')
   # We do this to allow `- #include` syntax  
@@ -36,11 +38,10 @@ def include_raw(yppi:ipp.iYamlPreProcessor, fname:str, prefix:str) -> str:
     for line in f:
       if line.endswith("\n"): line = line[:-1]
       if line.endswith("\r"): line = line[:-1]
-      txt += prefix + line + "\n"
+      yield prefix + line + "\n"
       prefix = prefix2
-  return txt
 
-def include_bin(yppi:ipp.iYamlPreProcessor, fname:str, prefix:str) -> str:
+def include_bin(yppi:ipp.iYamlPreProcessor, fname:str, prefix:str) -> typing.Iterator[str]:
   ''' Include binary file
 
   :param yppi: YamlPreProcessor instance
@@ -51,7 +52,6 @@ def include_bin(yppi:ipp.iYamlPreProcessor, fname:str, prefix:str) -> str:
 
   Prefix is used to maintain YAML file structure.
   '''
-  txt = ''
   prefix2 = prefix.replace('-',' ')
   # We do this to allow `- #include` syntax  
 
@@ -61,18 +61,17 @@ def include_bin(yppi:ipp.iYamlPreProcessor, fname:str, prefix:str) -> str:
     b64 = base64.b64encode(f.read()).decode('ascii')
     i = 0
     while i < len(b64):
-      txt += prefix + b64[i:i+76] + "\n"
+      yield prefix + b64[i:i+76] + "\n"
       prefix = prefix2
       i += 76
 
-  return txt
-
-def cb_inc(yppi:ipp.iYamlPreProcessor, args:str, prefix:str = '') -> str:
+def cb_inc(yppi:ipp.iYamlPreProcessor, args:str, prefix:str = '') -> typing.Iterator[str]:
   '''Handler for external commands
   
   :param yppi: Yaml Pre-Processor instance
   :param args: argument string passed in the pre-processor directive
   :param prefix: used to maintain YAML structure
+  :returns: iterator yielding the included text
   '''
   # ~ ic(args)
   try:
@@ -80,13 +79,13 @@ def cb_inc(yppi:ipp.iYamlPreProcessor, args:str, prefix:str = '') -> str:
     if mv:
       args = args[mv.end():]
       if mv.group(1) == 'raw':
-        return include_raw(yppi, args, prefix)
+        yield from include_raw(yppi, args, prefix)
       elif mv.group(1) == 'bin':
-        return include_bin(yppi, args, prefix)
-    return yppi.read_file(args, prefix)
+        yield from include_bin(yppi, args, prefix)
+      return
+    yield from yppi.iter_read_file(args, prefix)
   except FileNotFoundError as e:
     yppi.msg(str(e))
-    return ''
 
 if __name__ == '__main__':
   pass
@@ -2,6 +2,7 @@
 ''' YAML pre-processor interface
 
 '''
+import io
 import platform
 import sys
 import typing
@@ -23,6 +24,89 @@ class STR:
   KEY_STORE = 'key_store'
   '''Variable containing the directory used to store generated ssh keys'''
 
+class MK:
+  '''Characters used to signal macros'''
+  SIGNAL = '$'
+  '''Macro character indicator'''
+  OPEN = '<'
+  '''Open macro character'''
+  CLOSE = '>'
+  '''Close macro character'''
+
+class IterReader(io.TextIOBase):
+  '''Read-only text file over an iterator of text chunks
+
+  Lets consumers that expect a file, such as the YAML parser, read
+  pre-processed text while it is being produced.
+
+  ```python
+  >>> fp = IterReader(iter(['one\\n', 'two', '\\nthree\\n']))
+  >>> fp.read(5)
+  'one\\nt'
+  >>> fp.readline()
+  'wo\\n'
+  >>> fp.read()
+  'three\\n'
+  >>> fp.read()
+  ''
+  >>> list(IterReader(iter(['a\\nb\\n', 'c\\n', 'd\\n'])))
+  ['a\\n', 'b\\n', 'c\\n', 'd\\n']
+  >>> fp = IterReader(iter(['a\\nb', '', 'c\\n']))
+  >>> fp.readline(), fp.readline(), fp.readline()
+  ('a\\n', 'bc\\n', '')
+
+  ```
+  '''
+  def __init__(self, chunks:typing.Iterator[str]) -> None:
+    '''Create a reader
+    :param chunks: iterator yielding text
+    '''
+    self.chunks = chunks
+    self.pending = ''
+
+  def readable(self) -> bool:
+    return True
+
+  def read(self, size:int|None = -1) -> str:
+    '''Read text
+    :param size: maximum number of characters, negative or `None` to read everything
+    :returns: text, an empty string at the end of the file
+    '''
+    if size is None or size < 0:
+      res = self.pending + ''.join(self.chunks)
+      self.pending = ''
+      return res
+    parts = [ self.pending ]
+    have = len(self.pending)
+    for chunk in self.chunks:
+      parts.append(chunk)
+      have += len(chunk)
+      if have >= size: break
+    text = ''.join(parts)
+    self.pending = text[size:]
+    return text[:size]
+
+  def readline(self, size:int|None = -1) -> str:
+    '''Read a line
+    :param size: maximum number of characters, negative or `None` for no limit
+    :returns: line including the new line, an empty string at the end of the file
+    '''
+    parts = [ self.pending ]
+    while not '\n' in parts[-1]:
+      chunk = next(self.chunks, None)
+      if chunk is None: break
+      parts.append(chunk)
+    text = ''.join(parts)
+    end = text.find('\n') + 1 or len(text)
+    if not size is None and size >= 0: end = min(end, size)
+    self.pending = text[end:]
+    return text[:end]
+
+  def close(self) -> None:
+    '''Close the reader, finishing the iterator'''
+    if hasattr(self.chunks, 'close'): self.chunks.close()
+    super().close()
+
 class iYamlPreProcessor:
   '''This class defines the interface for YamlPreProcessor
   '''
@@ -100,33 +184,85 @@ class iYamlPreProcessor:
     :param prefix: Prefix used to maintain YAML file structure
     :returns: pre-processed text
     '''
-    if isinstance(inpfile,str):
-      return self.read_file(inpfile, prefix)
-    else:
-      state = self.save_state(None)
-      txt = self.parser(inpfile, prefix)
-      self.restore_state(state)
-      return txt
+    return ''.join(self.iter_process(inpfile, prefix))
+
+  def iter_process(self, inpfile:str|typing.TextIO, prefix:str = '', flush:bool = True) -> typing.Iterator[str]:
+    '''Streaming entry point for processing YAML documents
+    :param inpfile: YAML document to process as either a string containing a filename or a file pointer as returned by `open`
+    :param prefix: Prefix used to maintain YAML file structure
+    :param flush: if `False`, the caller must call `flush` once the output is complete
+    :returns: iterator yielding pre-processed text chunks
+
+    Same as `process` but pre-processed text is yielded as it is
+    produced, including the contents of nested `#include` files.
+    Only the current line and the include stack are kept in memory.
+    '''
+    try:
+      if isinstance(inpfile,str):
+        yield from self.iter_read_file(inpfile, prefix)
+      else:
+        state = self.save_state(None)
+        try:
+          yield from self.iter_parser(inpfile, prefix)
+        finally:
+          self.restore_state(state)
+    finally:
+      if flush: self.flush()
+
+  def reader(self, inpfile:str|typing.TextIO, prefix:str = '') -> typing.TextIO:
+    '''File-like entry point for processing YAML documents
+    :param inpfile: YAML document to process as either a string containing a filename or a file pointer as returned by `open`
+    :param prefix: Prefix used to maintain YAML file structure
+    :returns: file object reading the pre-processed text
+
+    Same as `iter_process`, but returns an object that can be passed
+    directly to `yaml.load`, so that the YAML parser consumes the
+    text while it is being produced.
+    '''
+    return IterReader(self.iter_process(inpfile, prefix))
 
-  # These methods should be implemented in child classes
   def parser(self, filep:typing.TextIO, prefix:str = '') -> str:
     '''Entry point for processing file pointers as returned by `open`
     :param filep: File pointer as returned by `open`
     :param prefix: Prefix used to maintain YAML file structure.
     :returns: pre-processed text
     '''
-    raise NotImplementedError
+    return ''.join(self.iter_parser(filep, prefix))
   def read_file(self, filename:str, prefix:str = '') -> str:
     '''Entry point for processing files
     :param filename: Name of YAML document file
     :param prefix: Prefix used to maintain YAML file structure.
     :returns: pre-processed text
     '''
+    return ''.join(self.iter_read_file(filename, prefix))
+
+  def flush(self) -> None:
+    '''Save pending changes
+
+    Called when processing of a document finishes, so that
+    changes buffered while processing (for example generated
+    secrets) are saved only once.  Does nothing by default.
+    '''
+    pass
+
+  # These methods should be implemented in child classes
+  def iter_parser(self, filep:typing.TextIO, prefix:str = '') -> typing.Iterator[str]:
+    '''Entry point for processing file pointers as returned by `open`
+    :param filep: File pointer as returned by `open`
+    :param prefix: Prefix used to maintain YAML file structure.
+    :returns: iterator yielding pre-processed text chunks
+    '''
+    raise NotImplementedError
+  def iter_read_file(self, filename:str, prefix:str = '') -> typing.Iterator[str]:
+    '''Entry point for processing files
+    :param filename: Name of YAML document file
+    :param prefix: Prefix used to maintain YAML file structure.
+    :returns: iterator yielding pre-processed text chunks
+    '''
     raise NotImplementedError
-  def expand_vars(self, line:str, loopctl:dict = dict()) -> str:
+  def expand_vars(self, line:str) -> str:
     '''Entry point for variable expansion
     :param line: text containing references to expand
-    :param loopctl: Internal variable used for loop prevention
     :returns: string with expanded variables
     '''
     raise NotImplementedError
@@ -136,10 +272,9 @@ class iYamlPreProcessor:
     :returns: `True` if `name` exists, `False` otherwise.
     '''
     raise NotImplementedError
-  def lookup(self, name:str, loopctl:dict = dict()) -> str|None:
+  def lookup(self, name:str) -> str|None:
     '''Lookup a pre-processor variable
     :param name: pre-processor variable to look-up
-    :param loopctl: Internal variable used for loop control
     :returns: contents of `name` variable, `None` if `name` does not exist.
     '''
     raise NotImplementedError
@@ -17,27 +17,19 @@ import sys
 import typing
 
 import cfgfile
+import compiler
 import extcmd
 import includes
 import pwhash
 import sshkeys
 
-from ipp import STR, iYamlPreProcessor
+from ipp import MK, STR, iYamlPreProcessor
 
 try:
   from icecream import ic
 except ImportError:  # Graceful fallback if IceCream isn't installed.
   ic = lambda *a: None if not a else (a[0] if len(a) == 1 else a)  # noqa
 
-class MK:
-  '''Characters used to signal macros'''
-  SIGNAL = '$'
-  '''Macro character indicator'''
-  OPEN = '<'
-  '''Open macro character'''
-  CLOSE = '>'
-  '''Close macro character'''
-
 class YppDirective:
   '''Class used to manage pre-processor directive or macro callbacks'''
   def __init__(self, callback:typing.Callable, expand_vars:bool = True):
@@ -64,9 +56,9 @@ class YamlPreProcessor(iYamlPreProcessor):
   # Complied RegExps
   RE_VALID_ID = re.compile(r'^[_A-Za-z][_A-Za-z0-9]*$')
   ''' Regular expressions to validate pre-processor variable names '''
-  RE_PP_DIRECTIVE = re.compile(r'^(\s*)#\s*([a-z]+)\s*')
+  RE_PP_DIRECTIVE = compiler.RE_PP_DIRECTIVE
   ''' Regular expression to get pre-processor directives '''
-  RE_PP_DIRECTIVE_ALT = re.compile(r'^(\s*-\s*)#\s*([a-z]+)\s*')
+  RE_PP_DIRECTIVE_ALT = compiler.RE_PP_DIRECTIVE_ALT
   ''' Regular expression to get alternative pre-processor directives '''
 
   RE_DEFER = re.compile(r'^\s*--(defer)\s+')
@@ -130,6 +122,20 @@ class YamlPreProcessor(iYamlPreProcessor):
       return
     if var_expand: value = self.expand_vars(value)
     self.ppv[key] = value
+    self.invalidate(key)
+
+  def invalidate(self, name:str) -> None:
+    '''Invalidate resolved variable values
+    :param name: variable that has changed
+
+    Removes the resolved value of `name` and of all the variables
+    that depend on it (directly or indirectly) from the cache.
+    '''
+    pending = [name]
+    while len(pending):
+      name = pending.pop()
+      self.resolved.pop(name, None)
+      pending.extend(self.dependents.pop(name, ()))
 
   def register_cb(self, directive:str, callback:typing.Callable, expand_vars:bool = True) -> None:
     '''Register a pre-processor directive callback
@@ -198,6 +204,14 @@ class YamlPreProcessor(iYamlPreProcessor):
     self.ppv = {
       STR.INCLUDE_PATH: '',
     }
+    self.resolved = {}
+    '''Cache of resolved variable values'''
+    self.dependents = {}
+    '''Maps variable names to the set of variables whose resolved values depend on them'''
+    self.resolving = []
+    '''Stack of variables being resolved.  Used to track dependencies and catch reference loops'''
+    self.exec_stats = []
+    '''Statistics of the `#exec` commands run, see {py:obj}`extcmd.ExecStat`'''
 
     sshkeys.register(self)
     pwhash.register(self)
@@ -238,6 +252,67 @@ class YamlPreProcessor(iYamlPreProcessor):
       else:
         self.msg(f'{key} is not a valid name')
 
+    # Variables were modified directly above, so discard any resolved values
+    self.resolved.clear()
+    self.dependents.clear()
+
+  def flush(self) -> None:
+    '''Save pending changes
+
+    Writes newly generated secrets to the secrets file and forgets
+    `#exec` results only cached for the current document.
+    '''
+    pwhash.flush()
+    extcmd.flush()
+
+  async def aprocess(self, inpfile:str|typing.TextIO, prefix:str = '', limit:int = extcmd.DEF_CONCURRENCY) -> str:
+    '''Process a YAML document running `#exec` commands concurrently
+
+    :param inpfile: YAML document to process as either a string containing a filename or a file pointer as returned by `open`
+    :param prefix: Prefix used to maintain YAML file structure
+    :param limit: maximum number of commands running at the same time
+    :returns: pre-processed text
+
+    Same as {py:obj}`ipp.iYamlPreProcessor.process`, but all `#exec`
+    commands in the document (and its `#include` files) are started
+    without waiting for earlier ones to finish.  Their output is
+    placed in document order.  Commands must not depend on the
+    side-effects of other commands in the same document.
+
+    ```python
+    >>> import asyncio, io
+    >>> yppi = YamlPreProcessor()
+    >>> doc = io.StringIO('a:\\n#exec sleep 0.2; echo "  - 1"\\n#exec echo "  - 2"\\n')
+    >>> print(asyncio.run(yppi.aprocess(doc)), end='')
+    a:
+      - 1
+    <BLANKLINE>
+      - 2
+    <BLANKLINE>
+
+    ```
+    '''
+    import asyncio
+    saved = self.cmds['exec']
+    inflight = {}
+    if getattr(saved.callback, '__wrapped__', saved.callback) is extcmd.cb_exec:
+      limiter = asyncio.Semaphore(limit)
+      self.cmds['exec'] = YppDirective(lambda yppi, args, prefix = '': extcmd.cb_aexec(yppi, args, prefix, limiter, inflight),
+                                       saved.expand_vars)
+    chunks = []
+    try:
+      try:
+        for chunk in self.iter_process(inpfile, prefix, flush = False): chunks.append(chunk)
+      finally:
+        self.cmds['exec'] = saved
+      await asyncio.gather(*(chunk for chunk in chunks if not isinstance(chunk, str)))
+    finally:
+      tasks = [ chunk for chunk in chunks if not isinstance(chunk, str) ] + list(inflight.values())
+      for task in tasks: task.cancel()
+      await asyncio.gather(*tasks, return_exceptions = True)
+      self.flush()
+    return ''.join(chunk if isinstance(chunk, str) else chunk.result() for chunk in chunks)
+
   def secrets_file(self) -> str:
     '''Return the value of `secrets_file`'''
     return self.ppv[STR.SECRETS_FILE]
@@ -245,113 +320,126 @@ class YamlPreProcessor(iYamlPreProcessor):
     '''Return the value of `key_store`'''
     return self.ppv[STR.KEY_STORE]
 
-  def parse_line(line:str) -> tuple[str,str,str]:
-    '''_internal_ utility function to parse pre-processor directives
-    :meta internal:
-    :param line: text to parse
-    :returns: tuple(token, args, prefix)
-    '''
-    mv = YamlPreProcessor.RE_PP_DIRECTIVE.match(line)
-    if mv:
-      return mv.group(2), line[mv.end():].strip(), mv.group(1)
-    mv = YamlPreProcessor.RE_PP_DIRECTIVE_ALT.match(line)
-    if mv:
-      return mv.group(2), line[mv.end():].strip(), mv.group(1)
-    return '','',''
+  parse_line = compiler.parse_line
+  '''_internal_ utility function to parse pre-processor directives
+  :meta internal:
 
-  def parser(self, fp:typing.TextIO, prefix='') -> str:
+  See {py:obj}`compiler.parse_line`
+  '''
+
+  def iter_parser(self, fp:typing.TextIO, prefix='') -> typing.Iterator[str]:
     '''Process data from a file pointer
     :param typing.TextIO fp: file pointer
     :param str prefix: (optional) Prefix string to maintain YAML structure
-    :returns str: processed text
+    :returns: iterator yielding processed text chunks
 
     This is the main YAML pre-processor functions.  Implements most of the
     logic related to YAML pre-processing.
 
     It takes a file pointer as input, executes the pre-processing statements
-    and returns the results as a text string.
+    and yields the results as they are produced.  Use
+    {py:obj}`ipp.iYamlPreProcessor.parser` to get the results as a
+    single text string.
+
+    Directive callbacks may return either a string or an iterable
+    of strings.  Iterables (such as nested `#include` files) are
+    streamed through the same iterator.
 
     '''
-    txt = ''
+    yield from self.iter_ops(compiler.compile_stream(fp), prefix)
+
+  def iter_ops(self, ops:typing.Iterable[tuple], prefix='') -> typing.Iterator[str]:
+    '''Execute compiled operations
+    :param ops: operations as returned by the {py:obj}`compiler` module
+    :param str prefix: (optional) Prefix string to maintain YAML structure
+    :returns: iterator yielding processed text chunks
+    '''
     cond_stack = []
     prefix2 = prefix.replace('-',' ')
     # Used to handle `- #include` syntax
 
-    for line in fp:
+    for op in ops:
       self.line += 1
 
-      if line.endswith("\n"): line = line[:-1]
-      if line.endswith("\r"): line = line[:-1]
-
-      token, args, in_prefix = YamlPreProcessor.parse_line(line)
-      match token:
+      match op[0]:
         #
         # Control statements
         #
-        case 'else':
+        case compiler.ELSE:
           if len(cond_stack):
             cond_stack[0] = not cond_stack[0]
           else:
             self.msg('dangling #else directive')
-        case 'endif':
+        case compiler.ENDIF:
           if len(cond_stack):
             cond_stack = cond_stack[1:]
           else:
             self.msg('dangling #endif directive')
-        case 'ifdef':
+        case compiler.IFDEF:
           if len(cond_stack) > 0 and not cond_stack[0]:
             # suppressing output...
             cond_stack.insert(0,False)
           else:
-            if not args:
+            if not op[1]:
               self.msg('Missing conditional')
             else:
-              if args in self.ppv:
+              if op[1] in self.ppv:
                 cond_stack.insert(0,True)
               else:
                 cond_stack.insert(0,False)
-        case 'ifndef':
+        case compiler.IFNDEF:
           if len(cond_stack) > 0 and not cond_stack[0]:
             # suppressing output...
             cond_stack.insert(0,False)
           else:
-            if not args:
+            if not op[1]:
               self.msg('Missing conditional')
             else:
-              if args in self.ppv:
+              if op[1] in self.ppv:
                 cond_stack.insert(0,False)
               else:
                 cond_stack.insert(0,True)
+        case compiler.LITERAL:
+          if len(cond_stack) > 0 and not cond_stack[0]: continue # Suppresing output
+          yield prefix + op[1] + '\n'
+          prefix = prefix2
+        case compiler.MACRO:
+          if len(cond_stack) > 0 and not cond_stack[0]: continue # Suppresing output
+          yield prefix + self.expand_vars(op[1]) + '\n'
+          prefix = prefix2
         case _:
           #
           # Pre-processor directives
           #
           if len(cond_stack) > 0 and not cond_stack[0]: continue # Suppresing output
 
+          _, token, args, args_segs, in_prefix, line_segs = op
           if token in self.cmds:
-            if self.cmds[token].expand_vars: args = self.expand_vars(args)
+            if self.cmds[token].expand_vars: args = self.expand_vars(args_segs)
             addme = self.cmds[token].callback(self, args, prefix + in_prefix)
+            if isinstance(addme, str): addme = (addme,) if addme else ()
+            for chunk in addme:
+              yield chunk
+              prefix = prefix2
           else:
-            addme = prefix + self.expand_vars(line) + '\n'
-          txt += addme
-          if addme != '':  prefix = prefix2
+            yield prefix + self.expand_vars(line_segs) + '\n'
+            prefix = prefix2
 
-    return txt
-
-  def read_file(self, filename:str, prefix:str = '') -> str:
+  def iter_read_file(self, filename:str, prefix:str = '') -> typing.Iterator[str]:
     '''Process a file
 
     :param str filename: filename to read
     :param str prefix: (optional) Prefix string to maintain YAML structure
-    :returns str: processed text
+    :returns: iterator yielding processed text chunks
     '''
 
     filename = self.find_include(filename)
-    with open(filename, 'r') as fp:
-      state = self.save_state(filename)
-      txt = self.parser(fp, prefix)
+    ops = compiler.compile_file(filename)
+    state = self.save_state(filename)
+    try:
+      yield from self.iter_ops(ops, prefix)
+    finally:
       self.restore_state(state)
-    return txt
 
   def find_include(self, fname:str) -> str:
     ''' Find included file path
@@ -384,34 +472,11 @@ class YamlPreProcessor(iYamlPreProcessor):
     # Otherwise just hope for the best!
     return fname
 
-  def find_closing_bracket(line:str, off:int) -> int:
-    '''Find closing bracket
-
-    :param str line: string to scan
-    :param int off: offset in string
-    :returns int: returns the index to the closing bracket or -1 if not found
+  find_closing_bracket = compiler.find_closing_bracket
+  '''Find closing bracket
 
-    Used to find the closing bracket for a `$(macro reference)`.  It
-    will handle `$$` escapes and nested macro references.
-
-    '''
-    i = off
-    ln = len(line)
-    nesting = 0
-
-    while i < ln:
-      if line[i] == MK.SIGNAL and i+1 < ln and line[i+1] == MK.SIGNAL:
-        i += 2
-        continue
-      if line[i] == MK.SIGNAL and i+1 < ln and line[i+1] == MK.OPEN:
-        i += 2
-        nesting += 1
-        continue
-      if line[i] == MK.CLOSE:
-        if nesting == 0: return i
-        nesting -= 1
-      i += 1
-    return -1
+  See {py:obj}`compiler.find_closing_bracket`
+  '''
 
   def vexists(self, name:str) -> bool:
     '''Check if a name exists
@@ -420,70 +485,87 @@ class YamlPreProcessor(iYamlPreProcessor):
     '''
     return True if name in self.ppv else False
 
-  def lookup(self, name:str, loopctl:dict = dict()) -> str|None:
+  def lookup(self, name:str) -> str|None:
     '''Look-up variable defintions
 
     :param name: variable to look-up
-    :param loopctl: used to catch reference loops
     :returns: expanded string
+
+    Resolved values are cached until the variable, or any of the
+    variables it references, is re-defined with `define_var`.
     '''
+    if len(self.resolving):
+      # Remember the dependency (even if `name` is not defined yet)
+      deps = self.dependents.get(name)
+      if deps is None: deps = self.dependents[name] = set()
+      deps.add(self.resolving[-1])
+
+    if name in self.resolved: return self.resolved[name]
     if not name in self.ppv: return None
-    if not name in loopctl:
-      loopctl[name] = None # Used to prevent loops
-      loopctl[name] = self.expand_vars(self.ppv[name],loopctl)
-    if loopctl[name] is None:
+    if name in self.resolving:
       self.msg(f'Potential loop in defining "{name}"')
       return f'$({name})'
-    return loopctl[name]
 
-  def expand_vars(self, line:str, loopctl:dict = dict()) -> str:
+    self.resolving.append(name)
+    try:
+      self.resolve_refs(name)
+      value = self.expand_vars(self.ppv[name])
+    finally:
+      self.resolving.pop()
+    self.resolved[name] = value
+    return value
+
+  def resolve_refs(self, name:str) -> None:
+    '''_internal_ Resolve the variables referenced by `name` bottom-up
+    :meta internal:
+    :param name: variable about to be resolved
+
+    Walks the plain variable references of `name` and resolves the
+    deepest ones first.  This keeps the recursion in `lookup` shallow
+    when resolving long chains of variables.
+    '''
+    order = []
+    pending = [name]
+    seen = { name }
+    while len(pending):
+      for ref in compiler.split_macros(self.ppv[pending.pop()])[1::2]:
+        if ref in seen or ref in self.resolved or ref in self.resolving: continue
+        if ref in self.macros or not ref in self.ppv: continue
+        seen.add(ref)
+        pending.append(ref)
+        order.append(ref)
+    for ref in reversed(order):
+      self.lookup(ref)
+
+  def expand_vars(self, line:str|list[str]) -> str:
     '''Expand variables
 
-    :param line: text with variables to expand
-    :param  loopctl: used to catch reference loops
+    :param line: text with variables to expand, or segments as returned by {py:obj}`compiler.split_macros`
 
     Given a string with macro references it will expand them
     '''
-    if not MK.SIGNAL in line: return line # This is the trivial case...
-
-    offset = 0
-    txt = ''
-    lenline= len(line)
-
-    while (pos := line.find(MK.SIGNAL, offset)) != -1:
-      txt += line[offset:pos]
-      offset = pos
-      if pos+1 == lenline: break
-      if line[pos+1] == MK.SIGNAL:
-        txt += MK.SIGNAL
-        offset += 2
-        continue
-      if line[pos+1] != MK.OPEN:
-        txt += line[offset:offset+2]
-        offset += 2
-        continue
-
-      closing = YamlPreProcessor.find_closing_bracket(line, offset+2)
-      if closing == -1: break
-
-      ref = line[offset+2:closing]
-      exp = self.run_macro(ref, loopctl)
+    if isinstance(line, str):
+      if not MK.SIGNAL in line: return line # This is the trivial case...
+      line = compiler.split_macros(line)
+    if len(line) == 1: return line[0]
+
+    txt = [ line[0] ]
+    for i in range(1, len(line), 2):
+      ref = line[i]
+      exp = self.run_macro(ref)
       if exp is None:
         self.msg(f'Unknown macro "{ref}"')
-        txt += line[offset:closing+1]
+        txt.append(MK.SIGNAL + MK.OPEN + ref + MK.CLOSE)
       else:
-        txt += exp
+        txt.append(exp)
+      txt.append(line[i+1])
 
-      offset = closing +1
-    txt += line[offset:]
+    return ''.join(txt)
 
-    return txt
-
-  def run_macro(self, macro:str, loopctl:dict) -> str|None:
+  def run_macro(self, macro:str) -> str|None:
     '''Run macro references
 
     :param macro: Macro specification to run
-    :param loopctl: used to catch reference loops
     :returns: expanded string
 
     It will run the given macro.  Primarily it is meant to handle
@@ -500,10 +582,8 @@ class YamlPreProcessor(iYamlPreProcessor):
     if macro in self.macros:
       if self.macros[macro].expand_vars: args = self.expand_vars(args)
       return self.macros[macro].callback(self, args)
-    elif macro in self.ppv:
-      return self.lookup(macro, loopctl)
     else:
-      return None
+      return self.lookup(macro)
 
 ###################################################################
 #
@@ -528,4 +608,7 @@ if __name__ == '__main__':
   # ~ ic('Input', line)
   # ~ print(expand_vars(line, ppv))
 
-  pass
+  import doctest
+
+  failures, tests = doctest.testmod()
+  if failures > 0: sys.exit(1)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+'''Render profiling
+
+Opt-in instrumentation of a {py:obj}`pproc.YamlPreProcessor`
+instance.  Call counts, cumulative and self times are recorded
+for:
+
+- directives (`#include`, `#exec`, user registered, ...)
+- macros (`pwgen`, `sshkey`, `rndstr`, user registered, ...)
+- pre-processed files, including the top level document
+- variable look-ups
+
+Instances are only instrumented when `Profiler.attach` is called,
+so rendering without a profiler has no overhead.
+
+```python
+>>> import io, pproc
+>>> yppi = pproc.YamlPreProcessor(define = ['name=world'])
+>>> prof = Profiler()
+>>> prof.attach(yppi)
+>>> yppi.process(io.StringIO('#define greet hello $<name>\\nmsg: $<greet>\\n'))
+'msg: hello world\\n'
+>>> sorted((kind, name, calls) for (kind, name), (calls, _, _) in prof.stats.items())
+[('directive', 'define', 1), ('lookup', 'greet', 1), ('lookup', 'name', 1)]
+
+```
+'''
+import functools
+import json
+import sys
+import time
+import typing
+
+try:
+  from icecream import ic
+except ImportError:  # Graceful fallback if IceCream isn't installed.
+  ic = lambda *a: None if not a else (a[0] if len(a) == 1 else a)  # noqa
+
+DIRECTIVE = 'directive'
+'''Directive callbacks'''
+MACRO = 'macro'
+'''Macro callbacks'''
+FILE = 'file'
+'''Pre-processed files'''
+LOOKUP = 'lookup'
+'''Variable look-ups'''
+
+TEXT = 'text'
+'''Report as a text table'''
+JSON = 'json'
+'''Report as JSON'''
+FORMATS = (TEXT, JSON)
+'''Report formats'''
+
+class Profiler:
+  '''Collects render statistics
+
+  Statistics are kept in `stats`, keyed by (kind, name) tuples.
+  '''
+  def __init__(self):
+    '''Create an empty profiler'''
+    self.stats = {}
+    '''dict with lists of call count, cumulative and self time, keyed by (kind, name)'''
+    self.stack = []
+    '''_internal_ frames being timed: key, start time and time spent in children
+    :meta internal:
+    '''
+
+  def enter(self, key:tuple[str,str]) -> None:
+    '''Start timing
+
+    :param key: (kind, name) being timed
+    '''
+    self.stack.append([key, time.perf_counter(), 0.0])
+
+  def leave(self, count:bool = True) -> None:
+    '''Stop timing the innermost frame
+
+    :param count: if `True` count a call
+
+    Cumulative time is only added by the outermost frame of a key,
+    so recursive calls are not counted twice.
+    '''
+    key, start, children = self.stack.pop()
+    elapsed = time.perf_counter() - start
+    stat = self.stats.get(key)
+    if stat is None: stat = self.stats[key] = [0, 0.0, 0.0]
+    if count: stat[0] += 1
+    if not any(frame[0] == key for frame in self.stack): stat[1] += elapsed
+    stat[2] += elapsed - children
+    if len(self.stack): self.stack[-1][2] += elapsed
+
+  def timed_iter(self, key:tuple[str,str], it:typing.Iterable) -> typing.Iterator:
+    '''Time an iterator
+
+    :param key: (kind, name) being timed
+    :param it: iterator to time
+    :returns: iterator yielding the same items
+
+    Only the time spent producing items is counted, not the time
+    the consumer spends between items.
+    '''
+    it = iter(it)
+    while True:
+      self.enter(key)
+      try:
+        item = next(it)
+      except StopIteration:
+        return
+      finally:
+        self.leave(False)
+      yield item
+
+  def timed(self, kind:str, name:str|None, func:typing.Callable) -> typing.Callable:
+    '''Wrap a function so that its calls are timed
+
+    :param kind: kind of function (`DIRECTIVE`, `MACRO`, ...)
+    :param name: name to report, `None` to use the first argument
+    :param func: function to wrap
+    :returns: wrapped function
+
+    Iterators returned by `func` (such as included files) are timed
+    while they are consumed.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      key = (kind, name if not name is None else str(args[0]))
+      self.enter(key)
+      try:
+        res = func(*args, **kwargs)
+      finally:
+        self.leave()
+      if res is None or isinstance(res, str): return res
+      return self.timed_iter(key, res)
+    return wrapper
+
+  def attach(self, yppi:'pproc.YamlPreProcessor') -> None:
+    '''Instrument a pre-processor instance
+
+    :param yppi: pre-processor instance
+
+    Directives and macros registered after calling `attach` are
+    not timed.
+    '''
+    for token, directive in yppi.cmds.items():
+      directive.callback = self.timed(DIRECTIVE, token, directive.callback)
+    for macro, directive in yppi.macros.items():
+      directive.callback = self.timed(MACRO, macro, directive.callback)
+    yppi.iter_read_file = self.timed(FILE, None, yppi.iter_read_file)
+    yppi.lookup = self.timed(LOOKUP, None, yppi.lookup)
+
+  def rows(self) -> list[dict]:
+    '''Return statistics sorted by self time
+
+    :returns: list of dicts with kind, name, calls, cumulative and self times in seconds
+    '''
+    rows = [ { 'kind': kind, 'name': name, 'calls': calls, 'cumulative': cum, 'self': own }
+             for (kind, name), (calls, cum, own) in self.stats.items() ]
+    rows.sort(key = lambda row: (-row['self'], row['kind'], row['name']))
+    return rows
+
+  def report(self, fp:typing.TextIO = sys.stderr, fmt:str = TEXT, limit:int|None = None) -> None:
+    '''Write a report
+
+    :param fp: file to write to
+    :param fmt: `TEXT` or `JSON`
+    :param limit: maximum number of rows, `None` for all
+    '''
+    rows = self.rows()[:limit]
+    if fmt == JSON:
+      fp.write(json.dumps(rows, indent = 2) + '\n')
+      return
+    fp.write(f'{"calls":>8} {"cumul(ms)":>10} {"self(ms)":>10}  {"kind":<9} name\n')
+    for row in rows:
+      fp.write(f'{row["calls"]:>8} {row["cumulative"]*1000:>10.3f} {row["self"]*1000:>10.3f}  {row["kind"]:<9} {row["name"]}\n')
+
+if __name__ == '__main__':
+  import doctest
+
+  failures, tests = doctest.testmod()
+  if failures > 0: sys.exit(1)
@@ -3,25 +3,33 @@
 
 This is a module to do password hash manipulations
 '''
+import atexit
+import collections
+import contextlib
+import functools
+import hashlib
+import io
+import heapq
+import itertools
+import json
+import mmap
 import os
-import random
+import platform
+import secrets
 import string
 import sys
+import tempfile
 import typing
 import yaml
 
-try:
-  from passlib.hash import md5_crypt, sha256_crypt, sha512_crypt
-except ImportError:
-  pass
-
 try:
   from icecream import ic
 except ImportError:  # Graceful fallback if IceCream isn't installed.
   ic = lambda *a: None if not a else (a[0] if len(a) == 1 else a)  # noqa
 
+import compiler
 from d3des import encrypt as d3des
-from ipp import STR, iYamlPreProcessor
+from ipp import MK, STR, iYamlPreProcessor
 
 TEXT = 0
 '''Encode password as clear-text'''
@@ -36,6 +44,23 @@ VNC = 4
 
 DEF_PWLEN = 16
 '''Default length for generated passwords'''
+DEF_CHARSET = string.ascii_lowercase + string.ascii_uppercase + string.digits
+'''Default character set for generated passwords'''
+RAND_BATCH = 65536
+'''Number of random characters generated at a time'''
+
+HASH_ROUNDS = 5000
+'''Rounds used for SHA256 and SHA512 hashes'''
+
+HASH_EXT = '.hashes'
+'''Extension appended to the secrets file name for the hash cache'''
+LOCK_EXT = '.lock'
+'''Extension appended to the secrets file name for the lock file used while saving'''
+
+INDEX_MAGIC = b'#ypp-secrets-index 1\n'
+'''First line of indexed secrets files'''
+INDEX_EXT = '.idx'
+'''Extension of new secrets files using the indexed format'''
 
 HASH_STR = {
   'TEXT': TEXT,
@@ -46,9 +71,525 @@ HASH_STR = {
 }
 '''Text names of supported hashes'''
 
-secrets_cache = {}
-'''dict storing cached secrets'''
+def write_atomic(filename:str, chunks:typing.Iterable[str]) -> None:
+  '''Atomically replace a file
+
+  :param filename: file to write
+  :param chunks: text to write
+
+  Text is written and synced to a temporary file, which is then
+  renamed over `filename`.  So the file is never left partially
+  written.  Permissions of an existing file are preserved.
+  '''
+  dirname = os.path.dirname(filename) or '.'
+  fd, tmp = tempfile.mkstemp(dir = dirname, prefix = '.tmp')
+  try:
+    with os.fdopen(fd, 'w') as fp:
+      fp.writelines(chunks)
+      fp.flush()
+      os.fsync(fp.fileno())
+    if os.path.isfile(filename):
+      os.chmod(tmp, os.stat(filename).st_mode & 0o7777)
+    os.replace(tmp, filename)
+  except:
+    os.unlink(tmp)
+    raise
+  if platform.system() != 'Windows':
+    # Make sure the rename itself is persisted
+    dfd = os.open(dirname, os.O_RDONLY)
+    try:
+      os.fsync(dfd)
+    finally:
+      os.close(dfd)
+
+@contextlib.contextmanager
+def locked(filename:str) -> typing.Iterator[None]:
+  '''Hold an exclusive lock while updating a file
+
+  :param filename: file being updated
+
+  The lock is taken on a separate file named by appending
+  `LOCK_EXT`, as the file itself is replaced when saved.  Where
+  `fcntl` is not available no lock is taken.
+  '''
+  try:
+    import fcntl
+  except ImportError:
+    yield
+    return
+  with open(filename + LOCK_EXT, 'a') as fp:
+    fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+class SecretsStore:
+  '''Secrets store
+
+  Maps secret names to passwords kept in a YAML secrets file.
+  The file is only read when a secret is first looked up.  New
+  secrets are buffered in memory and written back with a single
+  call to `flush`.
+
+  ```python
+  >>> store = SecretsStore('no-such-file.yaml')
+  >>> 'one' in store
+  False
+  >>> store['one'] = 'two'
+  >>> store['one'], store.dirty
+  ('two', True)
+
+  ```
+  '''
+  def __init__(self, filename:str):
+    '''Create a secrets store
+
+    :param filename: secrets file backing this store
+    '''
+    self.filename = filename
+    '''File where secrets are saved'''
+    self.secrets = None
+    '''dict with loaded secrets, `None` until loaded'''
+    self.dirty = False
+    '''`True` if there are secrets not yet saved'''
+    self.modified = set()
+    '''Names of secrets not yet saved'''
+    self.hash_store = None
+    '''Store for cached password hashes, see `hashes`'''
+    self.owner = None
+    '''Secrets store whose password hashes this store caches'''
+    self.stamp = None
+    '''File modification time and size when last loaded or saved'''
+
+  def file_stamp(self) -> tuple[int,int]|None:
+    '''Return modification time and size of the secrets file
+
+    :returns: tuple(mtime, size) or `None` if the file does not exist
+    '''
+    try:
+      st = os.stat(self.filename)
+    except FileNotFoundError:
+      return None
+    return st.st_mtime_ns, st.st_size
+
+  def stale(self) -> bool:
+    '''Check if the secrets file was changed by someone else
+
+    :returns: `True` if loaded secrets without pending changes are out of date
+    '''
+    return not self.secrets is None and not self.dirty and self.stamp != self.file_stamp()
+
+  def hashes(self) -> 'SecretsStore':
+    '''Return the password hash cache
+
+    :returns: store with cached hashes
+
+    Hashes are kept in a store of the same format next to the
+    secrets file, named by appending `HASH_EXT`.
+    '''
+    if self.hash_store is None:
+      self.hash_store = type(self)(self.filename + HASH_EXT)
+      self.hash_store.owner = self
+    return self.hash_store
+
+  def valid(self, name:str) -> bool:
+    '''Check if a record is kept when saving
+
+    :param name: record name
+    :returns: `False` for cached hashes of passwords that were changed or removed
+    '''
+    if self.owner is None: return True
+    secret, digest = name.rsplit(':', 3)[:2]
+    return secret in self.owner and hashlib.sha256(self.owner[secret].encode()).hexdigest() == digest
+
+  def load(self) -> None:
+    '''Load secrets if not loaded yet
+
+    Missing files are ignored, as they are created on `flush`.
+    '''
+    if not self.secrets is None: return
+    self.secrets = {}
+    self.stamp = self.file_stamp()
+    if os.path.isfile(self.filename):
+      with open(self.filename,'r') as fp:
+        secrets = yaml.safe_load(fp)
+        if secrets: self.secrets.update(secrets)
+
+  def __contains__(self, name:str) -> bool:
+    self.load()
+    return name in self.secrets
+
+  def __getitem__(self, name:str) -> str:
+    self.load()
+    return self.secrets[name]
+
+  def __setitem__(self, name:str, value:str) -> None:
+    self.load()
+    self.secrets[name] = value
+    self.modified.add(name)
+    self.dirty = True
+
+  def items(self) -> typing.Iterator[tuple[str,str]]:
+    '''Iterate over stored secrets
+
+    :returns: iterator yielding name and password tuples
+    '''
+    self.load()
+    yield from self.secrets.items()
+
+  def lock(self) -> typing.ContextManager[None]:
+    '''Lock the secrets file while saving, if needed
+
+    :returns: context manager holding the lock
+
+    The lock is only taken if `locking` is enabled, or if the file
+    was changed since it was loaded, so that single process runs
+    do not leave a lock file behind.
+    '''
+    if locking or self.stamp != self.file_stamp(): return locked(self.filename)
+    return contextlib.nullcontext()
+
+  def flush(self) -> None:
+    '''Save secrets and hashes if there are pending changes
+
+    The file is locked while saving, see `lock`.  If another
+    process saved it since it was loaded, its secrets are merged
+    in, so that processes sharing a secrets file do not lose each
+    other's new secrets.
+    '''
+    if not self.hash_store is None: self.hash_store.flush()
+    if not self.dirty: return
+    with self.lock():
+      if self.stamp != self.file_stamp():
+        pending = { name: self.secrets[name] for name in self.modified }
+        self.secrets = None
+        self.load()
+        self.secrets.update(pending)
+      if not self.owner is None:
+        self.secrets = { k: v for k, v in self.secrets.items() if self.valid(k) }
+      write_atomic(self.filename, [yaml.dump(self.secrets)])
+      self.dirty = False
+      self.modified.clear()
+      self.stamp = self.file_stamp()
+
+class IndexedSecretsStore(SecretsStore):
+  '''Secrets store for large numbers of secrets
+
+  Secrets are saved as one line per secret, sorted by name, with
+  JSON encoded names and passwords separated by a tab.  The file
+  is memory mapped and secrets are looked up with a binary search,
+  so only the lines visited by the search are read.
+
+  New secrets are kept in memory and merged into the file on
+  `flush`.
+
+  ```python
+  >>> import tempfile
+  >>> with tempfile.TemporaryDirectory() as tmpdir:
+  ...   store = IndexedSecretsStore(os.path.join(tmpdir, 's.idx'))
+  ...   for i in range(5): store[f'pw{i}'] = str(i)
+  ...   store.flush()
+  ...   store = IndexedSecretsStore(store.filename)
+  ...   store['pw3'], 'pw9' in store, len(list(store.items()))
+  ('3', False, 5)
+
+  The last line does not need to end with a newline:
+
+  >>> with tempfile.TemporaryDirectory() as tmpdir:
+  ...   with open(os.path.join(tmpdir, 's.idx'), 'wb') as fp:
+  ...     _ = fp.write(INDEX_MAGIC + b'"a"\\t"x"\\n"b"\\t"y"')
+  ...   store = IndexedSecretsStore(fp.name)
+  ...   store['a'], store['b'], 'c' in store
+  ('x', 'y', False)
+
+  ```
+  '''
+  def __init__(self, filename:str):
+    '''Create an indexed secrets store
+
+    :param filename: secrets file backing this store
+    '''
+    super().__init__(filename)
+    self.mm = None
+    '''Memory mapped secrets file'''
+
+  def load(self) -> None:
+    '''Map the secrets file if not done yet'''
+    if not self.secrets is None: return
+    self.secrets = {}
+    self.stamp = self.file_stamp()
+    if not os.path.isfile(self.filename) or os.path.getsize(self.filename) <= len(INDEX_MAGIC): return
+    with open(self.filename, 'rb') as fp:
+      self.mm = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+    if self.mm[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+      raise ValueError(f'{self.filename}: not an indexed secrets file')
+
+  def find(self, name:str) -> str|None:
+    '''Look up a secret in the secrets file
+
+    :param name: secret to look up
+    :returns: password or `None` if not found
+    '''
+    self.load()
+    if self.mm is None: return None
+    key = json.dumps(name).encode()
+    lo, hi = len(INDEX_MAGIC), len(self.mm)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      nl = self.mm.rfind(b'\n', lo, mid)
+      start = lo if nl < 0 else nl + 1
+      end = self.mm.find(b'\n', start)
+      if end < 0: end = len(self.mm)
+      k, _, v = self.mm[start:end].partition(b'\t')
+      if k == key: return json.loads(v)
+      if k < key:
+        lo = end + 1
+      else:
+        hi = start
+    return None
+
+  def __contains__(self, name:str) -> bool:
+    self.load()
+    return name in self.secrets or not self.find(name) is None
+
+  def __getitem__(self, name:str) -> str:
+    self.load()
+    if name in self.secrets: return self.secrets[name]
+    passwd = self.find(name)
+    if passwd is None: raise KeyError(name)
+    return passwd
+
+  def records(self) -> typing.Iterator[tuple[bytes,bytes]]:
+    '''Iterate over all secrets in sorted order
+
+    :returns: iterator yielding encoded name and password tuples
+
+    Saved secrets are merged with the ones not saved yet.
+    '''
+    self.load()
+    pending = sorted((json.dumps(k).encode(), json.dumps(v).encode()) for k, v in self.secrets.items())
+    saved = iter(())
+    if not self.mm is None:
+      saved = (line.partition(b'\t')[::2] for line in self.mm[len(INDEX_MAGIC):].splitlines())
+    return heapq.merge(pending, saved, key = lambda rec: rec[0])
+
+  def items(self) -> typing.Iterator[tuple[str,str]]:
+    '''Iterate over stored secrets
+
+    :returns: iterator yielding name and password tuples
+    '''
+    for k, v in self.records():
+      yield json.loads(k), json.loads(v)
+
+  def flush(self) -> None:
+    '''Merge pending secrets into the secrets file
+
+    As with `SecretsStore.flush`, the file is locked and secrets
+    saved by other processes are kept.
+    '''
+    if not self.hash_store is None: self.hash_store.flush()
+    if not self.dirty: return
+    with self.lock():
+      if self.stamp != self.file_stamp():
+        # Map the file as saved by the other process
+        pending = self.secrets
+        if not self.mm is None: self.mm.close()
+        self.secrets, self.mm = None, None
+        self.load()
+        self.secrets = pending
+      self.merge()
+    self.secrets, self.dirty = None, False
+    self.modified.clear()
+
+  def merge(self) -> None:
+    '''_internal_ write the saved and pending secrets to the secrets file
+    :meta internal:
+    '''
+    def lines():
+      yield INDEX_MAGIC.decode()
+      last = None
+      for k, v in self.records():
+        # Pending secrets sort first, so saved duplicates are skipped
+        if k == last: continue
+        last = k
+        if not self.owner is None and not self.valid(json.loads(k)): continue
+        yield (k + b'\t' + v + b'\n').decode()
+      # Unmap before the file is replaced
+      if not self.mm is None: self.mm.close()
+      self.mm = None
+    write_atomic(self.filename, lines())
+
+stores = {}
+'''dict with secrets stores by absolute file path'''
+
+hash_cache = False
+'''Re-use password hashes saved in the hash cache'''
+rehash = False
+'''Always compute new hashes, replacing the cached ones'''
+rehashed = set()
+'''_internal_ hash cache keys already re-computed
+:meta internal:
+'''
+locking = False
+'''Always lock secrets files while saving, as other processes may save them at the same time'''
+
+def set_hash_cache(enabled:bool = True, force_rehash:bool = False) -> None:
+  '''Configure the password hash cache
+
+  :param enabled: if `False`, hashes are neither looked up nor saved
+  :param force_rehash: compute new hashes even if they are cached and update the cache
+
+  The hash cache is disabled until enabled with this function.
+  '''
+  global hash_cache, rehash
+  hash_cache = enabled
+  rehash = force_rehash
+  rehashed.clear()
+
+def set_locking(enabled:bool = True) -> None:
+  '''Configure locking of secrets files
 
+  :param enabled: if `True`, secrets files are always locked while saving
+
+  Enable this in processes that share secrets files with other
+  processes, such as the workers used when processing files in
+  parallel.  Otherwise files are only locked when they were changed
+  since they were loaded.
+  '''
+  global locking
+  locking = enabled
+
+def open_store(filename:str) -> SecretsStore:
+  '''Create a secrets store for a file
+
+  :param filename: secrets file
+  :returns: secrets store
+
+  Files starting with `INDEX_MAGIC`, or new files ending with
+  `INDEX_EXT`, use the indexed format.  All other files use the
+  YAML format.
+  '''
+  if os.path.isfile(filename):
+    with open(filename, 'rb') as fp:
+      indexed = fp.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+  else:
+    indexed = filename.endswith(INDEX_EXT)
+  return IndexedSecretsStore(filename) if indexed else SecretsStore(filename)
+
+def get_store(filename:str) -> SecretsStore:
+  '''Get the secrets store for a file
+
+  :param filename: secrets file
+  :returns: secrets store shared by all users of `filename`
+  '''
+  key = os.path.abspath(filename)
+  if not key in stores: stores[key] = open_store(key)
+  return stores[key]
+
+def revalidate() -> None:
+  '''Forget secrets stores whose files were changed by someone else
+
+  Used by long running processes, so that secrets and hashes are
+  re-read when other programs update them.
+  '''
+  for key, store in list(stores.items()):
+    if store.stale():
+      del stores[key]
+    elif not store.hash_store is None and store.hash_store.stale():
+      store.hash_store = None
+
+def convert(src:str, dst:str) -> None:
+  '''Copy secrets between stores
+
+  :param src: secrets file to read
+  :param dst: secrets file to write
+
+  Use this to convert a YAML secrets file to the indexed format
+  (by giving `dst` an `INDEX_EXT` extension) or back.
+  '''
+  target = open_store(dst)
+  for k, v in open_store(src).items():
+    target[k] = v
+  target.flush()
+
+def flush() -> None:
+  '''Save newly generated secrets
+
+  Called when the pre-processor finishes a document and on exit.
+  '''
+  for store in stores.values():
+    store.flush()
+
+atexit.register(flush)
+
+
+@functools.lru_cache
+def rand_table(charset:str) -> tuple[bytes,bytes]|None:
+  '''_internal_ translation tables used to map random bytes to a charset
+  :meta internal:
+
+  :param charset: set of characters to use
+  :returns: translation table and rejected bytes, `None` if `charset` can not be mapped from bytes
+
+  Byte values that would make some characters more likely than
+  others are rejected.
+  '''
+  try:
+    chars = charset.encode('latin-1')
+  except UnicodeEncodeError:
+    return None
+  if len(chars) > 256: return None
+  limit = 256 - 256 % len(chars)
+  return bytes(chars[b % len(chars)] for b in range(256)), bytes(range(limit, 256))
+
+def iter_rand(count:int, length:int = DEF_PWLEN, charset:str|None = None, batch:int = RAND_BATCH) -> typing.Iterator[str]:
+  '''Generate random strings in bulk
+
+  :param count: number of strings to generate
+  :param length: number of characters per string
+  :param charset: set of characters to use.  If None, it will select lower case, upper case and digits.
+  :param batch: approximate number of characters generated at a time
+  :returns: iterator yielding random strings
+
+  Random bytes are read from `os.urandom` in large blocks and
+  mapped to `charset` with rejection sampling, using
+  `bytes.translate` so no per-character Python code runs.
+  Charsets with more than 256 or non Latin-1 characters fall
+  back to `secrets.choice`.
+
+  ```python
+  >>> [ len(s) for s in iter_rand(3, 5) ]
+  [5, 5, 5]
+  >>> set(''.join(iter_rand(100, 10, 'ab'))) == {'a', 'b'}
+  True
+  >>> len(list(iter_rand(2, 4, 'αβγ')))
+  2
+
+  ```
+  '''
+  if charset is None or charset == '': charset = DEF_CHARSET
+  tables = rand_table(charset)
+  if tables is None or length <= 0:
+    for _ in range(count):
+      yield ''.join(secrets.choice(charset) for _ in range(length))
+    return
+
+  table, reject = tables
+  ratio = 256 / (256 - len(reject))
+  per_batch = max(1, batch // length)
+  pending = b''
+  while count > 0:
+    n = min(count, per_batch)
+    need = n * length
+    buf = pending
+    while len(buf) < need:
+      buf += os.urandom(int((need - len(buf)) * ratio) + 16).translate(table, reject)
+    chunk = buf[:need].decode('latin-1')
+    pending = buf[need:]
+    for off in range(0, need, length):
+      yield chunk[off:off+length]
+    count -= n
 
 def gen_rand(length:int = DEF_PWLEN, charset:str|None = None) -> str:
   '''Generate a random string
@@ -65,22 +606,21 @@ def gen_rand(length:int = DEF_PWLEN, charset:str|None = None) -> str:
   gen_rand(12, string.ascii_lowercase + string.ascii_uppercase + string.digits)
   ```
 
-  ```python
-  >>> random.seed(100), gen_rand()
-  (None, 'zKFST2OEfWjxnYXa')
-
+  Strings are generated with a cryptographically secure random
+  generator, see {py:obj}`iter_rand`.
 
-  >>> random.seed(101), gen_rand(32)
-  (None, 'm8Aa2YG0AL4Nf2utGc21a1CuAxt5RAUg')
-
-  >>> random.seed(102), gen_rand(24,string.digits)
-  (None, '737131295684894815597137')
+  ```python
+  >>> len(gen_rand())
+  16
+  >>> len(gen_rand(32))
+  32
+  >>> gen_rand(24,string.digits).isdigit()
+  True
 
   ```
 
   '''
-  if charset is None or charset == '': charset = string.ascii_lowercase + string.ascii_uppercase + string.digits
-  return ''.join(random.sample(charset*length, length))
+  return next(iter_rand(1, length, charset))
 
 def enc_passwd(passwd:str, encode:int = TEXT) -> str:
   '''Encode a password using a standard hash
@@ -123,17 +663,67 @@ def enc_passwd(passwd:str, encode:int = TEXT) -> str:
   '''
 
   if encode == MD5:
+    from passlib.hash import md5_crypt
     return md5_crypt.hash(passwd)
   elif encode == SHA256:
-    return sha256_crypt.hash(passwd,rounds=5000)
+    from passlib.hash import sha256_crypt
+    return sha256_crypt.hash(passwd,rounds=HASH_ROUNDS)
   elif encode == SHA512:
-    return sha512_crypt.hash(passwd,rounds=5000)
+    from passlib.hash import sha512_crypt
+    return sha512_crypt.hash(passwd,rounds=HASH_ROUNDS)
   elif encode == VNC:
     return d3des(passwd)
   else:
     return passwd
 
 
+def cached_hash(store:SecretsStore, secret:str, passwd:str, encode:int) -> str:
+  '''Encode a password re-using cached hashes
+
+  :param store: secrets store holding `secret`
+  :param secret: name of the secret
+  :param passwd: password to encode
+  :param encode: hash constant to use
+  :returns str: encoded string
+
+  If enabled with `set_hash_cache`, salted hashes are cached by
+  secret name, password digest, algorithm and rounds.  So the same
+  secret always encodes to the same hash, until the password
+  changes.  Hashes of changed or removed passwords are dropped
+  when the cache is saved.
+
+  ```python
+  >>> import tempfile
+  >>> set_hash_cache(True)
+  >>> with tempfile.TemporaryDirectory() as tmpdir:
+  ...   store = SecretsStore(os.path.join(tmpdir, 'secrets.yaml'))
+  ...   store['linux'] = 'onetwo'
+  ...   one = cached_hash(store, 'linux', 'onetwo', SHA512)
+  ...   same = one == cached_hash(store, 'linux', 'onetwo', SHA512)
+  ...   store['linux'] = 'three'
+  ...   same, one == cached_hash(store, 'linux', 'three', SHA512)
+  ...   store.flush()
+  ...   len(list(SecretsStore(store.hashes().filename).items()))
+  (True, False)
+  1
+  >>> set_hash_cache(False)
+
+  ```
+  '''
+  if not hash_cache or not encode in (MD5, SHA256, SHA512): return enc_passwd(passwd, encode)
+  algo = [ k for k, v in HASH_STR.items() if v == encode ][0]
+  rounds = 0 if encode == MD5 else HASH_ROUNDS
+  key = f'{secret}:{hashlib.sha256(passwd.encode()).hexdigest()}:{algo}:{rounds}'
+  hashes = store.hashes()
+  if rehash:
+    # Re-compute each hash only once
+    if (hashes.filename, key) in rehashed: return hashes[key]
+    rehashed.add((hashes.filename, key))
+  elif key in hashes:
+    return hashes[key]
+  hashes[key] = enc_passwd(passwd, encode)
+  return hashes[key]
+
 def gen(secrets_file:str, secret:str, encode:int = TEXT, pwlen:int = DEF_PWLEN, charset:str|None = None) -> str:
   '''Password generator
 
@@ -144,8 +734,8 @@ def gen(secrets_file:str, secret:str, encode:int = TEXT, pwlen:int = DEF_PWLEN,
   :param str charset: character set (defaults to None)
   :returns str: secret string
 
-  This will either use an existing password or generate a new one.  This
-  will update the `secrets_file` if a new password is generated.
+  This will either use an existing password or generate a new one.  New
+  passwords are saved to the `secrets_file` when `flush` is called.
 
   ```python
   >>> len(gen('pwgen.txt','linux', pwlen=32))
@@ -153,42 +743,33 @@ def gen(secrets_file:str, secret:str, encode:int = TEXT, pwlen:int = DEF_PWLEN,
 
   ```
   '''
-  if len(secrets_cache) == 0:
-    if os.path.isfile(secrets_file):
-      with open(secrets_file,'r') as fp:
-        secrets = yaml.safe_load(fp)
-        if secrets: secrets_cache.update(secrets)
-
-  if secret in secrets_cache:
-    passwd = secrets_cache[secret]
+  store = get_store(secrets_file)
+  if secret in store:
+    passwd = store[secret]
   else:
     passwd = gen_rand(pwlen, charset)
-    secrets_cache[secret] = passwd
-    with open(secrets_file,'w') as fp:
-      fp.write(yaml.dump(secrets_cache))
+    store[secret] = passwd
     print(f'Generated password for {secret} as "{passwd}"')
 
-  return enc_passwd(passwd, encode)
+  return cached_hash(store, secret, passwd, encode)
 
-def macro_pwgen(yppi:iYamlPreProcessor, args:str) -> str:
-  '''Implements pwgen macro
+def parse_opts(args:str) -> tuple[str|None,int,int,str,list[str]]:
+  '''Parse pwgen macro arguments
 
-  :param yppi: YamlPreProcessor instance
-  :param args: additional arguments
-  :returns: generated string
+  :param args: macro arguments
+  :returns: tuple(secret, encoding, pwlen, charset, ignored options)
 
-  Runs PWGEN macros and replaces them with the specified password.
-  It will either read them from the ``secrets_file`` or will
-  create a new password as needed.
+  ```python
+  >>> parse_opts('linux:SHA512:24:digits:bad')
+  ('linux', 3, 24, '0123456789', ['bad'])
 
-  Post-processed line will contain the specified password and this can
-  be formatted according to the macro's arguments.
+  ```
   '''
-
   secret = None
   encoding = TEXT
   pwlen = DEF_PWLEN
   chrset = ''
+  ignored = []
 
   for opt in args.split(':'):
     opt = opt.strip()
@@ -205,7 +786,115 @@ def macro_pwgen(yppi:iYamlPreProcessor, args:str) -> str:
     elif opt.upper() == 'DIGITS':
       chrset += string.digits
     else:
-      yppi.msg( f'Ignoring pwgen option {opt}')
+      ignored.append(opt)
+
+  return secret, encoding, pwlen, chrset, ignored
+
+def scan(ops:typing.Iterable[tuple]) -> typing.Iterator[tuple[str,int,str]]:
+  '''Find secrets referenced in compiled operations
+
+  :param ops: operations from {py:obj}`compiler.compile_file`
+  :returns: iterator yielding secret, password length and charset tuples
+
+  Only references with literal arguments are returned, as
+  arguments containing macros can only be resolved while
+  pre-processing.
+
+  ```python
+  >>> list(scan(compiler.compile_stream(['a: $<pwgen:one:SHA512>\\n', 'b: $<pwgen:$<name>>\\n', 'c: $<pwgen:two:8:digits>\\n'])))
+  [('one', 16, ''), ('two', 8, '0123456789')]
+
+  ```
+  '''
+  for op in ops:
+    if op[0] != compiler.MACRO: continue
+    for ref in op[1][1::2]:
+      cmd, _, args = ref.partition(':')
+      if cmd.strip() != 'pwgen' or MK.SIGNAL in args: continue
+      secret, _, pwlen, chrset, _ = parse_opts(args)
+      if secret: yield secret, pwlen, chrset
+
+def pregen(secrets_file:str, refs:typing.Iterable[tuple[str,int,str]]) -> list[str]:
+  '''Generate missing secrets and save them
+
+  :param secrets_file: path to the secrets file store
+  :param refs: secret, password length and charset tuples
+  :returns: list of generated secrets
+
+  Used before processing files in parallel, so that all worker
+  processes read the same passwords from the secrets file.
+  '''
+  store = get_store(secrets_file)
+  generated = []
+  for secret, pwlen, chrset in refs:
+    if secret in store: continue
+    gen(secrets_file, secret, TEXT, pwlen, chrset)
+    generated.append(secret)
+  store.flush()
+  return generated
+
+def pregen_files(yppi:iYamlPreProcessor, files:list[str]) -> list[str]:
+  '''Generate missing secrets referenced in files
+
+  :param yppi: Yaml Pre-Processor instance
+  :param files: files to scan
+  :returns: list of generated secrets
+
+  Only the `secrets_file` set by `yppi` is used, so files that
+  define their own `secrets_file` are skipped.  Secrets referenced
+  only from included files or through macros are still generated
+  while pre-processing, and merged into the secrets file when
+  it is saved.
+
+  ```python
+  >>> import subprocess, tempfile
+  >>> topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  >>> with tempfile.TemporaryDirectory() as tmpdir:
+  ...   secrets_file = os.path.join(tmpdir, 's.yaml')
+  ...   files = []
+  ...   for i in range(4):
+  ...     with open(os.path.join(tmpdir, f'inc{i}.yaml'), 'w') as fp:
+  ...       _ = fp.write(f'inc: $<pwgen:inc{i}>\\n')
+  ...     files.append(os.path.join(tmpdir, f'f{i}.yaml'))
+  ...     with open(files[-1], 'w') as fp:
+  ...       _ = fp.write(f'common: $<pwgen:common>\\nonly: $<pwgen:only{i}>\\n#include inc{i}.yaml\\n')
+  ...   res = subprocess.run([sys.executable, '-m', 'ypp', '-j4', f'-Dsecrets_file={secrets_file}', '--json-lines', *files],
+  ...                        capture_output = True, text = True, cwd = topdir)
+  ...   docs = [ json.loads(line) for line in res.stdout.splitlines() if line.startswith('{') ]
+  ...   store = SecretsStore(secrets_file)
+  ...   saved = dict(store.items())
+  ...   len(docs), len({ doc['common'] for doc in docs }), sorted(saved)
+  ...   all(doc['common'] == saved['common'] and doc['only'] == saved[f'only{i}'] and doc['inc'] == saved[f'inc{i}'] for i, doc in enumerate(docs))
+  (4, 1, ['common', 'inc0', 'inc1', 'inc2', 'inc3', 'only0', 'only1', 'only2', 'only3'])
+  True
+
+  ```
+  '''
+  refs = []
+  for fname in files:
+    ops = list(compiler.compile_file(fname))
+    if compiler.defines(ops, STR.SECRETS_FILE): continue
+    refs.extend(scan(ops))
+  return pregen(yppi.lookup(STR.SECRETS_FILE), refs)
+
+def macro_pwgen(yppi:iYamlPreProcessor, args:str) -> str:
+  '''Implements pwgen macro
+
+  :param yppi: YamlPreProcessor instance
+  :param args: additional arguments
+  :returns: generated string
+
+  Runs PWGEN macros and replaces them with the specified password.
+  It will either read them from the ``secrets_file`` or will
+  create a new password as needed.
+
+  Post-processed line will contain the specified password and this can
+  be formatted according to the macro's arguments.
+  '''
+
+  secret, encoding, pwlen, chrset, ignored = parse_opts(args)
+  for opt in ignored:
+    yppi.msg( f'Ignoring pwgen option {opt}')
 
   return gen(yppi.lookup(STR.SECRETS_FILE), secret, encoding, pwlen, chrset)
 
@@ -247,11 +936,97 @@ def register(yppi:iYamlPreProcessor) -> None:
   yppi.register_macro('rndstr', macro_randstr)
 
 
-def util(fp:typing.TextIO, defs:list[str]) -> None:
+def hash_record(record:tuple[str,str], encode:int) -> tuple[str,str]:
+  '''Encode the password of a record
+
+  :param record: name and password tuple
+  :param encode: hash constant to use
+  :returns: name and encoded password tuple
+  '''
+  name, passwd = record
+  return name, enc_passwd(passwd, encode)
+
+def hash_batch(records:list[tuple[str,str]], encode:int) -> list[tuple[str,str]]:
+  '''Encode the passwords of several records
+
+  :param records: name and password tuples
+  :param encode: hash constant to use
+  :returns: name and encoded password tuples
+  '''
+  return [ hash_record(record, encode) for record in records ]
+
+def read_records(fp:typing.TextIO) -> typing.Iterator[tuple[str,str]]:
+  '''Read `name<TAB>password` records
+
+  :param fp: file to read
+  :returns: iterator yielding name and password tuples
+
+  Empty lines are skipped.  Lines without a tab are reported and
+  skipped.
+
+  ```python
+  >>> list(read_records(['alice\\tone\\n', '\\n', 'bob\\ttwo\\tthree\\r\\n']))
+  [('alice', 'one'), ('bob', 'two\\tthree')]
+
+  ```
+  '''
+  for lno, line in enumerate(fp, 1):
+    line = line.rstrip('\r\n')
+    if line == '': continue
+    name, sep, passwd = line.partition('\t')
+    if sep == '':
+      sys.stderr.write(f'{lno}: Missing tab, line ignored\n')
+      continue
+    yield name, passwd
+
+def bulk_hash(inp:typing.TextIO, out:typing.TextIO, encode:int, jobs:int|None = None, chunksize:int = 64) -> None:
+  '''Encode many passwords
+
+  :param inp: file with `name<TAB>password` records
+  :param out: file where `name<TAB>hash` records are written
+  :param encode: hash constant to use
+  :param jobs: number of processes to use (defaults to the number of CPUs)
+  :param chunksize: number of records sent to a process at a time
+
+  Passwords are hashed in a process pool.  Results are written
+  in input order as soon as they are available.  Input is read
+  as the pool needs more work, with at most two batches of
+  `chunksize` records per process in flight, so memory does not
+  grow with the size of the input.
+
+  ```python
+  >>> out = io.StringIO()
+  >>> bulk_hash(io.StringIO(''.join(f'n{i}\\tp{i}\\n' for i in range(10))), out, TEXT, 2, 3)
+  >>> out.getvalue().splitlines()[:3]
+  ['n0\\tp0', 'n1\\tp1', 'n2\\tp2']
+  >>> len(out.getvalue().splitlines())
+  10
+
+  ```
+  '''
+  records = read_records(inp)
+  if jobs == 1:
+    for name, hashed in map(hash_record, records, itertools.repeat(encode)):
+      out.write(f'{name}\t{hashed}\n')
+    return
+  from concurrent.futures import ProcessPoolExecutor
+  def write(future):
+    for name, hashed in future.result():
+      out.write(f'{name}\t{hashed}\n')
+  window = collections.deque()
+  workers = jobs or os.cpu_count() or 1
+  with ProcessPoolExecutor(max_workers = workers) as pool:
+    for batch in iter(lambda: list(itertools.islice(records, chunksize)), []):
+      window.append(pool.submit(hash_batch, batch, encode))
+      if len(window) >= 2 * workers: write(window.popleft())
+    while window: write(window.popleft())
+
+def util(fp:typing.TextIO, defs:list[str], jobs:int|None = None) -> None:
   '''Implements a CLI utility for encoding passwords
 
   :param fp: Output file pointer
   :param defs: Passed arguments using `-D` options.
+  :param jobs: Number of processes used in bulk mode (defaults to the number of CPUs).
 
   Implements the command line option `--pwhash` to generate
   password hashes.  It accepts the following command line
@@ -261,11 +1036,16 @@ def util(fp:typing.TextIO, defs:list[str]) -> None:
   - `-Dpass=plaintext` : Specify the password to encode.
     If not provided, it will prompt on the screen or read
     from standard input.
+  - `-Dbulk=file` : Encode `name<TAB>password` records read from
+    `file` (or standard input if `file` is `-`) and output
+    `name<TAB>hash` records.  Passwords are hashed using all CPUs,
+    use `-j` to change the number of processes.
   - `-o output` : Save the hash to the `output` file, if not specified
     saves to standard output.
   '''
   enc = TEXT
   pwd = None
+  bulk = None
 
   for i in defs:
     if i.startswith('algo='):
@@ -276,9 +1056,20 @@ def util(fp:typing.TextIO, defs:list[str]) -> None:
         exit(2)
     elif i.startswith('pwd='):
       pwd = i[5:]
+    elif i.startswith('bulk='):
+      bulk = i[5:]
     else:
       sys.stderr.write(f'Option -D{i} ignored\n')
       continue
+
+  if bulk == '-':
+    bulk_hash(sys.stdin, fp, enc, jobs)
+    return
+  elif not bulk is None:
+    with open(bulk, 'r') as inp:
+      bulk_hash(inp, fp, enc, jobs)
+    return
+
   if pwd is None: pwd = input('Enter password: ')
 
   fp.write(enc_passwd(pwd, enc))
@@ -302,15 +1093,20 @@ def randutil(fp:typing.TextIO, defs:list[str]) -> None:
      - `D-chrset=lower` : Lower case characters
   - `-Dchrset` can be specified multiple times and it will be added
     to the chrset.
+  - `-Dcount=num`: generate `num` strings, one per line.  Defaults to 1.
   - `-o output` : Save the string the `output` file, if not specified
     saves to standard output.
   '''
   chrset = ''
   slen = DEF_PWLEN
+  count = 1
   for i in defs:
     if i.startswith('len='):
       slen = int(i[4:])
       continue
+    if i.startswith('count='):
+      count = int(i[6:])
+      continue
     if not i.startswith('chrset='):
       sys.stderr.write(f'Option -D{i} ignored\n')
       continue
@@ -323,17 +1119,19 @@ def randutil(fp:typing.TextIO, defs:list[str]) -> None:
     else:
       chrset += i[7:]
   if chrset == '': chrset = string.digits + string.ascii_uppercase + string.ascii_lowercase
-  fp.write(gen_rand(slen,chrset))
-  fp.write('\n')
+  fp.writelines(rnd + '\n' for rnd in iter_rand(count, slen, chrset))
 
 if __name__ == '__main__':
   import doctest
   import sys
 
   gen('pwgen.txt','linux', pwlen=32)
+  flush()
   failures, tests = doctest.testmod()
+  flush()
 
   os.unlink('pwgen.txt')
+  if os.path.exists('pwgen.txt' + LOCK_EXT): os.unlink('pwgen.txt' + LOCK_EXT)
 
   if failures > 0: sys.exit(1)
 
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+'''Resident pre-processor daemon
+
+Runs the command line interface in a long lived process that
+accepts requests over a UNIX domain socket.  This avoids paying
+for interpreter start-up, imports and re-reading configuration,
+secrets and templates on every call.
+
+Each connection carries a single request, sent by the client as one
+line of JSON:
+
+```json
+{"argv": ["-DX=1", "file.yaml"], "cwd": "/path", "env": {}, "stdin": null}
+```
+
+The server answers with one line of JSON containing the exit code
+and the captured output:
+
+```json
+{"rc": 0, "stdout": "...", "stderr": ""}
+```
+
+Requests are handled one at a time, as they run in the client's
+working directory and environment.
+
+```python
+>>> import shutil, subprocess, tempfile, time
+>>> topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+>>> tmpdir = tempfile.mkdtemp()
+>>> sock = os.path.join(tmpdir, 'ypp.sock')
+>>> for name in ('a', 'b'):
+...   os.mkdir(os.path.join(tmpdir, name))
+...   with open(os.path.join(tmpdir, name, 't.yaml'), 'w') as fp:
+...     _ = fp.write(f'v: {name.upper() * 3}\\n')
+...   os.utime(os.path.join(tmpdir, name, 't.yaml'), ns = (0, 0))
+>>> srv = subprocess.Popen([sys.executable, '-m', 'ypp', '--serve', sock], cwd = topdir, stderr = subprocess.DEVNULL)
+>>> deadline = time.monotonic() + 30
+>>> while not os.path.exists(sock) and srv.poll() is None and time.monotonic() < deadline: time.sleep(0.05)
+>>> srv.poll(), os.path.exists(sock)
+(None, True)
+>>> [ call(sock, ['t.yaml'], cwd = os.path.join(tmpdir, name))[1] for name in ('a', 'b', 'a') ]
+['v: AAA\\n', 'v: BBB\\n', 'v: AAA\\n']
+>>> srv.terminate(); srv.wait() and None; shutil.rmtree(tmpdir)
+
+```
+
+```python
+>>> import tempfile, threading
+>>> tmpdir = tempfile.mkdtemp()
+>>> sock = os.path.join(tmpdir, 'ypp.sock')
+>>> def echo(argv):
+...   print(*argv, sys.stdin.read())
+...   sys.exit(len(argv))
+>>> srv = listen(sock, echo)
+>>> oct(os.stat(sock).st_mode & 0o777)
+'0o600'
+>>> th = threading.Thread(target = srv.serve_forever, daemon = True)
+>>> th.start()
+>>> call(sock, ['one', 'two'], stdin = '!')
+(2, 'one two !\\n', '')
+>>> call(sock, ['one'], cwd = os.path.join(tmpdir, 'missing'))[0]
+53
+>>> srv.shutdown(); srv.server_close(); os.unlink(sock); os.rmdir(tmpdir)
+
+```
+'''
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import traceback
+import typing
+
+try:
+  from icecream import ic
+except ImportError:  # Graceful fallback if IceCream isn't installed.
+  ic = lambda *a: None if not a else (a[0] if len(a) == 1 else a)  # noqa
+
+ENCODING = 'utf-8'
+'''Encoding used on the socket'''
+RC_BAD_REQUEST = 53
+'''Exit code returned for requests that cannot be run'''
+
+Handler = typing.Callable[[list[str]],None]
+'''Request handler: called with the command line arguments, reads
+`sys.stdin`, writes `sys.stdout` and `sys.stderr` and may call
+`sys.exit`'''
+
+@contextlib.contextmanager
+def client_context(cwd:str, env:dict[str,str]) -> typing.Iterator[None]:
+  '''Run a request in the client's working directory and environment
+
+  :param cwd: working directory
+  :param env: environment variables
+
+  The server's directory and environment are restored afterwards.
+  '''
+  saved_cwd, saved_env = os.getcwd(), dict(os.environ)
+  try:
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(env)
+    yield
+  finally:
+    os.environ.clear()
+    os.environ.update(saved_env)
+    os.chdir(saved_cwd)
+
+def run_handler(handler:Handler, argv:list[str], stdin:str) -> tuple[int,str,str]:
+  '''Call a request handler, converting exits and errors to exit codes
+
+  :param handler: request handler
+  :param argv: command line arguments
+  :param stdin: standard input
+  :returns: exit code, standard output and standard error
+  '''
+  out, err = io.StringIO(), io.StringIO()
+  saved_stdin = sys.stdin
+  sys.stdin = io.StringIO(stdin)
+  try:
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+      try:
+        handler(argv)
+        rc = 0
+      except SystemExit as e:
+        if e.code is None:
+          rc = 0
+        elif isinstance(e.code, int):
+          rc = e.code
+        else:
+          sys.stderr.write(f'{e.code}\n')
+          rc = 1
+      except Exception:
+        sys.stderr.write(traceback.format_exc())
+        rc = 1
+  finally:
+    sys.stdin = saved_stdin
+  return rc, out.getvalue(), err.getvalue()
+
+class RequestHandler(socketserver.StreamRequestHandler):
+  '''Reads a request from the socket and writes the response'''
+  def handle(self) -> None:
+    line = self.rfile.readline()
+    if not line: return
+    try:
+      req = json.loads(line.decode(ENCODING))
+      argv, stdin = req['argv'], req.get('stdin') or ''
+      with client_context(req.get('cwd', os.getcwd()), req.get('env', os.environ)):
+        rc, out, err = run_handler(self.server.handler, argv, stdin)
+    except (ValueError, KeyError, TypeError, AttributeError, OSError) as e:
+      # Malformed requests and missing directories are reported to the client
+      rc, out, err = RC_BAD_REQUEST, '', f'Invalid request: {e!r}\n'
+    self.wfile.write(json.dumps({'rc': rc, 'stdout': out, 'stderr': err}).encode(ENCODING) + b'\n')
+
+def listen(path:str, handler:Handler) -> socketserver.UnixStreamServer:
+  '''Create a server listening on a UNIX domain socket
+
+  :param path: socket path
+  :param handler: function handling requests
+  :returns: server, call its `serve_forever` method to process requests
+  :raises OSError: if another server is already listening on `path`
+
+  Stale sockets left over by servers that did not shut down
+  cleanly are removed.  The socket is only accessible by the user
+  running the server, as requests run with the server's privileges.
+  '''
+  if os.path.exists(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+      try:
+        s.connect(path)
+      except ConnectionRefusedError:
+        os.unlink(path)
+      else:
+        raise OSError(f'{path}: server already running')
+  umask = os.umask(0o177)
+  try:
+    srv = socketserver.UnixStreamServer(path, RequestHandler)
+  finally:
+    os.umask(umask)
+  srv.handler = handler
+  return srv
+
+def serve(path:str, handler:Handler) -> None:
+  '''Serve requests until interrupted
+
+  :param path: socket path
+  :param handler: function handling requests
+
+  The socket is removed when the server exits.
+  '''
+  srv = listen(path, handler)
+  sys.stderr.write(f'Listening on {path}\n')
+  try:
+    srv.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    srv.server_close()
+    if os.path.exists(path): os.unlink(path)
+
+def call(path:str, argv:list[str], stdin:str|None = None, cwd:str|None = None, env:dict[str,str]|None = None) -> tuple[int,str,str]:
+  '''Send a request to a server
+
+  :param path: socket path
+  :param argv: command line arguments
+  :param stdin: standard input for the request
+  :param cwd: working directory, defaults to the current directory
+  :param env: environment, defaults to the current environment
+  :returns: exit code, standard output and standard error
+  '''
+  req = {
+    'argv': argv,
+    'cwd': os.getcwd() if cwd is None else cwd,
+    'env': dict(os.environ) if env is None else env,
+    'stdin': stdin,
+  }
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+    s.connect(path)
+    s.sendall(json.dumps(req).encode(ENCODING) + b'\n')
+    s.shutdown(socket.SHUT_WR)
+    with s.makefile('rb') as fp:
+      res = json.loads(fp.readline().decode(ENCODING))
+  return res['rc'], res['stdout'], res['stderr']
+
+def strip_option(argv:list[str], option:str) -> list[str]:
+  '''Remove an option and its value from a command line
+
+  :param argv: command line arguments
+  :param option: option to remove
+  :returns: arguments without `option`
+
+  ```python
+  >>> strip_option(['--client', 'x.sock', '-DA=1', 'f.yaml'], '--client')
+  ['-DA=1', 'f.yaml']
+  >>> strip_option(['--client=x.sock', 'f.yaml'], '--client')
+  ['f.yaml']
+
+  ```
+  '''
+  res = []
+  skip = False
+  for arg in argv:
+    if skip:
+      skip = False
+    elif arg == option:
+      skip = True
+    elif not arg.startswith(option + '='):
+      res.append(arg)
+  return res
+
+if __name__ == '__main__':
+  import doctest
+
+  failures, tests = doctest.testmod()
+  if failures > 0: sys.exit(1)
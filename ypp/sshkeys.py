@@ -1,39 +1,80 @@
 #!/usr/bin/env python3
 '''Generate SSH keys
 
+The `cryptography` library is only imported when the first key
+is generated.  Pre-processing documents without keys does not pay
+for it (nor for `passlib`, see {py:obj}`pwhash.enc_passwd`).  This
+is checked by `tests/test-imports.py`.
 '''
 import os
 import platform
+import tempfile
+import typing
 
-try:
-  from cryptography.hazmat.primitives import serialization as crypto_serialization
-  from cryptography.hazmat.primitives.asymmetric import rsa
-  from cryptography.hazmat.backends import default_backend as crypto_default_backend
-except ImportError:
-  pass
-
+import compiler
 from ipp import STR, iYamlPreProcessor
 
 DEF_KEYLEN = 4096
 '''Default key length'''
+RSA = 'rsa'
+'''RSA key type'''
+ED25519 = 'ed25519'
+'''Ed25519 key type'''
+ECDSA_CURVES = {
+  'ecdsa256': 'SECP256R1',
+  'ecdsa384': 'SECP384R1',
+  'ecdsa521': 'SECP521R1',
+}
+'''ECDSA key types and their curves'''
+KEY_TYPES = (RSA, ED25519) + tuple(ECDSA_CURVES)
+'''Supported key types'''
+DEF_KEYTYPE = RSA
+'''Default key type'''
 PUB = 1
 '''Return public keys'''
 PRIV = 2
 '''Return private keys'''
+KEY_CMDS = ('sshkey', 'keygen')
+'''Directives and macros that reference SSH keys'''
 
-def ssh_key_gen(keysz: int = DEF_KEYLEN):
+key_cache = {}
+'''dict storing key files read.  Keyed by path, contains tuple(mtime, size, text)'''
+
+def ssh_key_gen(keysz: int = DEF_KEYLEN, keytype:str = DEF_KEYTYPE):
   '''Generate a ssh key pair
-  :param int keysz: Key size
+  :param int keysz: Key size (only used for RSA keys)
+  :param str keytype: Key type, one of `KEY_TYPES`
   :returns str,str: public, private key pair
+  :raises ValueError: on unknown key types
+
+  Ed25519 private keys are stored in OpenSSH format, other key
+  types use the traditional PEM format.
+
+  The `cryptography` package is only imported here, when the first
+  key is generated, to keep start-up fast for documents that do not
+  use keys.
   '''
-  key = rsa.generate_private_key(
-      backend=crypto_default_backend(),
-      public_exponent=65537,
-      key_size=keysz
-  )
+  from cryptography.hazmat.primitives import serialization as crypto_serialization
+  from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+  from cryptography.hazmat.backends import default_backend as crypto_default_backend
+
+  private_format = crypto_serialization.PrivateFormat.TraditionalOpenSSL
+  if keytype == RSA:
+    key = rsa.generate_private_key(
+        backend=crypto_default_backend(),
+        public_exponent=65537,
+        key_size=keysz
+    )
+  elif keytype == ED25519:
+    key = ed25519.Ed25519PrivateKey.generate()
+    private_format = crypto_serialization.PrivateFormat.OpenSSH
+  elif keytype in ECDSA_CURVES:
+    key = ec.generate_private_key(getattr(ec, ECDSA_CURVES[keytype])())
+  else:
+    raise ValueError(f'Unknown key type {keytype}')
   private_key = key.private_bytes(
       crypto_serialization.Encoding.PEM,
-      crypto_serialization.PrivateFormat.TraditionalOpenSSL,
+      private_format,
       crypto_serialization.NoEncryption()
   ).decode('ascii')
   public_key = key.public_key().public_bytes(
@@ -42,8 +83,202 @@ def ssh_key_gen(keysz: int = DEF_KEYLEN):
   ).decode('ascii')
   return public_key, private_key
 
+def write_file(fname:str, text:str, mode:int|None = None) -> None:
+  '''Atomically write a file
+
+  :param fname: file to write
+  :param text: file contents
+  :param mode: optional file permissions
+
+  The text is written to a temporary file in the same directory
+  which is then renamed, so readers never see partially written
+  files.
+  '''
+  fd, tmp = tempfile.mkstemp(dir = os.path.dirname(fname) or '.', prefix = '.tmp')
+  try:
+    with os.fdopen(fd, 'w') as fp:
+      fp.write(text)
+    if not mode is None and platform.system() != 'Windows':
+      os.chmod(tmp, mode)
+    os.replace(tmp, fname)
+  except:
+    os.unlink(tmp)
+    raise
+
+def read_key(fname:str) -> str|None:
+  '''Read a key file
+
+  :param fname: file to read
+  :returns: key text or `None` if the file does not exist
+
+  Keys are cached in memory until the file changes, so long running
+  processes do not re-read the key store for every reference.
+  '''
+  try:
+    st = os.stat(fname)
+  except FileNotFoundError:
+    return None
+  if fname in key_cache:
+    mtime, size, text = key_cache[fname]
+    if mtime == st.st_mtime_ns and size == st.st_size: return text
+  with open(fname, 'r') as fp:
+    text = fp.read().strip()
+  key_cache[fname] = (st.st_mtime_ns, st.st_size, text)
+  return text
+
+def save_key(key_store:str, key_id:str, public_key:str, private_key:str, comment:str|None = None) -> str:
+  '''Save a generated key pair in the key store
+
+  :param key_store: directory path to keys
+  :param key_id: name of the key
+  :param public_key: public key text
+  :param private_key: private key text
+  :param comment: Key comment (defaults to key_id)
+  :returns: public key with comment
+
+  The private key is written first, so that when the public key
+  file exists, the key pair is complete.
+  '''
+  if comment is None: comment = key_id
+  public_key = public_key.strip() + " " + comment
+  base_name = os.path.join(key_store, key_id)
+  write_file(base_name, private_key, 0o600)
+  write_file(base_name + '.pub', public_key, 0o644)
+  return public_key
+
+def parse_opts(args:str) -> tuple[str|None, int, int, str, list[str]]:
+  '''Parse key options
+
+  :param args: colon separated key options
+  :returns: key id, mode, key length, key type and list of ignored options
+
+  ```python
+  >>> parse_opts('linux:priv:2048')
+  ('linux', 2, 2048, 'rsa', [])
+  >>> parse_opts('host1 : pub : ED25519 : dsa')
+  ('host1', 1, 4096, 'ed25519', ['dsa'])
+  >>> parse_opts('host2:ecdsa')
+  ('host2', 1, 4096, 'ecdsa256', [])
+
+  ```
+  '''
+  secret = None
+  keytype = PUB
+  keylen = DEF_KEYLEN
+  algo = DEF_KEYTYPE
+  ignored = []
+
+  for opt in args.split(':'):
+    opt = opt.strip()
+    if secret is None:
+      secret = opt
+    elif opt.upper() == 'PUB':
+      keytype = PUB
+    elif opt.upper() == 'PRIV':
+      keytype = PRIV
+    elif opt.isdigit():
+      keylen = int(opt)
+    elif opt.lower() in KEY_TYPES:
+      algo = opt.lower()
+    elif opt.lower() == 'ecdsa':
+      algo = 'ecdsa256'
+    else:
+      ignored.append(opt)
+  return secret, keytype, keylen, algo, ignored
+
+def scan(ops:typing.Iterable[tuple]) -> typing.Iterator[tuple[str,int,str]]:
+  '''Find SSH keys referenced in compiled operations
+
+  :param ops: operations from {py:obj}`compiler.compile_file`
+  :returns: iterator yielding key id, key length and key type tuples
 
-def gen(key_store:str, key_id:str, mode:int = PUB, key_sz:int = DEF_KEYLEN, comment:str|None = None):
+  Only references with literal arguments are returned, as
+  arguments containing macros can only be resolved while
+  pre-processing.
+
+  ```python
+  >>> list(scan(compiler.compile_stream(['  key: $<sshkey:host1:pub>\\n', '#keygen host2:priv:2048\\n', '$<sshkey:$<name>>\\n', '- $<sshkey:host3:ed25519>\\n'])))
+  [('host1', 4096, 'rsa'), ('host2', 2048, 'rsa'), ('host3', 4096, 'ed25519')]
+
+  ```
+  '''
+  for op in ops:
+    if op[0] == compiler.MACRO:
+      refs = op[1][1::2]
+    elif op[0] == compiler.DIRECTIVE and op[1] in KEY_CMDS:
+      refs = [ op[1] + ':' + op[2] ]
+    else:
+      continue
+    for ref in refs:
+      cmd, _, args = ref.partition(':')
+      if cmd.strip() not in KEY_CMDS or compiler.MK.SIGNAL in args: continue
+      key_id, _, key_sz, algo, _ = parse_opts(args)
+      if key_id: yield key_id, key_sz, algo
+
+def pregen(key_store:str, keys:typing.Iterable[tuple[str,int,str]], jobs:int|None = None) -> list[str]:
+  '''Generate missing keys in parallel
+
+  :param key_store: directory path to keys
+  :param keys: key id, key length and key type tuples
+  :param jobs: number of processes to use (defaults to the number of CPUs)
+  :returns: list of generated key ids
+
+  Key pairs that are already in the key store are skipped.  The
+  remaining keys are generated in a process pool and saved
+  atomically, so that the pre-processor later finds them in the
+  key store.
+  '''
+  missing = dict()
+  for key_id, key_sz, algo in keys:
+    if key_id in missing or os.path.isfile(os.path.join(key_store, key_id + '.pub')): continue
+    missing[key_id] = (key_sz, algo)
+  if len(missing) == 0: return []
+
+  from concurrent.futures import ProcessPoolExecutor
+  if not os.path.isdir(key_store): os.mkdir(key_store)
+  sizes, algos = zip(*missing.values())
+  with ProcessPoolExecutor(max_workers = jobs) as pool:
+    for key_id, (public_key, private_key) in zip(missing, pool.map(ssh_key_gen, sizes, algos)):
+      save_key(key_store, key_id, public_key, private_key)
+      print(f'Generated ssh key pair {key_id}')
+  return list(missing)
+
+def pregen_files(yppi:iYamlPreProcessor, files:list[str], jobs:int|None = None) -> list[str]:
+  '''Generate missing keys referenced in files
+
+  :param yppi: Yaml Pre-Processor instance
+  :param files: files to scan
+  :param jobs: number of processes to use (defaults to the number of CPUs)
+  :returns: list of generated key ids
+
+  Keys referenced only from included files or through macros are
+  still generated on demand while pre-processing.
+
+  Only the `key_store` set by `yppi` (that is, from the command
+  line or configuration) is used.  Files that define their own
+  `key_store` are skipped, so their keys are never generated in
+  the wrong directory.
+
+  ```python
+  >>> import pproc, tempfile
+  >>> with tempfile.TemporaryDirectory() as tmpdir:
+  ...   fname = os.path.join(tmpdir, 'doc.yaml')
+  ...   with open(fname, 'w') as fp:
+  ...     _ = fp.write(f'#define key_store {tmpdir}/own\\nkey: $<sshkey:host1>\\n')
+  ...   yppi = pproc.YamlPreProcessor(define = [f'key_store={tmpdir}/cli'])
+  ...   pregen_files(yppi, [fname]), os.listdir(tmpdir)
+  ([], ['doc.yaml'])
+
+  ```
+  '''
+  keys = []
+  for fname in files:
+    ops = list(compiler.compile_file(fname))
+    if compiler.defines(ops, STR.KEY_STORE): continue
+    keys.extend(scan(ops))
+  return pregen(yppi.lookup(STR.KEY_STORE), keys, jobs)
+
+def gen(key_store:str, key_id:str, mode:int = PUB, key_sz:int = DEF_KEYLEN, comment:str|None = None, key_type:str = DEF_KEYTYPE):
   '''Return a public/private key pair
 
   :param str key_store: directory path to keys
@@ -51,37 +286,26 @@ def gen(key_store:str, key_id:str, mode:int = PUB, key_sz:int = DEF_KEYLEN, comm
   :param str comment: Key comment (defaults to key_id)
   :param int mode: mode to use, either PRIV or PUB
   :param int key_sz: default key length
+  :param str key_type: key type to generate, one of `KEY_TYPES`
   :returns str: key text
 
   Will generate keys if they do not exist.  Generated keys are stored
   in the key_store directory with name key_id and key_id.pub.
+  Existing keys are returned regardless of `key_type`.
   '''
   if not os.path.isdir(key_store): os.mkdir(key_store)
 
-  base_name = os.path.join(key_store, key_id)
-  if mode == PUB and os.path.isfile(base_name + '.pub'):
+  base_name = os.path.abspath(os.path.join(key_store, key_id))
+  public_key = read_key(base_name + '.pub')
+  if mode == PUB and not public_key is None:
     # This is a bit of a special case, where public key already
     # exists, and only needs to be returned.
-    with open(base_name + '.pub','r') as fp:
-      public_key = fp.read().strip()
     return public_key
 
-  if os.path.isfile(base_name) and os.path.isfile(base_name + '.pub'):
-    with open(base_name, 'r') as fp:
-      private_key = fp.read().strip()
-    with open(base_name + '.pub','r') as fp:
-      public_key = fp.read().strip()
-  else:
-    public_key, private_key = ssh_key_gen(key_sz)
-    if comment is None: comment = key_id
-    public_key = public_key.strip() + " " + comment
-    with open(base_name, 'w') as fp:
-      fp.write(private_key)
-    with open(base_name + '.pub','w') as fp:
-      fp.write(public_key)
-    if platform.system() != 'Windows':
-      # Make sure the key file has the right permissions
-      os.chmod(base_name, 0o600)
+  private_key = read_key(base_name)
+  if private_key is None or public_key is None:
+    public_key, private_key = ssh_key_gen(key_sz, key_type)
+    public_key = save_key(key_store, key_id, public_key, private_key, comment)
     print(f'Generated ssh key pair {key_id}')
 
   if mode == PRIV:
@@ -98,40 +322,26 @@ def macro_sshkey(yppi:iYamlPreProcessor, args:str) -> str:
 
   Runs SSHKEY macros and replaces them with the specified key.
   '''
-  secret = None
-  keytype = PUB
-  keylen = DEF_KEYLEN
-
-  for opt in args.split(':'):
-    opt = opt.strip()
-    if secret is None:
-      secret = opt
-    elif opt.upper() == 'PUB':
-      keytype = PUB
-    elif opt.upper() == 'PRIV':
-      keytype = PRIV
-    elif opt.isdigit():
-      keylen = int(opt)
-    else:
-      yppi.msg(f'Ignoring keygen option {opt}')
-  return gen(yppi.lookup(STR.KEY_STORE), secret, keytype, keylen).strip()
+  secret, keytype, keylen, algo, ignored = parse_opts(args)
+  for opt in ignored:
+    yppi.msg(f'Ignoring keygen option {opt}')
+  return gen(yppi.lookup(STR.KEY_STORE), secret, keytype, keylen, key_type = algo).strip()
 
-def cb_sshkey(yppi:iYamlPreProcessor, args:str, prefix:str = '') -> str:
+def cb_sshkey(yppi:iYamlPreProcessor, args:str, prefix:str = '') -> typing.Iterator[str]:
   '''Handler for SSH key pairs
 
   :param yppi: Yaml Pre-Processor instance
   :param args: argument string passed in the pre-processor directive
   :param prefix: used to maintain YAML structure
+  :returns: iterator yielding key text lines
   '''
   key = macro_sshkey(yppi, args)
   prefix2 = prefix.replace('-',' ')
   # Used to handle `- #include` syntax
 
-  txt = ''
   for l in key.split('\n'):
-    txt += prefix + l + '\n'
+    yield prefix + l + '\n'
     prefix = prefix2
-  return txt
 
 def register(yppi:iYamlPreProcessor) -> None:
   '''Register callback for keypair statements and/or macros
@@ -145,10 +355,18 @@ def register(yppi:iYamlPreProcessor) -> None:
   yppi.register_macro('keygen', macro_sshkey)
 
 if __name__ == '__main__':
+  import doctest
   import shutil
-  pub, priv = ssh_key_gen()
-  print('pub', pub)
-  print('priv', priv)
-  print(gen('keys','linux', PUB, comment='Generated key'))
-  print(gen('keys','linux', PUB))
-  shutil.rmtree('keys')
+  import sys
+
+  failures, tests = doctest.testmod()
+  if failures > 0: sys.exit(1)
+
+  for keytype in KEY_TYPES:
+    pub, priv = ssh_key_gen(keytype = keytype)
+    print('pub', pub)
+    print('priv', priv)
+  key_store = tempfile.mkdtemp()
+  print(gen(key_store,'linux', PUB, comment='Generated key'))
+  print(gen(key_store,'linux', PUB))
+  shutil.rmtree(key_store)